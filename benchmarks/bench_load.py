@@ -0,0 +1,91 @@
+from common import use_temporary_database, create_database, percentile, add_baseline_arguments, report_baseline
+
+import argparse
+import asyncio
+import os
+import random
+import time
+
+# ASGI load driver: concurrent requests on each endpoint of the app, in process (no network),
+# reporting requests/s and p50/p95/p99 latency per endpoint
+# Usage: python benchmarks/bench_load.py --tasks 100000 --requests 2000 --concurrency 20 [--no-cache] [--save-baseline | --check]
+
+# Endpoints as (name, method, function returning the path and the json body)
+def endpoints(tasks: int) -> list:
+    task_id = lambda: random.randint(1, tasks)
+    return [
+        ("GET /tasks", "GET", lambda: ("/tasks?limit=100", None)),
+        ("GET /tasks?status&priority&sort", "GET", lambda: ("/tasks?status=pending&priority=high&sort=-updated_at&limit=100", None)),
+        ("GET /tasks/{task_id}", "GET", lambda: (f"/tasks/{task_id()}", None)),
+        ("GET /tasks/status", "GET", lambda: ("/tasks/status/pending?limit=100", None)),
+        ("GET /tasks/priority", "GET", lambda: ("/tasks/priority/high?limit=100", None)),
+        ("GET /tasks/status/priority", "GET", lambda: ("/tasks/status/pending/priority/high?limit=100", None)),
+        ("GET /tasks/sortBy/title", "GET", lambda: ("/tasks/sortBy/title?limit=100", None)),
+        ("GET /tasks/sortBy/dueDate", "GET", lambda: ("/tasks/sortBy/dueDate?limit=100", None)),
+        ("GET /tasks/sortBy/updatedAt", "GET", lambda: ("/tasks/sortBy/updatedAt?limit=100", None)),
+        ("GET /tasks/search", "GET", lambda: ("/tasks/search/deploy%20budget?limit=100", None)),
+        ("POST /tasks", "POST", lambda: ("/tasks", {"title": "Load test task", "priority": "high"})),
+        ("PUT /tasks/{task_id}", "PUT", lambda: (f"/tasks/{task_id()}", {"status": "in_progress"})),
+    ]
+
+async def run_endpoint(client, method: str, request, requests: int, concurrency: int) -> dict:
+    latencies, errors = [], 0
+    async def worker(count: int):
+        nonlocal errors
+        for _ in range(count):
+            path, body = request()
+            start = time.perf_counter()
+            response = await client.request(method, path, json=body)
+            latencies.append((time.perf_counter() - start) * 1000)
+            errors += response.status_code >= 400 and response.status_code != 404
+
+    start = time.perf_counter()
+    await asyncio.gather(*[worker(requests // concurrency) for _ in range(concurrency)])
+    elapsed = time.perf_counter() - start
+    return {
+        "requests_per_s": round(len(latencies) / elapsed, 1),
+        "p50_ms": round(percentile(latencies, 50), 3),
+        "p95_ms": round(percentile(latencies, 95), 3),
+        "p99_ms": round(percentile(latencies, 99), 3),
+        "errors": errors,
+    }
+
+async def load(args) -> dict:
+    import httpx
+    from main import app
+
+    results = {}
+    print(f"{'endpoint':<36} {'req/s':>10} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'errors':>7}")
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test", timeout=None) as client:
+        for name, method, request in endpoints(args.tasks):
+            if args.endpoint and args.endpoint not in name:
+                continue
+            result = await run_endpoint(client, method, request, args.requests, args.concurrency)
+            errors = result.pop("errors")
+            results[name] = result
+            print(f"{name:<36} {result['requests_per_s']:>10,.1f} {result['p50_ms']:>9.2f} {result['p95_ms']:>9.2f} {result['p99_ms']:>9.2f} {errors:>7}")
+    return results
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--tasks", type=int, default=100_000)
+    parser.add_argument("--requests", type=int, default=2000, help="requests per endpoint")
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--endpoint", help="only run the endpoints whose name contains this text")
+    parser.add_argument("--no-cache", action="store_true", help="disable the response cache to measure the queries")
+    add_baseline_arguments(parser)
+    args = parser.parse_args()
+
+    use_temporary_database()
+    if args.no_cache:
+        os.environ["CACHE_ENABLED"] = "false"
+    start = time.perf_counter()
+    create_database(args.tasks)
+    print(f"{args.tasks:,} synthetic tasks created in {time.perf_counter() - start:.1f}s\n")
+
+    random.seed(0)
+    results = asyncio.run(load(args))
+    report_baseline("load-no-cache" if args.no_cache else "load", results, args)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+from common import use_temporary_database, create_database, add_baseline_arguments, report_baseline
+
+import argparse
+import time
+import timeit
+
+# Micro-benchmarks: model validation, serialization and the query of each list endpoint of main.py,
+# run against a temporary database of synthetic tasks
+# Usage: python benchmarks/bench_micro.py --tasks 100000 [--save-baseline | --check]
+
+PAGE_SIZE = 100
+
+def validation_benchmarks() -> dict:
+    from models import TaskCreate, TaskUpdate
+    payload = {"title": "Write the report", "description": "Quarterly numbers", "status": "pending",
+               "priority": "high", "due_date": "2100-01-01T00:00:00Z", "assigned_to": "user1"}
+    return {
+        "validate TaskCreate": lambda: TaskCreate.model_validate(payload),
+        "validate TaskUpdate": lambda: TaskUpdate.model_validate({"status": "completed"}),
+    }
+
+def serialization_benchmarks(engine) -> dict:
+    from sqlmodel import Session, select
+    from models import Task, TaskResponse
+    from serializers import select_task_columns, encode_tasks
+    with Session(engine) as session:
+        rows = session.connection().execute(select_task_columns().limit(PAGE_SIZE)).all()
+        tasks = session.exec(select(Task).limit(PAGE_SIZE)).all()
+    return {
+        f"encode {PAGE_SIZE} rows (orjson)": lambda: encode_tasks(rows),
+        f"encode {PAGE_SIZE} tasks (pydantic)": lambda: [TaskResponse.model_validate(task).model_dump(mode="json") for task in tasks],
+    }
+
+# The first page of each list endpoint, built like main.py builds it
+def query_benchmarks(engine) -> dict:
+    from sqlmodel import Session
+    from models import Task, TaskStatus, TaskPriority
+    from serializers import select_task_columns, TASK_FIELDS
+    from pagination import paginate
+    from queries import task_query, parse_sort
+    from search import search_statement
+    from main import ID_KEYS, TITLE_KEYS, DUE_DATE_KEYS, UPDATED_AT_KEYS
+
+    pending, high = TaskStatus.pending, TaskPriority.high
+    queries = {
+        "GET /tasks": task_query({}, parse_sort("id"), TASK_FIELDS, None, PAGE_SIZE)[:2],
+        "GET /tasks?status&priority&sort": task_query({"status": [pending], "priority": [high]}, parse_sort("-updated_at"), TASK_FIELDS, None, PAGE_SIZE)[:2],
+        "GET /tasks/status": (paginate(select_task_columns().where(Task.status == pending), ID_KEYS, None, PAGE_SIZE), None),
+        "GET /tasks/priority": (paginate(select_task_columns().where(Task.priority == high), ID_KEYS, None, PAGE_SIZE), None),
+        "GET /tasks/status/priority": (paginate(select_task_columns().where(Task.status == pending, Task.priority == high), ID_KEYS, None, PAGE_SIZE), None),
+        "GET /tasks/sortBy/title": (paginate(select_task_columns(), TITLE_KEYS, None, PAGE_SIZE), None),
+        "GET /tasks/sortBy/dueDate": (paginate(select_task_columns(), DUE_DATE_KEYS, None, PAGE_SIZE), None),
+        "GET /tasks/sortBy/updatedAt": (paginate(select_task_columns(), UPDATED_AT_KEYS, None, PAGE_SIZE), None),
+        "GET /tasks/search": (paginate(*search_statement("report"), None, PAGE_SIZE), None),
+        "GET /tasks/{task_id}": (select_task_columns().where(Task.id == 1), None),
+    }
+    connection = Session(engine).connection()
+    return {name: (lambda statement=statement, parameters=parameters: connection.execute(statement, parameters).all())
+            for name, (statement, parameters) in queries.items()}
+
+# Best time of one call, in microseconds
+def measure(function, repeat: int) -> float:
+    timer = timeit.Timer(function)
+    number, _ = timer.autorange()
+    return min(timer.repeat(repeat = repeat, number = number)) / number * 1e6
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--tasks", type=int, default=100_000)
+    parser.add_argument("--repeat", type=int, default=5)
+    add_baseline_arguments(parser)
+    args = parser.parse_args()
+
+    use_temporary_database()
+    start = time.perf_counter()
+    create_database(args.tasks)
+    print(f"{args.tasks:,} synthetic tasks created in {time.perf_counter() - start:.1f}s\n")
+
+    from database import engine
+    benchmarks = {**validation_benchmarks(), **serialization_benchmarks(engine), **query_benchmarks(engine)}
+    results = {}
+    for name, function in benchmarks.items():
+        microseconds = measure(function, args.repeat)
+        results[name] = {"us": round(microseconds, 3)}
+        print(f"{name:<40} {microseconds:>12,.1f} us")
+
+    report_baseline("micro", results, args)
+
+if __name__ == "__main__":
+    main()
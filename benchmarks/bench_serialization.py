@@ -0,0 +1,91 @@
+import sys
+import os
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+
+import argparse
+import json
+import random
+import tempfile
+import time
+from datetime import datetime, timedelta, timezone
+from fastapi.responses import JSONResponse
+from sqlalchemy import insert
+from sqlmodel import SQLModel, Session, create_engine, select
+from models import Task, TaskResponse, TaskStatus, TaskPriority
+from serializers import select_task_columns, encode_tasks
+from common import add_baseline_arguments, report_baseline
+
+# Compare the per-row pydantic path against the column select + orjson path on a list of tasks
+# Usage: python benchmarks/bench_serialization.py --rows 100000 [--save-baseline | --check]
+
+def create_rows(engine, rows: int):
+    now = datetime.now(timezone.utc)
+    statuses, priorities = list(TaskStatus), list(TaskPriority)
+    tasks = [
+        {
+            "title": f"Task {i}",
+            "description": f"Description of task {i}" if i % 3 else None,
+            "status": random.choice(statuses),
+            "priority": random.choice(priorities),
+            "created_at": now - timedelta(minutes=i),
+            "updated_at": now if i % 2 else None,
+            "due_date": now + timedelta(days=i % 30) if i % 4 else None,
+            "assigned_to": f"user{i % 50}" if i % 5 else None,
+        }
+        for i in range(rows)
+    ]
+    with Session(engine) as session:
+        session.exec(insert(Task), params=tasks)
+        session.commit()
+
+# Previous path: ORM objects, TaskResponse validation and dump, then stdlib json encoding
+def pydantic_path(engine) -> bytes:
+    with Session(engine) as session:
+        tasks = session.exec(select(Task)).all()
+        response = [TaskResponse.model_validate(task, from_attributes=True).model_dump(mode="json") for task in tasks]
+    return JSONResponse(content=response).body
+
+# Fast path: column only select encoded straight to bytes
+def fast_path(engine) -> bytes:
+    with Session(engine) as session:
+        rows = session.connection().execute(select_task_columns()).all()
+    return encode_tasks(rows)
+
+def measure(function, engine, repeat: int) -> float:
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function(engine)
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=100_000)
+    parser.add_argument("--repeat", type=int, default=3)
+    add_baseline_arguments(parser)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        engine = create_engine(f"sqlite:///{os.path.join(directory, 'bench.db')}")
+        SQLModel.metadata.create_all(engine)
+        create_rows(engine, args.rows)
+
+        slow, fast = pydantic_path(engine), fast_path(engine)
+        assert json.loads(slow) == json.loads(fast), "fast path output differs from TaskResponse"
+
+        slow_time = measure(pydantic_path, engine, args.repeat)
+        fast_time = measure(fast_path, engine, args.repeat)
+        engine.dispose()
+
+    print(f"rows: {args.rows}")
+    print(f"pydantic + json: {slow_time:.3f}s ({args.rows / slow_time:,.0f} rows/s)")
+    print(f"columns + orjson: {fast_time:.3f}s ({args.rows / fast_time:,.0f} rows/s)")
+    print(f"speedup: {slow_time / fast_time:.1f}x")
+    results = {name: {"seconds": round(elapsed, 4), "rows_per_s": round(args.rows / elapsed)}
+        for name, elapsed in [("pydantic + json", slow_time), ("columns + orjson", fast_time)]}
+    report_baseline("serialization", results, args)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+from common import use_temporary_database, create_database, add_baseline_arguments, report_baseline
+
+import argparse
+import time
+import timeit
+
+# Bytes on the wire and encode CPU time of a page of tasks, for each list format and compression,
+# against the JSONResponse path (TaskResponse objects encoded by FastAPI) used before the orjson encoders
+# Usage: python benchmarks/bench_wire.py --tasks 10000 --page-sizes 100 1000 [--save-baseline | --check]
+
+def formats(engine, page_size: int) -> dict:
+    from fastapi.responses import JSONResponse
+    from sqlmodel import Session, select
+    from models import Task, TaskResponse
+    from serializers import MSGPACK_AVAILABLE, select_task_columns, encode_tasks, encode_tasks_columns, encode_tasks_msgpack
+    with Session(engine) as session:
+        rows = session.connection().execute(select_task_columns().limit(page_size)).all()
+        tasks = session.exec(select(Task).limit(page_size)).all()
+    encoders = {
+        "JSONResponse": lambda: JSONResponse([TaskResponse.model_validate(task).model_dump(mode="json") for task in tasks]).body,
+        "json": lambda: encode_tasks(rows),
+        "columns": lambda: encode_tasks_columns(rows),
+    }
+    if MSGPACK_AVAILABLE:
+        encoders["msgpack"] = lambda: encode_tasks_msgpack(rows)
+    return encoders
+
+# CPU time of one call, in microseconds
+def measure(function, repeat: int) -> float:
+    timer = timeit.Timer(function, timer = time.process_time)
+    number, _ = timer.autorange()
+    return min(timer.repeat(repeat = repeat, number = number)) / number * 1e6
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--tasks", type=int, default=10_000)
+    parser.add_argument("--page-sizes", type=int, nargs="+", default=[100, 1000])
+    parser.add_argument("--repeat", type=int, default=5)
+    add_baseline_arguments(parser)
+    args = parser.parse_args()
+
+    use_temporary_database()
+    create_database(args.tasks)
+
+    from database import engine
+    from compression import COMPRESSORS
+    results = {}
+    print(f"{'page':>5} {'format':<13} {'encoding':<9} {'bytes':>10} {'ratio':>7} {'encode us':>11} {'compress us':>12}")
+    for page_size in args.page_sizes:
+        baseline_bytes = None
+        for format, encode in formats(engine, page_size).items():
+            body = encode()
+            encode_us = measure(encode, args.repeat)
+            baseline_bytes = baseline_bytes or len(body)
+            for encoding in ["identity", *COMPRESSORS]:
+                if encoding == "identity":
+                    size, compress_us = len(body), 0.0
+                else:
+                    size = len(COMPRESSORS[encoding]().compress(body, True))
+                    compress_us = measure(lambda: COMPRESSORS[encoding]().compress(body, True), args.repeat)
+                results[f"{page_size} {format} {encoding}"] = {"bytes": size, "encode_us": round(encode_us + compress_us, 1)}
+                print(f"{page_size:>5} {format:<13} {encoding:<9} {size:>10,} {size / baseline_bytes:>7.1%} {encode_us:>11,.1f} {compress_us:>12,.1f}")
+
+    report_baseline("wire", results, args)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,157 @@
+import sys
+import os
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+
+import argparse
+import asyncio
+import json
+import subprocess
+import tempfile
+import time
+from common import percentile, add_baseline_arguments, report_baseline
+
+# Write throughput load test: concurrent writes of one task per request against a temporary database,
+# reporting writes/s and the latency of a request. --compare profile runs them before (default sqlite
+# settings, one transaction per request) and after (production profile with WAL pragmas and the single
+# writer queue). --compare paths runs PUT and DELETE under the production profile, first with the ORM
+# paths they had before single statement writes, then with the UPDATE/DELETE ... RETURNING statements.
+# The baseline of each operation and comparison is stored apart (writes-put, writes-delete-paths...)
+# Usage: python benchmarks/bench_writes.py --requests 2000 --concurrency 50 [--operation post|put|patch|delete] [--compare profile|paths] [--save-baseline | --check]
+
+PRODUCTION = {"DB_PROFILE": "production", "WRITE_QUEUE_ENABLED": "true"}
+MODES = {
+    "before": {"DB_PROFILE": "development", "WRITE_QUEUE_ENABLED": "false"},
+    "after": PRODUCTION,
+    "orm": PRODUCTION,
+    "statements": PRODUCTION,
+}
+COMPARISONS = {"profile": ["before", "after"], "paths": ["orm", "statements"]}
+
+# Request of each operation on the task with an id, as (method, path, json body)
+OPERATIONS = {
+    "post": lambda task_id: ("POST", "/tasks", {"title": f"Task {task_id}", "description": "Load test task"}),
+    "put": lambda task_id: ("PUT", f"/tasks/{task_id}", {"status": "in_progress", "description": "Updated by the load test"}),
+    "patch": lambda task_id: ("PATCH", f"/tasks/{task_id}", {"assigned_to": None, "priority": "urgent"}),
+    "delete": lambda task_id: ("DELETE", f"/tasks/{task_id}", None),
+}
+
+# PUT and DELETE of a task with the ORM: get, set, flush, refresh the version / get, delete, flush, get
+def add_orm_routes(app):
+    from datetime import datetime, timezone
+    from fastapi import HTTPException, Header
+    from fastapi.responses import JSONResponse
+    from models import Task, TaskUpdate, TaskResponse
+    from writer import write_queue
+    from cache import task_cache
+    from scheduler import scheduler
+    from etags import ETAGS_ENABLED, task_etag, etag_matches
+
+    async def update_task(task_id: int, tasknew: TaskUpdate, if_match: str | None = Header(default = None)):
+        async def write(session):
+            task = await session.get(Task, task_id)
+            if not task:
+                raise HTTPException(status_code = 404, detail = "Task not found")
+            if ETAGS_ENABLED and if_match and not etag_matches(if_match, task_etag(task.id, task.version), weak = False):
+                raise HTTPException(status_code = 412, detail = "Task was modified, get it again before updating")
+            for field, value in tasknew.model_dump(exclude_none = True).items():
+                setattr(task, field, value)
+            task.updated_at = datetime.now(timezone.utc)
+            session.add(task)
+            await session.flush()
+            await session.refresh(task, ["version"])
+            return TaskResponse.model_validate(task, from_attributes=True).model_dump(mode="json"), task.version, task.due_date
+
+        response, version, due_date = await write_queue.submit(write)
+        await task_cache.invalidate()
+        scheduler.notify(task_id, due_date)
+        return JSONResponse(status_code=200, content=response, headers={"ETag": task_etag(task_id, version)} if ETAGS_ENABLED else None)
+
+    async def delete_task(task_id: int):
+        async def write(session):
+            task = await session.get(Task, task_id)
+            if not task:
+                raise HTTPException(status_code = 404, detail = "Task not found")
+            await session.delete(task)
+            await session.flush()
+            if await session.get(Task, task_id):
+                raise HTTPException(status_code = 400, detail = "Could not delete task")
+
+        await write_queue.submit(write)
+        await task_cache.invalidate()
+        scheduler.notify(task_id, None)
+        return JSONResponse(status_code=200, content="Task deleted successfully")
+
+    app.add_api_route("/tasks/{task_id}", update_task, methods=["PUT"])
+    app.add_api_route("/tasks/{task_id}", delete_task, methods=["DELETE"])
+    # Matched before the routes of main.py
+    app.router.routes[:0] = app.router.routes[-2:]
+    del app.router.routes[-2:]
+
+async def load(requests: int, concurrency: int, operation: str, mode: str) -> dict:
+    import httpx
+    from main import app, main
+    if mode == "orm":
+        add_orm_routes(app)
+    # Updates and deletes each get their own synthetic task
+    main(0 if operation == "post" else requests)
+
+    errors, latencies = 0, []
+    async def worker(client, first_id: int, count: int):
+        nonlocal errors
+        for task_id in range(first_id, first_id + count):
+            method, path, body = OPERATIONS[operation](task_id)
+            start = time.perf_counter()
+            response = await client.request(method, path, json=body)
+            latencies.append((time.perf_counter() - start) * 1000)
+            errors += response.status_code >= 400
+
+    count = requests // concurrency
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test", timeout=None) as client:
+        start = time.perf_counter()
+        await asyncio.gather(*[worker(client, 1 + i * count, count) for i in range(concurrency)])
+        elapsed = time.perf_counter() - start
+    total = count * concurrency
+    print(f"{total} writes in {elapsed:.2f}s: {total / elapsed:,.0f} writes/s, "
+          f"p50 {percentile(latencies, 50):.2f} ms, p95 {percentile(latencies, 95):.2f} ms, {errors} errors")
+    return {"writes_per_s": round(total / elapsed, 1), "p50_ms": round(percentile(latencies, 50), 3), "p95_ms": round(percentile(latencies, 95), 3)}
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--operation", choices=OPERATIONS, default="post")
+    parser.add_argument("--compare", choices=COMPARISONS, default="profile")
+    parser.add_argument("--mode", choices=MODES)
+    # File the process of a mode writes its results to
+    parser.add_argument("--output", help=argparse.SUPPRESS)
+    add_baseline_arguments(parser)
+    args = parser.parse_args()
+    if args.compare == "paths" and args.operation not in ("put", "delete"):
+        parser.error("--compare paths runs --operation put or delete")
+
+    # Each mode runs in its own process since the engines are configured at import time
+    if args.mode:
+        result = asyncio.run(load(args.requests, args.concurrency, args.operation, args.mode))
+        if args.output:
+            with open(args.output, "w") as file:
+                json.dump(result, file)
+        return
+
+    results = {}
+    for mode in COMPARISONS[args.compare]:
+        env = MODES[mode]
+        with tempfile.TemporaryDirectory() as directory:
+            print(f"{mode}: ", end="", flush=True)
+            output = os.path.join(directory, "results.json")
+            subprocess.run(
+                [sys.executable, __file__, "--mode", mode, "--requests", str(args.requests), "--concurrency", str(args.concurrency), "--operation", args.operation, "--output", output],
+                env={**os.environ, **env, "SQLITE_FILE_NAME": os.path.join(directory, "bench.db")},
+                check=True,
+            )
+            with open(output) as file:
+                results[mode] = json.load(file)
+    report_baseline(f"writes-{args.operation}" + ("-paths" if args.compare == "paths" else ""), results, args)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+import sys
+import os
+
+sys.path.append(os.path.join(os.path.dirname(__file__), ".."))
+
+import atexit
+import json
+import shutil
+import statistics
+import tempfile
+
+# Shared helpers of the benchmarks: temporary database, percentiles and stored baselines
+
+BASELINES_FILE = os.path.join(os.path.dirname(__file__), "baselines.json")
+
+# Point the app at a new database in a temporary folder
+# Must be called before importing main or database, the engines are configured at import time
+def use_temporary_database() -> str:
+    directory = tempfile.mkdtemp(prefix="tasks-bench-")
+    atexit.register(shutil.rmtree, directory, ignore_errors=True)
+    os.environ["SQLITE_FILE_NAME"] = os.path.join(directory, "bench.db")
+    return os.environ["SQLITE_FILE_NAME"]
+
+# Create the schema and fill it with count synthetic tasks
+def create_database(count: int, seed: int = 0):
+    from migrations import migrate
+    from database_seeder import create_synthetic_tasks
+    migrate()
+    create_synthetic_tasks(count, seed)
+
+def percentile(values: list, p: float) -> float:
+    if len(values) < 2:
+        return values[0] if values else 0.0
+    return statistics.quantiles(values, n=100, method="inclusive")[int(p) - 1]
+
+# Metrics are lower is better, except throughputs (names ending with "per_s")
+def higher_is_better(metric: str) -> bool:
+    return metric.endswith("per_s")
+
+def load_baselines() -> dict:
+    if not os.path.exists(BASELINES_FILE):
+        return {}
+    with open(BASELINES_FILE) as file:
+        return json.load(file)
+
+# Store results ({name: {metric: value}}) as the baseline of a benchmark, with the arguments of the run
+def save_baseline(benchmark: str, results: dict, arguments: dict):
+    baselines = load_baselines()
+    baselines[benchmark] = {"arguments": arguments, "results": results}
+    with open(BASELINES_FILE, "w") as file:
+        json.dump(baselines, file, indent=2, sort_keys=True)
+        file.write("\n")
+    print(f"baseline of {benchmark} saved to {BASELINES_FILE}")
+
+# Compare results with the stored baseline, returns the regressions beyond tolerance (0.2 = 20% worse)
+def check_baseline(benchmark: str, results: dict, arguments: dict, tolerance: float) -> list:
+    stored = load_baselines().get(benchmark)
+    if stored is None:
+        print(f"no baseline stored for {benchmark}, run with --save-baseline first")
+        return []
+    if stored["arguments"] != arguments:
+        print(f"warning: the baseline was measured with {stored['arguments']}")
+    baseline = stored["results"]
+    regressions = []
+    for name, metrics in results.items():
+        for metric, value in metrics.items():
+            expected = baseline.get(name, {}).get(metric)
+            if not expected:
+                continue
+            change = (expected - value) / expected if higher_is_better(metric) else (value - expected) / expected
+            if change > tolerance:
+                regressions.append(f"{name} {metric}: {value:,.3f} vs baseline {expected:,.3f} ({change:+.0%})")
+    return regressions
+
+# Handle --save-baseline and --check, exiting with an error on regressions
+def report_baseline(benchmark: str, results: dict, args):
+    arguments = {name: value for name, value in vars(args).items() if name not in ("save_baseline", "check", "tolerance")}
+    if args.save_baseline:
+        save_baseline(benchmark, results, arguments)
+    if args.check:
+        regressions = check_baseline(benchmark, results, arguments, args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            sys.exit(1)
+        print(f"no regression beyond {args.tolerance:.0%} against the baseline")
+
+def add_baseline_arguments(parser):
+    parser.add_argument("--save-baseline", action="store_true", help="store the results as the new baseline")
+    parser.add_argument("--check", action="store_true", help="fail if the results regressed against the baseline")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed regression before failing (0.25 = 25%%)")
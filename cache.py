@@ -0,0 +1,196 @@
+import os
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from etags import ETAGS_ENABLED, table_version
+from metrics import METRICS, CounterMetric
+
+# Read-through cache of encoded task responses
+# Lists are cached by query (path and query string) under a generation number that every write bumps,
+# so a write makes every cached list unreachable at once. Single tasks are cached by id and version:
+# a write gives the task a new version, which only makes that task's entry unreachable, and the other
+# tasks stay cached (where tasks have no versions, the generation stands for the version).
+# Values are the response bytes, ready to be sent.
+# On sqlite the generation is the change counter of the task table (see etags.py), read in the same
+# transaction as the cached data: writes of every worker process, and of the import command, are seen
+# by the in-process cache of each worker without any message between them.
+
+CACHE_ENABLED = os.getenv("CACHE_ENABLED", "true").lower() == "true"
+CACHE_TTL = float(os.getenv("CACHE_TTL", "30"))
+CACHE_MAX_ENTRIES = int(os.getenv("CACHE_MAX_ENTRIES", "10000"))
+CACHE_URL = os.getenv("CACHE_URL")
+# "database" (the change counter, sqlite only) or "cache" (a counter in the cache backend, bumped by this process's writes)
+CACHE_GENERATION_SOURCE = os.getenv("CACHE_GENERATION_SOURCE", "database")
+
+CACHE_LOOKUPS = CounterMetric("cache_lookups_total", "Response cache lookups, by result (hit or miss)")
+CACHE_INVALIDATIONS = CounterMetric("cache_invalidations_total", "Writes making the cached lists unreachable")
+METRICS.extend([CACHE_LOOKUPS, CACHE_INVALIDATIONS])
+
+# Storage of the cache, the in-process backend can be replaced by a shared one (e.g. redis) without other changes
+class CacheBackend(ABC):
+    @abstractmethod
+    async def get(self, key: str) -> bytes | None:
+        ...
+
+    @abstractmethod
+    async def set(self, key: str, value: bytes, ttl: float):
+        ...
+
+    @abstractmethod
+    async def delete(self, *keys: str):
+        ...
+
+    @abstractmethod
+    async def counter(self, key: str) -> int:
+        ...
+
+    @abstractmethod
+    async def incr(self, key: str) -> int:
+        ...
+
+    # Drop every cached value, but not the counters
+    @abstractmethod
+    async def clear(self):
+        ...
+
+# LRU cache with a time to live, local to the process
+class InProcessBackend(CacheBackend):
+    def __init__(self, max_entries: int = CACHE_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.counters = {}
+
+    async def get(self, key: str) -> bytes | None:
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        value, expires_at = entry
+        if expires_at < time.monotonic():
+            del self.entries[key]
+            return None
+        self.entries.move_to_end(key)
+        return value
+
+    async def set(self, key: str, value: bytes, ttl: float):
+        self.entries[key] = (value, time.monotonic() + ttl)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last = False)
+
+    async def delete(self, *keys: str):
+        for key in keys:
+            self.entries.pop(key, None)
+
+    async def counter(self, key: str) -> int:
+        return self.counters.get(key, 0)
+
+    async def incr(self, key: str) -> int:
+        self.counters[key] = self.counters.get(key, 0) + 1
+        return self.counters[key]
+
+    async def clear(self):
+        self.entries.clear()
+
+# Redis backend shared by every worker, used when CACHE_URL is set (needs the redis package)
+class RedisBackend(CacheBackend):
+    def __init__(self, url: str):
+        import redis.asyncio
+        self.client = redis.asyncio.from_url(url)
+
+    async def get(self, key: str) -> bytes | None:
+        return await self.client.get(key)
+
+    async def set(self, key: str, value: bytes, ttl: float):
+        await self.client.set(key, value, px = int(ttl * 1000))
+
+    async def delete(self, *keys: str):
+        if keys:
+            await self.client.delete(*keys)
+
+    async def counter(self, key: str) -> int:
+        value = await self.client.get(key)
+        return int(value) if value else 0
+
+    async def incr(self, key: str) -> int:
+        return await self.client.incr(key)
+
+    async def clear(self):
+        keys = [key async for key in self.client.scan_iter("tasks:item:*")]
+        keys += [key async for key in self.client.scan_iter("tasks:list:*")]
+        await self.delete(*keys)
+
+class TaskCache:
+    GENERATION_KEY = "tasks:generation"
+
+    def __init__(self, backend: CacheBackend, ttl: float = CACHE_TTL, enabled: bool = CACHE_ENABLED, generation_source = None):
+        self.backend = backend
+        self.generation_source = generation_source
+        self.ttl = ttl
+        self.enabled = enabled
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    # Generation of the cached data, read it before querying the database (on the connection of the query)
+    # and pass it to set()
+    async def generation(self, connection = None) -> int:
+        if self.generation_source and connection is not None:
+            return await self.generation_source(connection)
+        return await self.backend.counter(self.GENERATION_KEY)
+
+    # Key of a task at a version (read with the cached data), or at a generation where tasks have no versions
+    def task_key(self, task_id: int, version: int) -> str:
+        return f"tasks:item:{task_id}:{version}"
+
+    def list_key(self, generation: int, query: str) -> str:
+        return f"tasks:list:{generation}:{query}"
+
+    async def get(self, key: str) -> bytes | None:
+        if not self.enabled:
+            return None
+        value = await self.backend.get(key)
+        if value is None:
+            self.misses += 1
+            CACHE_LOOKUPS.inc(result = "miss")
+        else:
+            self.hits += 1
+            CACHE_LOOKUPS.inc(result = "hit")
+        return value
+
+    # Values read from the database are only stored if no write happened since the read started,
+    # otherwise a response older than the write could be cached after its invalidation
+    # (a generation read from the database belongs to the same snapshot as the data, so it is always right,
+    # and so does the version of a task key, which is passed without a generation)
+    async def set(self, key: str, value: bytes, generation: int | None = None):
+        if not self.enabled:
+            return
+        if generation is None or self.generation_source or await self.generation() == generation:
+            await self.backend.set(key, value, self.ttl)
+
+    # Called after every committed write of this process: every cached list becomes unreachable
+    async def invalidate(self):
+        if not self.enabled:
+            return
+        self.invalidations += 1
+        CACHE_INVALIDATIONS.inc()
+        await self.backend.incr(self.GENERATION_KEY)
+
+    # Drop every cached value (counters are kept so that reads in progress do not store stale values)
+    async def clear(self):
+        await self.backend.clear()
+        await self.backend.incr(self.GENERATION_KEY)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "enabled": self.enabled,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+            "invalidations": self.invalidations,
+        }
+
+task_cache = TaskCache(
+    RedisBackend(CACHE_URL) if CACHE_URL else InProcessBackend(),
+    generation_source = table_version if ETAGS_ENABLED and CACHE_GENERATION_SOURCE == "database" else None,
+)
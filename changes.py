@@ -0,0 +1,85 @@
+import asyncio
+import os
+import time
+from sqlalchemy import DateTime, String, bindparam, type_coerce, Integer
+from sqlmodel import select
+from sqlmodel.ext.asyncio.session import AsyncSession
+from models import Task, TaskChange, ChangeOp
+from serializers import TASK_FIELDS, TASK_COLUMNS, encode
+from etags import table_version
+
+# Change feed over the task_change table (see models.py)
+# A client keeps the seq of the last change it applied and asks for the changes after it, getting each
+# changed task once with its current state, or a tombstone for deleted tasks. Starting from since=0
+# returns every task, so the feed is also the initial sync.
+
+CHANGES_POLL_INTERVAL = float(os.getenv("TASKS_CHANGES_POLL_INTERVAL", "1"))
+CHANGES_STREAM_TIMEOUT = float(os.getenv("TASKS_CHANGES_STREAM_TIMEOUT", "300"))
+CHANGES_KEEP_ALIVE = 15
+
+# Changes after :since in seq order, with the current columns of the task (null for deleted tasks)
+CHANGES_STATEMENT = (
+    select(
+        TaskChange.seq,
+        TaskChange.task_id,
+        type_coerce(TaskChange.op, String()).label("op"),
+        type_coerce(TaskChange.changed_at, DateTime()).label("changed_at"),
+        *TASK_COLUMNS,
+    )
+    .select_from(TaskChange)
+    .outerjoin(Task, Task.id == TaskChange.task_id)
+    .where(TaskChange.seq > bindparam("since"))
+    .order_by(TaskChange.seq)
+    .limit(bindparam("limit", type_ = Integer))
+)
+
+def change_to_dict(row) -> dict:
+    seq, task_id, op, changed_at, *task = row
+    return {
+        "seq": seq,
+        "task_id": task_id,
+        "op": op,
+        "changed_at": changed_at,
+        "task": None if op == ChangeOp.delete.name else dict(zip(TASK_FIELDS, task)),
+    }
+
+# Up to limit changes after since, and whether more changes follow
+async def read_changes(connection, since: int, limit: int) -> tuple[list, bool]:
+    rows = (await connection.execute(CHANGES_STATEMENT, {"since": since, "limit": limit + 1})).all()
+    return [change_to_dict(row) for row in rows[:limit]], len(rows) > limit
+
+# One page of the feed, next_since is the seq to ask from next time
+# (the current change counter once the client is up to date, lower than since if the database was reseeded)
+async def changes_page(engine, since: int, limit: int) -> dict:
+    async with AsyncSession(engine) as session:
+        connection = await session.connection()
+        changes, has_more = await read_changes(connection, since, limit)
+        next_since = changes[-1]["seq"] if changes else await table_version(connection)
+    return {"changes": changes, "next_since": next_since, "has_more": has_more}
+
+# Server-sent events of the changes after since: the backlog first, then new changes as they are committed
+# The change counter is checked every poll interval (a primary key lookup) and the feed only queried when it moved
+# The stream ends after timeout seconds (or when the client leaves), clients reconnect with the Last-Event-ID header
+async def stream_changes(engine, since: int, limit: int, timeout: float, is_disconnected):
+    deadline = time.monotonic() + timeout
+    last_sent = time.monotonic()
+    yield f"retry: {int(CHANGES_POLL_INTERVAL * 1000)}\n\n".encode()
+    while True:
+        async with AsyncSession(engine) as session:
+            connection = await session.connection()
+            has_more = False
+            if await table_version(connection) > since:
+                changes, has_more = await read_changes(connection, since, limit)
+                for change in changes:
+                    yield b"id: %d\nevent: change\ndata: %b\n\n" % (change["seq"], encode(change))
+                    since = change["seq"]
+                if changes:
+                    last_sent = time.monotonic()
+        if has_more:
+            continue
+        if time.monotonic() >= deadline or await is_disconnected():
+            return
+        if time.monotonic() - last_sent >= CHANGES_KEEP_ALIVE:
+            yield b": keep-alive\n\n"
+            last_sent = time.monotonic()
+        await asyncio.sleep(min(CHANGES_POLL_INTERVAL, max(deadline - time.monotonic(), 0)))
@@ -0,0 +1,140 @@
+import os
+import zlib
+
+# Response compression negotiated with the Accept-Encoding header
+# zstd and brotli are used when their packages (zstandard, brotli) are installed, gzip otherwise. Responses
+# smaller than COMPRESSION_MIN_SIZE are sent as they are, since compressing them saves less than it costs.
+# Streamed responses (NDJSON listings, exports) are compressed chunk by chunk, each chunk flushed so that
+# clients can decode it on arrival. Server-sent events and already compressed formats are left alone.
+# Entity tags are kept: they identify the content, whatever its encoding (like Starlette's GZipMiddleware).
+
+COMPRESSION_ENABLED = os.getenv("COMPRESSION_ENABLED", "true").lower() == "true"
+COMPRESSION_MIN_SIZE = int(os.getenv("COMPRESSION_MIN_SIZE", "1024"))
+# Encodings in order of preference when a client accepts several with the same weight
+COMPRESSION_ENCODINGS = [encoding.strip() for encoding in os.getenv("COMPRESSION_ENCODINGS", "zstd,br,gzip").split(",")]
+
+# Compression levels, higher levels trade CPU time for smaller responses (see benchmarks/bench_wire.py)
+GZIP_LEVEL = int(os.getenv("COMPRESSION_GZIP_LEVEL", "6"))
+BROTLI_QUALITY = int(os.getenv("COMPRESSION_BROTLI_QUALITY", "4"))
+ZSTD_LEVEL = int(os.getenv("COMPRESSION_ZSTD_LEVEL", "3"))
+
+COMPRESSIBLE_TYPES = ("application/json", "application/x-ndjson", "application/msgpack", "text/csv", "text/plain")
+
+class GzipCompressor:
+    def __init__(self, level: int = GZIP_LEVEL):
+        self.compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+
+    def compress(self, data: bytes, final: bool) -> bytes:
+        return self.compressor.compress(data) + self.compressor.flush(zlib.Z_FINISH if final else zlib.Z_SYNC_FLUSH)
+
+class BrotliCompressor:
+    def __init__(self, quality: int = BROTLI_QUALITY):
+        import brotli
+        self.compressor = brotli.Compressor(quality = quality)
+
+    def compress(self, data: bytes, final: bool) -> bytes:
+        return self.compressor.process(data) + (self.compressor.finish() if final else self.compressor.flush())
+
+class ZstdCompressor:
+    def __init__(self, level: int = ZSTD_LEVEL):
+        import zstandard
+        self.flush_block = zstandard.COMPRESSOBJ_FLUSH_BLOCK
+        self.compressor = zstandard.ZstdCompressor(level = level).compressobj()
+
+    def compress(self, data: bytes, final: bool) -> bytes:
+        return self.compressor.compress(data) + (self.compressor.flush() if final else self.compressor.flush(self.flush_block))
+
+# Compressors of the encodings whose package is installed
+def available_compressors() -> dict:
+    compressors = {"gzip": GzipCompressor}
+    for encoding, compressor, package in (("br", BrotliCompressor, "brotli"), ("zstd", ZstdCompressor, "zstandard")):
+        try:
+            __import__(package)
+            compressors[encoding] = compressor
+        except ImportError:
+            pass
+    return compressors
+
+COMPRESSORS = available_compressors()
+
+# Pick the encoding of a response from an Accept-Encoding header, None to send it uncompressed
+def negotiate_encoding(header: str, encodings: list = COMPRESSION_ENCODINGS) -> str | None:
+    weights = {}
+    for item in header.split(","):
+        name, *parameters = [part.strip() for part in item.split(";")]
+        weight = 1.0
+        for parameter in parameters:
+            if parameter.startswith("q="):
+                try:
+                    weight = float(parameter[2:])
+                except ValueError:
+                    weight = 0.0
+        weights[name.lower()] = weight
+    candidates = [encoding for encoding in encodings if encoding in COMPRESSORS and weights.get(encoding, weights.get("*", 0)) > 0]
+    if not candidates:
+        return None
+    return max(candidates, key = lambda encoding: weights.get(encoding, weights.get("*", 0)))
+
+def is_compressible(headers: list) -> bool:
+    content_type, encoded = "", False
+    for name, value in headers:
+        if name == b"content-type":
+            content_type = value.decode("latin-1")
+        elif name == b"content-encoding":
+            encoded = True
+    return not encoded and content_type.startswith(COMPRESSIBLE_TYPES)
+
+def add_vary(headers: list) -> list:
+    for index, (name, value) in enumerate(headers):
+        if name == b"vary":
+            if b"accept-encoding" not in value.lower():
+                headers[index] = (name, value + b", Accept-Encoding")
+            return headers
+    return headers + [(b"vary", b"Accept-Encoding")]
+
+class CompressionMiddleware:
+    def __init__(self, app, minimum_size: int = COMPRESSION_MIN_SIZE):
+        self.app = app
+        self.minimum_size = minimum_size
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not COMPRESSION_ENABLED:
+            return await self.app(scope, receive, send)
+        accept_encoding = next((value for name, value in scope["headers"] if name == b"accept-encoding"), b"").decode("latin-1")
+        encoding = negotiate_encoding(accept_encoding) if accept_encoding else None
+
+        start = None
+        compressor = None
+
+        async def send_wrapper(message):
+            nonlocal start, compressor
+            if message["type"] == "http.response.start":
+                # Sent with the first body message, once the size of the response is known
+                start = message
+                return
+            if message["type"] != "http.response.body" or start is None:
+                return await send(message)
+
+            body, more_body = message.get("body", b""), message.get("more_body", False)
+            if compressor is None:
+                headers = list(start.get("headers", []))
+                compressible = start["status"] not in (204, 304) and is_compressible(headers)
+                if compressible:
+                    headers = add_vary(headers)
+                if not compressible or encoding is None or (not more_body and len(body) < self.minimum_size):
+                    await send({**start, "headers": headers})
+                    start = None
+                    return await send(message)
+
+                compressor = COMPRESSORS[encoding]()
+                headers = [(name, value) for name, value in headers if name != b"content-length"]
+                headers.append((b"content-encoding", encoding.encode()))
+                body = compressor.compress(body, not more_body)
+                if not more_body:
+                    headers.append((b"content-length", str(len(body)).encode()))
+                await send({**start, "headers": headers})
+                return await send({"type": "http.response.body", "body": body, "more_body": more_body})
+
+            await send({"type": "http.response.body", "body": compressor.compress(body, not more_body), "more_body": more_body})
+
+        await self.app(scope, receive, send_wrapper)
@@ -1,5 +1,7 @@
+import random
+from itertools import accumulate, islice
 from models import Task, TaskStatus, TaskPriority
-from datetime import datetime, timezone
+from datetime import datetime, timedelta, timezone
 from database import engine
 from sqlmodel import Session
 
@@ -13,4 +15,41 @@ def create_tasks():
     
     with Session(engine) as session:
         session.add_all([task_1, task_2, task_3, task_4, task_5])
-        session.commit()
\ No newline at end of file
+        session.commit()
+
+# Distributions of the synthetic tasks: most tasks are done or waiting, few are urgent,
+# a few assignees hold most of the work (zipf like) and about a third of the tasks have no description
+STATUS_WEIGHTS = {TaskStatus.pending: 30, TaskStatus.in_progress: 15, TaskStatus.completed: 45, TaskStatus.cancelled: 10}
+PRIORITY_WEIGHTS = {TaskPriority.low: 30, TaskPriority.medium: 45, TaskPriority.high: 18, TaskPriority.urgent: 7}
+WORDS = ("review", "deploy", "fix", "update", "write", "test", "design", "release", "report", "meeting",
+         "invoice", "customer", "database", "backup", "api", "docs", "budget", "migration", "security", "sprint")
+
+# Generate count synthetic task rows (dicts ready for an executemany insert), the same ones for the same seed
+# Rows are produced lazily so any number of tasks can be generated in constant memory
+def generate_tasks(count: int, seed: int = 0, assignees: int = 1000):
+    rng = random.Random(seed)
+    now = datetime.now(timezone.utc)
+    statuses, status_weights = list(STATUS_WEIGHTS), list(accumulate(STATUS_WEIGHTS.values()))
+    priorities, priority_weights = list(PRIORITY_WEIGHTS), list(accumulate(PRIORITY_WEIGHTS.values()))
+    assignee_names = [f"user{rank}" for rank in range(assignees)]
+    assignee_weights = list(accumulate(1 / rank for rank in range(1, assignees + 1)))
+    for i in range(count):
+        created_at = now - timedelta(seconds=rng.randint(0, 365 * 24 * 3600))
+        updated_at = created_at + timedelta(seconds=rng.randint(0, 30 * 24 * 3600)) if rng.random() < 0.6 else None
+        yield {
+            "title": " ".join(rng.choices(WORDS, k=rng.randint(2, 6))).capitalize(),
+            "description": " ".join(rng.choices(WORDS, k=rng.randint(5, 40))) if rng.random() < 0.65 else None,
+            "status": rng.choices(statuses, cum_weights=status_weights)[0],
+            "priority": rng.choices(priorities, cum_weights=priority_weights)[0],
+            "created_at": created_at,
+            "updated_at": min(updated_at, now) if updated_at else None,
+            "due_date": created_at + timedelta(days=rng.randint(1, 90)) if rng.random() < 0.5 else None,
+            "assigned_to": rng.choices(assignee_names, cum_weights=assignee_weights)[0] if rng.random() < 0.8 else None,
+            "version": 0,
+        }
+
+# Insert count synthetic tasks with the bulk loader, returns the number of tasks
+def create_synthetic_tasks(count: int, seed: int = 0, batch_size: int = 10_000, bind = engine) -> int:
+    from transfer import load_chunks
+    rows = generate_tasks(count, seed)
+    return load_chunks(iter(lambda: list(islice(rows, batch_size)), []), bind)
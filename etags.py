@@ -0,0 +1,54 @@
+import hashlib
+from sqlalchemy import literal_column, text
+from database import is_sqlite
+
+# Entity tags of task responses, for conditional requests (If-None-Match, If-Match)
+# A task's tag is built from its id and version, a list's tag from the change counter of the task table
+# and the query, so checking whether a response changed only needs one primary key lookup
+
+# The change counter and the task versions are maintained by sqlite triggers (see models.py)
+ETAGS_ENABLED = is_sqlite
+
+# Current value of the change counter of the task table
+async def table_version(connection) -> int:
+    return (await connection.execute(text("SELECT value FROM task_version WHERE id = 1"))).scalar_one()
+
+# Version of the next write, for a statement setting the version of the task it writes (see TASK_VERSION_DDL)
+NEXT_VERSION = literal_column("(SELECT value + 1 FROM task_version WHERE id = 1)")
+
+def task_etag(task_id: int, version: int) -> str:
+    return f'"{task_id}.{version}"'
+
+def list_etag(version: int, query: str) -> str:
+    return f'"{version}.{hashlib.sha1(query.encode()).hexdigest()[:16]}"'
+
+# Whether an If-None-Match (weak comparison) or If-Match (strong comparison) header matches a tag
+def etag_matches(header: str | None, etag: str, weak: bool = True) -> bool:
+    if not header:
+        return False
+    for candidate in header.split(","):
+        candidate = candidate.strip()
+        if candidate == "*":
+            return True
+        if candidate.startswith("W/"):
+            if not weak:
+                continue
+            candidate = candidate[2:]
+        if candidate == etag:
+            return True
+    return False
+
+# Versions of a task accepted by an If-Match header, for a conditional update in one statement
+# None when any version is accepted (no header, or "*")
+def if_match_versions(header: str | None, task_id: int) -> list[int] | None:
+    if not header:
+        return None
+    versions = []
+    for candidate in header.split(","):
+        candidate = candidate.strip()
+        if candidate == "*":
+            return None
+        tag_id, _, version = candidate.strip('"').partition(".")
+        if candidate.startswith('"') and tag_id == str(task_id) and version.isdigit():
+            versions.append(int(version))
+    return versions
@@ -4,250 +4,822 @@ import os
 sys.path.append(os.path.dirname(__file__))
 
 from models import *
-from database import engine, create_db, sqlite_file_name
-from database_seeder import create_tasks
-from sqlmodel import Session, select
-from datetime import datetime
-from fastapi import FastAPI, HTTPException
-from fastapi.responses import JSONResponse
+from database import FTS5_AVAILABLE, engine, async_engine, sqlite_file_name, is_sqlite
+from migrations import SCHEMA_VERSION, migrate, schema_version
+from database_seeder import create_tasks, create_synthetic_tasks
+from serializers import TASK_FIELDS, TASK_COLUMNS, select_task_columns, execute_rows, row_to_dict, encode, encode_task, encode_tasks, encode_tasks_ndjson, encode_tasks_columns, encode_tasks_msgpack, MSGPACK_AVAILABLE
+from writer import write_queue
+from search import search_statement, like_search_statement
+from pagination import DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE, InvalidCursor, decode_cursor, paginate, next_page
+from queries import parse_sort, parse_fields, sort_keys, task_query
+from cache import task_cache
+from transfer import FORMATS, PARQUET_AVAILABLE, TransferError, TransferConflict, import_tasks, export_tasks, export_header, encode_chunk
+from metrics import MetricsMiddleware, instrument_engine, render as render_metrics
+from compression import CompressionMiddleware
+from changes import CHANGES_STREAM_TIMEOUT, changes_page, stream_changes
+from stats import read_stats
+from scheduler import scheduler
+from routing import RoutingMiddleware, router, read_engine
+from etags import ETAGS_ENABLED, NEXT_VERSION, table_version, task_etag, list_etag, etag_matches, if_match_versions
+from sqlmodel import select
+from sqlalchemy import insert, update, delete, bindparam, text
+from sqlalchemy.exc import IntegrityError
+from sqlmodel.ext.asyncio.session import AsyncSession
+from datetime import datetime, timedelta, timezone
+from fastapi import FastAPI, HTTPException, Query, Header, Depends, Body, Request
+from fastapi.responses import JSONResponse, StreamingResponse, Response
+from starlette.background import BackgroundTask
+from fastapi.concurrency import run_in_threadpool
+from tempfile import SpooledTemporaryFile
+from contextlib import asynccontextmanager
+import argparse
+import signal
+import threading
+import time
 from pydantic import ValidationError
+from urllib.parse import urlencode
 import uvicorn
 
+# Production settings, see run_production()
+WEB_CONCURRENCY = int(os.getenv("WEB_CONCURRENCY", "0")) or os.cpu_count() or 1
+GRACEFUL_TIMEOUT = float(os.getenv("GRACEFUL_TIMEOUT", "30"))
+DRAIN_DELAY = float(os.getenv("DRAIN_DELAY", "5"))
+SEED_ENABLED = os.getenv("SEED_ENABLED", "true").lower() == "true"
+
+# Report not ready as soon as the worker gets SIGTERM, and only pass the signal on to the server (which closes
+# its listening sockets and finishes the requests in progress) DRAIN_DELAY seconds later, so that load balancers
+# see the 503 of /ready and stop sending requests before connections are refused. A second SIGTERM stops at once.
+# The server's handler is wrapped from the lifespan startup, when it is installed (signals need the main thread).
+def install_drain_handler(app):
+    previous = signal.getsignal(signal.SIGTERM)
+    if threading.current_thread() is not threading.main_thread() or not callable(previous):
+        return
+
+    def on_sigterm(signum, frame):
+        if app.state.draining or DRAIN_DELAY <= 0:
+            return previous(signum, frame)
+        app.state.draining = True
+        timer = threading.Timer(DRAIN_DELAY, previous, (signum, frame))
+        timer.daemon = True
+        timer.start()
+
+    signal.signal(signal.SIGTERM, on_sigterm)
+
+# Startup and shutdown of a worker
+# On startup the schema is created or migrated, under the database write lock so that workers starting together
+# do it once (see migrations.py), then the due date scheduler starts and the read replicas are checked. On
+# SIGTERM the worker reports not ready for DRAIN_DELAY seconds before it stops accepting connections. On
+# shutdown, after the requests in progress are done, it stops the scheduler, commits the queued writes and
+# closes its connections.
+@asynccontextmanager
+async def lifespan(app):
+    app.state.draining = False
+    install_drain_handler(app)
+    await run_in_threadpool(migrate)
+    scheduler.start()
+    await router.start()
+    yield
+    app.state.draining = True
+    await scheduler.stop()
+    await write_queue.drain()
+    await router.stop()
+    await async_engine.dispose()
+
 # API Endpoints
-app = FastAPI()
+app = FastAPI(lifespan = lifespan)
+# Metrics wrap compression, so that response sizes are the bytes sent
+# Routing is innermost, its consistency token is read once the write is done
+app.add_middleware(RoutingMiddleware)
+app.add_middleware(CompressionMiddleware)
+app.add_middleware(MetricsMiddleware)
+instrument_engine(async_engine.sync_engine, watch_pool = True)
+instrument_engine(engine)
+for replica in router.replicas:
+    instrument_engine(replica.engine.sync_engine)
+
+# Sort keys used for keyset pagination, each list ends with the unique id as a tie breaker
+ID_KEYS = [(Task.id, False)]
+TITLE_KEYS = [(Task.title, False), (Task.id, False)]
+DUE_DATE_KEYS = [(Task.due_date, False), (Task.id, False)]
+UPDATED_AT_KEYS = [(Task.updated_at, True), (Task.id, True)]
+
+# Rows fetched per round trip when streaming a task listing
+STREAM_BATCH_SIZE = int(os.getenv("TASKS_STREAM_BATCH_SIZE", "1000"))
+
+# Media types of the list formats
+LIST_MEDIA_TYPES = {ListFormat.json: "application/json", ListFormat.columns: "application/json", ListFormat.msgpack: "application/msgpack"}
+LIST_ENCODERS = {ListFormat.json: encode_tasks, ListFormat.columns: encode_tasks_columns, ListFormat.msgpack: encode_tasks_msgpack}
+
+# Query parameters shared by the list endpoints
+# Streaming is enabled with ?stream=true or an Accept: application/x-ndjson header
+# Pages are sent as an array of task objects, or with ?format=columns (or msgpack, also chosen with an
+# Accept: application/msgpack header) in the compact columnar representation of serializers.py
+class PageParams:
+    def __init__(
+        self,
+        request: Request,
+        cursor: str | None = None,
+        limit: int = Query(DEFAULT_PAGE_SIZE, ge = 1, le = MAX_PAGE_SIZE),
+        stream: bool = False,
+        format: ListFormat | None = None,
+        accept: str | None = Header(default = None),
+        if_none_match: str | None = Header(default = None),
+    ):
+        self.cursor = cursor
+        self.limit = limit
+        self.stream = stream or "application/x-ndjson" in (accept or "")
+        self.format = format or (ListFormat.msgpack if "application/msgpack" in (accept or "") else ListFormat.json)
+        self.if_none_match = if_none_match
+        # Cache key of the page: the path with the query parameters in a canonical order, and the format
+        query = [(name, value) for name, value in request.query_params.multi_items() if name != "format"]
+        self.cache_query = request.url.path + "?" + urlencode(sorted(query + [("format", self.format.value)]))
 
-# Create database and different tasks
+# Yield tasks as newline delimited JSON, one batch of rows per chunk
+async def stream_tasks(statement, parameters: dict | None, fields: tuple):
+    async with AsyncSession(read_engine()) as session:
+        connection = await session.connection()
+        result = await connection.stream(statement.execution_options(yield_per = STREAM_BATCH_SIZE), parameters)
+        async for rows in result.partitions():
+            yield encode_tasks_ndjson(rows, fields)
+
+# Send the result of a paginated statement: one page with the cursor of the next page in the X-Next-Cursor header,
+# or in streaming mode every task after the cursor, without a page size limit
+# Pages depending on the current time are not cacheable: they are sent without a tag and not cached
+async def page_response(statement, keys: list, page: PageParams, fields: tuple = TASK_FIELDS, parameters: dict | None = None, cacheable: bool = True):
+    if page.stream:
+        return StreamingResponse(stream_tasks(statement, parameters, fields), media_type = "application/x-ndjson")
+    if page.format == ListFormat.msgpack and not MSGPACK_AVAILABLE:
+        raise HTTPException(status_code = 406, detail = "MessagePack needs the msgpack package")
+
+    async with AsyncSession(read_engine()) as session:
+        connection = await session.connection()
+        # Nothing changed since the tag sent by the client: answer without running the query
+        etag = ""
+        if ETAGS_ENABLED and cacheable:
+            etag = list_etag(await table_version(connection), page.cache_query)
+            if etag_matches(page.if_none_match, etag):
+                return Response(status_code=304, headers={"ETag": etag})
+
+        # Cached pages are stored as the tag, the next cursor and the body, separated by newlines
+        cached = None
+        if cacheable:
+            generation = await task_cache.generation(connection)
+            key = task_cache.list_key(generation, page.cache_query)
+            cached = await task_cache.get(key)
+        if cached is not None:
+            etag, next_cursor, content = cached.split(b"\n", 2)
+            etag, next_cursor = etag.decode(), next_cursor.decode()
+        else:
+            rows = (await connection.execute(statement, parameters)).all()
+            rows, next_cursor = next_page(rows, keys, page.limit)
+            content = LIST_ENCODERS[page.format](rows, fields)
+            if cacheable:
+                await task_cache.set(key, b"\n".join([etag.encode(), (next_cursor or "").encode(), content]), generation)
+    headers = {"X-Next-Cursor": next_cursor} if next_cursor else {}
+    if etag:
+        headers["ETag"] = etag
+    headers["Vary"] = "Accept"
+    return Response(status_code=200, content=content, media_type=LIST_MEDIA_TYPES[page.format], headers=headers)
+
+# Paginate a statement with keys and send the page
+async def list_tasks_response(statement, keys: list, page: PageParams, cacheable: bool = True):
+    try:
+        statement = paginate(statement, keys, page.cursor, None if page.stream else page.limit)
+    except InvalidCursor as e:
+        raise HTTPException(status_code = 400, detail = str(e))
+    return await page_response(statement, keys, page, cacheable = cacheable)
+
+# Create database and different tasks, or ?tasks=N synthetic tasks
+# The database file is replaced, so this is disabled in production (other workers have it open)
 @app.post("/seed")
-async def seeder():
-    main()
+async def seeder(tasks: int = Query(0, ge = 0, le = 10_000_000), seed: int = 0):
+    if not SEED_ENABLED:
+        raise HTTPException(status_code = 403, detail = "Seeding is disabled")
+    await async_engine.dispose()
+    await run_in_threadpool(main, tasks, seed)
+    await task_cache.clear()
     return JSONResponse(status_code=201, content="Database seeded")
 
 # Get all endpoints
 @app.get("/")
-def root():
-    return{"endpoints": ["/health", "/tasks", "/seed"]}
+async def root():
+    return{"endpoints": ["/health", "/ready", "/tasks", "/seed"]}
 
 # Get health status
 @app.get("/health")
-def health():
+async def health():
     return{"status": "OK"}
 
+# Get readiness: the database answers and its schema is up to date, and the worker is not shutting down
+# Load balancers and orchestrators stop sending requests to a worker answering 503
+@app.get("/ready")
+async def ready():
+    if getattr(app.state, "draining", False):
+        return JSONResponse(status_code=503, content={"status": "draining"})
+    try:
+        async with async_engine.connect() as connection:
+            await connection.execute(text("SELECT 1"))
+            version = await connection.run_sync(schema_version) if is_sqlite else SCHEMA_VERSION
+    except Exception as e:
+        return JSONResponse(status_code=503, content={"status": "database unavailable"})
+    if version < SCHEMA_VERSION:
+        return JSONResponse(status_code=503, content={"status": "migrating", "schema_version": version})
+    if router.replicas:
+        return {"status": "ready", "schema_version": version, "replicas": router.status()}
+    return {"status": "ready", "schema_version": version}
+
+# Get request, query and serialization metrics in the Prometheus text format
+@app.get("/metrics")
+async def metrics():
+    return Response(status_code=200, content=render_metrics(), media_type="text/plain; version=0.0.4")
+
+# Get hit and miss counts of the response cache
+@app.get("/cache/stats")
+async def cache_stats():
+    return task_cache.stats()
+
 # Create a task
 @app.post("/tasks")
 async def create_task(task: TaskCreate):
     try:
         task_data = Task(**task.model_dump())
-        with Session(engine) as session:
+
+        async def write(session):
             session.add(task_data)
-            session.commit()
-            session.refresh(task_data)
-            response = TaskResponse.model_validate(task_data, from_attributes=True).model_dump(mode="json")
-            return JSONResponse(status_code=201, content=response)
+            await session.flush()
+            return TaskResponse.model_validate(task_data, from_attributes=True).model_dump(mode="json")
+
+        response = await write_queue.submit(write)
+        await task_cache.invalidate()
+        scheduler.notify(task_data.id, task_data.due_date)
+        return JSONResponse(status_code=201, content=response)
     except ValidationError as e:
         raise HTTPException(status_code = 422, detail = str(e))
     except Exception as e:
         raise HTTPException(status_code = 400, detail = "An error occured, try again")
 
-# Get all tasks
+# Largest number of items accepted by one bulk request, and ids per IN (...) statement
+MAX_BULK_SIZE = int(os.getenv("TASKS_MAX_BULK_SIZE", "10000"))
+BULK_CHUNK_SIZE = 500
+
+# Validate each item of a bulk request on its own, invalid items are reported instead of failing the request
+def validate_bulk_items(model, items: list) -> tuple[dict, list]:
+    if len(items) > MAX_BULK_SIZE:
+        raise HTTPException(status_code = 413, detail = f"At most {MAX_BULK_SIZE} items per request")
+    valid, results = {}, [None] * len(items)
+    for index, item in enumerate(items):
+        try:
+            valid[index] = model.model_validate(item)
+        except ValidationError as e:
+            results[index] = {"index": index, "status": 422, "errors": e.errors(include_url = False, include_context = False, include_input = False)}
+    return valid, results
+
+# Create tasks in bulk, with a single executemany insert in one transaction
+@app.post("/tasks/bulk")
+async def create_tasks_in_bulk(items: list[dict] = Body(...)):
+    try:
+        valid, results = validate_bulk_items(TaskCreate, items)
+        indexes = list(valid)
+        # Fields sent as null (status and priority included) take the column defaults, like POST /tasks
+        rows = [Task(**valid[index].model_dump(exclude_none = True)).model_dump(exclude = {"id"}) for index in indexes]
+
+        async def write(session):
+            if not rows:
+                return []
+            connection = await session.connection()
+            statement = insert(Task.__table__).returning(*TASK_COLUMNS, sort_by_parameter_order = True)
+            return (await connection.execute(statement, rows)).all()
+
+        created = await write_queue.submit(write)
+        await task_cache.invalidate()
+        for index, row in zip(indexes, created):
+            scheduler.notify(row.id, row.due_date)
+            results[index] = {"index": index, "status": 201, "task": row_to_dict(row)}
+        return Response(status_code=200, content=encode(results), media_type="application/json")
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code = 400, detail = "An error occured, try again")
+
+# Update tasks in bulk, items setting the same fields share one executemany update
+@app.patch("/tasks/bulk")
+async def update_tasks_in_bulk(items: list[dict] = Body(...)):
+    try:
+        valid, results = validate_bulk_items(TaskBulkUpdate, items)
+        updated_at = datetime.now(timezone.utc)
+        groups = {}
+        for index, item in valid.items():
+            values = item.model_dump(include = item.model_fields_set - {"id"})
+            groups.setdefault(tuple(sorted(values)), []).append((index, item.id, values))
+
+        async def write(session):
+            connection = await session.connection()
+            ids = [item.id for item in valid.values()]
+            existing = set()
+            for start in range(0, len(ids), BULK_CHUNK_SIZE):
+                chunk = ids[start:start + BULK_CHUNK_SIZE]
+                existing.update((await connection.execute(select(Task.id).where(Task.id.in_(chunk)))).scalars())
+            table = Task.__table__
+            for fields, group in groups.items():
+                params = [{"_id": task_id, "updated_at": updated_at, **values} for _, task_id, values in group if task_id in existing]
+                if params:
+                    statement = update(table).where(table.c.id == bindparam("_id")).values(
+                        {field: bindparam(field) for field in (*fields, "updated_at")})
+                    await connection.execute(statement, params)
+            return existing
+
+        existing = await write_queue.submit(write)
+        await task_cache.invalidate()
+        for fields, group in groups.items():
+            for index, task_id, values in group:
+                if task_id in existing and "due_date" in values:
+                    scheduler.notify(task_id, values["due_date"])
+                results[index] = {"index": index, "status": 200 if task_id in existing else 404, "id": task_id}
+        if any(values.get("status") in OPEN_STATUSES for group in groups.values() for _, _, values in group):
+            scheduler.wake()
+        return Response(status_code=200, content=encode(results), media_type="application/json")
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code = 400, detail = "An error occured, try again")
+
+# Delete tasks in bulk from a list of ids, in one transaction
+@app.delete("/tasks/bulk")
+async def delete_tasks_in_bulk(ids: list[int] = Body(...)):
+    try:
+        if len(ids) > MAX_BULK_SIZE:
+            raise HTTPException(status_code = 413, detail = f"At most {MAX_BULK_SIZE} items per request")
+
+        async def write(session):
+            connection = await session.connection()
+            deleted = set()
+            for start in range(0, len(ids), BULK_CHUNK_SIZE):
+                chunk = ids[start:start + BULK_CHUNK_SIZE]
+                statement = delete(Task.__table__).where(Task.__table__.c.id.in_(chunk)).returning(Task.__table__.c.id)
+                deleted.update((await connection.execute(statement)).scalars())
+            return deleted
+
+        deleted = await write_queue.submit(write)
+        await task_cache.invalidate()
+        results = [{"index": index, "status": 200 if task_id in deleted else 404, "id": task_id} for index, task_id in enumerate(ids)]
+        return JSONResponse(status_code=200, content=results)
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code = 400, detail = "An error occured, try again")
+
+# Get all tasks, with optional filters, sort and field projection that can be combined
+# e.g. /tasks?status=pending&status=in_progress&priority=high&sort=-updated_at,title&fields=id,title
 @app.get("/tasks")
-def get_tasks():
+async def get_tasks(
+    page: PageParams = Depends(),
+    status: list[TaskStatus] = Query(default = []),
+    priority: list[TaskPriority] = Query(default = []),
+    assigned_to: str | None = None,
+    due_after: datetime | None = None,
+    due_before: datetime | None = None,
+    created_after: datetime | None = None,
+    created_before: datetime | None = None,
+    sort: str = "id",
+    fields: str | None = None,
+):
     try:
-        with Session(engine) as session:
-            statement = select(Task).offset(0)
-            tasks = session.exec(statement).all()
-            response = [TaskResponse.model_validate(task, from_attributes=True).model_dump(mode="json") for task in tasks]
-            return JSONResponse(status_code=200, content=response)
+        try:
+            sort_spec = parse_sort(sort)
+            field_list = parse_fields(fields)
+        except ValueError as e:
+            raise HTTPException(status_code = 422, detail = str(e))
+        keys = sort_keys(sort_spec)
+        try:
+            cursor_values = decode_cursor(page.cursor, keys) if page.cursor else None
+        except InvalidCursor as e:
+            raise HTTPException(status_code = 400, detail = str(e))
+
+        # Dates without a timezone are taken as UTC, like the stored dates
+        filters = {
+            "status": status,
+            "priority": priority,
+            "assigned_to": assigned_to,
+            "due_after": due_after,
+            "due_before": due_before,
+            "created_after": created_after,
+            "created_before": created_before,
+        }
+        for name, value in filters.items():
+            if isinstance(value, datetime) and value.tzinfo is None:
+                filters[name] = value.replace(tzinfo = timezone.utc)
+
+        statement, parameters, keys = task_query(filters, sort_spec, field_list, cursor_values, None if page.stream else page.limit)
+        return await page_response(statement, keys, page, field_list, parameters)
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code = 400, detail = "An error occured, try again")
+
+# Get task counts by status, priority and assignee (the ones with the most tasks), and the number of overdue tasks
+@app.get("/tasks/stats")
+async def get_task_stats(assignees: int = Query(100, ge = 0, le = MAX_PAGE_SIZE)):
+    try:
+        async with read_engine().connect() as connection:
+            stats = await read_stats(connection, assignees)
+        return Response(status_code=200, content=encode(stats), media_type="application/json")
+    except Exception as e:
+        raise HTTPException(status_code = 400, detail = "An error occured, try again")
+
+# Open tasks (pending or in progress) past their due date, the most overdue first
+# Read as a range of the open tasks due date index, so the time does not depend on the number of other tasks
+@app.get("/tasks/overdue")
+async def get_overdue_tasks(page: PageParams = Depends()):
+    try:
+        statement = select_task_columns().where(OPEN_TASKS, Task.due_date < datetime.now(timezone.utc))
+        return await list_tasks_response(statement, DUE_DATE_KEYS, page, cacheable = False)
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code = 400, detail = "An error occured, try again")
 
+# Open tasks due within a duration (by default 24 hours, e.g. ?within=PT2H or ?within=3600), the soonest first
+@app.get("/tasks/due-soon")
+async def get_tasks_due_soon(within: timedelta = timedelta(hours = 24), page: PageParams = Depends()):
+    try:
+        if within <= timedelta(0):
+            raise HTTPException(status_code = 400, detail = "within must be a positive duration")
+        now = datetime.now(timezone.utc)
+        statement = select_task_columns().where(OPEN_TASKS, Task.due_date >= now, Task.due_date <= now + within)
+        return await list_tasks_response(statement, DUE_DATE_KEYS, page, cacheable = False)
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code = 400, detail = "An error occured, try again")
+
+# Get the changes after a seq (tasks created or updated with their current state, deleted tasks as tombstones)
+# Pass next_since of the response as since to get the following changes
+@app.get("/tasks/changes")
+async def get_task_changes(since: int = Query(0, ge = 0), limit: int = Query(DEFAULT_PAGE_SIZE, ge = 1, le = MAX_PAGE_SIZE)):
+    try:
+        return Response(status_code=200, content=encode(await changes_page(read_engine(), since, limit)), media_type="application/json")
+    except Exception as e:
+        raise HTTPException(status_code = 400, detail = "An error occured, try again")
+
+# Stream the changes after a seq as server-sent events, resuming after the Last-Event-ID header on reconnection
+@app.get("/tasks/changes/stream")
+async def stream_task_changes(
+    request: Request,
+    since: int = Query(0, ge = 0),
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge = 1, le = MAX_PAGE_SIZE),
+    timeout: float = Query(CHANGES_STREAM_TIMEOUT, ge = 0, le = 3600),
+    last_event_id: int | None = Header(default = None),
+):
+    since = last_event_id if last_event_id is not None else since
+    events = stream_changes(read_engine(), since, limit, timeout, request.is_disconnected)
+    return StreamingResponse(events, media_type = "text/event-stream", headers = {"Cache-Control": "no-cache"})
+
+# Media types of the import and export formats
+FORMAT_MEDIA_TYPES = {"csv": "text/csv", "ndjson": "application/x-ndjson", "parquet": "application/vnd.apache.parquet"}
+
+# Import tasks from a CSV, NDJSON or Parquet body (the format is taken from the Content-Type header by default)
+# The body is spooled to disk and loaded in chunks in a single transaction: either every task is imported or none
+@app.post("/tasks/import")
+async def import_tasks_from_file(request: Request, format: str | None = None):
+    try:
+        media_types = {media_type: name for name, media_type in FORMAT_MEDIA_TYPES.items()}
+        format = format or media_types.get(request.headers.get("content-type", "").split(";")[0].strip())
+        if format not in FORMATS:
+            raise HTTPException(status_code = 415, detail = f"Send a format parameter or a Content-Type among {', '.join(FORMAT_MEDIA_TYPES.values())}")
+        if format == "parquet" and not PARQUET_AVAILABLE:
+            raise HTTPException(status_code = 415, detail = "Parquet needs the pyarrow package")
+
+        with SpooledTemporaryFile(max_size = 16 * 1024 * 1024) as file:
+            async for chunk in request.stream():
+                file.write(chunk)
+            file.seek(0)
+            start = time.perf_counter()
+            count = await run_in_threadpool(import_tasks, file, format)
+            elapsed = time.perf_counter() - start
+        await task_cache.clear()
+        scheduler.wake()
+        return JSONResponse(status_code=201, content={"imported": count, "seconds": round(elapsed, 3), "rows_per_s": round(count / elapsed) if elapsed else count})
+    except HTTPException:
+        raise
+    except TransferConflict as e:
+        raise HTTPException(status_code = 409, detail = {"row": e.row, "reason": e.reason})
+    except TransferError as e:
+        raise HTTPException(status_code = 422, detail = str(e) if e.row is None else {"row": e.row, "reason": e.reason})
+    except IntegrityError as e:
+        raise HTTPException(status_code = 409, detail = {"row": None, "reason": "A task id already exists"})
+    except Exception as e:
+        raise HTTPException(status_code = 400, detail = "An error occured, try again")
+
+# Stream every task as CSV or NDJSON (or send a Parquet file)
+@app.get("/tasks/export")
+async def export_tasks_to_file(format: str = "ndjson"):
+    if format not in FORMATS:
+        raise HTTPException(status_code = 422, detail = f"Unknown format '{format}', expected one of {', '.join(FORMATS)}")
+    headers = {"Content-Disposition": f'attachment; filename="tasks.{format}"'}
+    if format == "parquet":
+        if not PARQUET_AVAILABLE:
+            raise HTTPException(status_code = 406, detail = "Parquet needs the pyarrow package")
+        # The file is closed (and removed when spooled to disk) once it was sent
+        file = SpooledTemporaryFile(max_size = 16 * 1024 * 1024)
+        try:
+            await run_in_threadpool(export_tasks, file, format)
+            file.seek(0)
+        except Exception as e:
+            file.close()
+            raise HTTPException(status_code = 400, detail = "An error occured, try again")
+        return StreamingResponse(file, media_type = FORMAT_MEDIA_TYPES[format], headers = headers, background = BackgroundTask(file.close))
+
+    async def chunks():
+        yield export_header(format)
+        async with AsyncSession(read_engine()) as session:
+            connection = await session.connection()
+            result = await connection.stream(select_task_columns().order_by(Task.id).execution_options(yield_per = STREAM_BATCH_SIZE))
+            async for rows in result.partitions():
+                yield encode_chunk(rows, format)
+    return StreamingResponse(chunks(), media_type = FORMAT_MEDIA_TYPES[format], headers = headers)
+
 # Get a specific task with id
 @app.get("/tasks/{task_id}")
-def get_task_with_id(task_id: int):
+async def get_task_with_id(task_id: int, if_none_match: str | None = Header(default = None)):
     try:
-        with Session(engine) as session:
-            task = session.get(Task, task_id)
+        # Cached tasks are stored as the tag and the body, separated by a newline
+        # With versions, the task is looked up by the version read with one primary key lookup, which also
+        # answers a tag sent by the client for an unchanged task, and writes to other tasks keep it cached
+        async with AsyncSession(read_engine()) as session:
+            generation = None
+            if ETAGS_ENABLED:
+                version = (await execute_rows(session, select(Task.version).where(Task.id == task_id))).scalar()
+                if version is None:
+                    raise HTTPException(status_code = 404, detail = "Task not found")
+                if if_none_match and etag_matches(if_none_match, task_etag(task_id, version)):
+                    return Response(status_code=304, headers={"ETag": task_etag(task_id, version)})
+                key = task_cache.task_key(task_id, version)
+            else:
+                generation = await task_cache.generation(await session.connection())
+                key = task_cache.task_key(task_id, generation)
+            cached = await task_cache.get(key)
+            if cached is None:
+                task = (await execute_rows(session, select_task_columns().add_columns(Task.version).where(Task.id == task_id))).first()
+        if cached is not None:
+            etag, content = cached.split(b"\n", 1)
+            etag = etag.decode()
+        else:
             if not task:
                 raise HTTPException(status_code = 404, detail = "Task not found")
-            response = TaskResponse.model_validate(task, from_attributes=True).model_dump(mode="json")
-            return JSONResponse(status_code=200, content=response)
+            etag = task_etag(task_id, task.version) if ETAGS_ENABLED else ""
+            content = encode_task(task)
+            await task_cache.set(key, etag.encode() + b"\n" + content, generation)
+        return Response(status_code=200, content=content, media_type="application/json", headers={"ETag": etag} if etag else None)
     except HTTPException:
         raise
     except Exception as e:
         raise HTTPException(status_code = 400, detail = "An error occured, try again")
 
-# Update a specific task with id
+# Update the given columns of a task with one UPDATE ... RETURNING statement, and send the updated task
+# The statement claims the task's new version, so the response carries its tag without another query,
+# and an If-Match header becomes a condition on the version: the task is only updated if it was not modified
+# since the tag was read. The task is only looked up again when nothing was updated, to tell 404 from 412.
+async def update_task_response(task_id: int, values: dict, if_match: str | None):
+    table = Task.__table__
+    statement = update(table).where(table.c.id == task_id).values(**values, updated_at = datetime.now(timezone.utc))
+    if ETAGS_ENABLED:
+        statement = statement.values(version = NEXT_VERSION)
+        versions = if_match_versions(if_match, task_id)
+        if versions is not None:
+            statement = statement.where(table.c.version.in_(versions))
+    statement = statement.returning(*TASK_COLUMNS, table.c.version)
+
+    async def write(session):
+        connection = await session.connection()
+        task = (await connection.execute(statement)).first()
+        if task is None:
+            if (await connection.execute(select(Task.id).where(Task.id == task_id))).first() is None:
+                raise HTTPException(status_code = 404, detail = "Task not found")
+            raise HTTPException(status_code = 412, detail = "Task was modified, get it again before updating")
+        return task
+
+    task = await write_queue.submit(write)
+    await task_cache.invalidate()
+    scheduler.notify(task_id, task.due_date)
+    if values.get("status") in OPEN_STATUSES:
+        scheduler.wake()
+    headers = {"ETag": task_etag(task_id, task.version)} if ETAGS_ENABLED else None
+    return Response(status_code=200, content=encode_task(task), media_type="application/json", headers=headers)
+
+# Update a specific task with id, fields sent as null are left unchanged
+# With an If-Match header the task is only updated if it was not modified since the tag was read
 @app.put("/tasks/{task_id}")
-async def update_task_with_id(task_id: int, tasknew: TaskUpdate):
+async def update_task_with_id(task_id: int, tasknew: TaskUpdate, if_match: str | None = Header(default = None)):
     try:
-        with Session(engine) as session:
-            task = session.get(Task, task_id)
-            if not task:
-                raise HTTPException(status_code = 404, detail = "Task not found")
-            if(tasknew.title):
-                task.title = tasknew.title
-            if(tasknew.description):
-                task.description = tasknew.description
-            if(tasknew.status):
-                task.status = tasknew.status
-            if(tasknew.priority):
-                task.priority = tasknew.priority
-            if(tasknew.due_date):
-                task.due_date = tasknew.due_date
-            if(tasknew.assigned_to):
-                task.assigned_to = tasknew.assigned_to
+        return await update_task_response(task_id, tasknew.model_dump(exclude_none = True), if_match)
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code = 400, detail = "An error occured, try again")
 
-            task.updated_at = datetime.now()
-            session.add(task)
-            session.commit()
-            session.refresh(task)
-            response = TaskResponse.model_validate(task, from_attributes=True).model_dump(mode="json")
-            return JSONResponse(status_code=200, content=response)
+# Partially update a specific task with id, only the fields sent are changed and null clears an optional field
+@app.patch("/tasks/{task_id}")
+async def patch_task_with_id(task_id: int, tasknew: TaskPatch, if_match: str | None = Header(default = None)):
+    try:
+        return await update_task_response(task_id, tasknew.model_dump(include = tasknew.model_fields_set), if_match)
     except HTTPException:
         raise
     except Exception as e:
         raise HTTPException(status_code = 400, detail = "An error occured, try again")
-    
-# Delete a specific task with id
+
+# Delete a specific task with id, with one DELETE ... RETURNING statement
 @app.delete("/tasks/{task_id}")
-def delete_task_with_id(task_id: int):
-    with Session(engine) as session:
-        task = session.get(Task, task_id)
-        if not task:
-            raise HTTPException(status_code = 404, detail = "Task not found")
-        session.delete(task)
-        session.commit()
-
-        task = session.get(Task, task_id)
-        if(not task):
-            return JSONResponse(status_code=200, content="Task deleted successfully")
-        else:
-            raise HTTPException(status_code = 400, detail = "Could not delete task")
+async def delete_task_with_id(task_id: int):
+    try:
+        table = Task.__table__
+        statement = delete(table).where(table.c.id == task_id).returning(table.c.id)
+
+        async def write(session):
+            connection = await session.connection()
+            if (await connection.execute(statement)).first() is None:
+                raise HTTPException(status_code = 404, detail = "Task not found")
+
+        await write_queue.submit(write)
+        await task_cache.invalidate()
+        scheduler.notify(task_id, None)
+        return JSONResponse(status_code=200, content="Task deleted successfully")
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code = 400, detail = "An error occured, try again")
 
 # Filter tasks based on status
 @app.get("/tasks/status/{status}")
-def get_tasks_with_status(status: TaskStatus):
+async def get_tasks_with_status(status: TaskStatus, page: PageParams = Depends()):
     try:
-        with Session(engine) as session:
-            statement = select(Task).where(Task.status == status)
-            tasks = session.exec(statement).all()
-            response = [TaskResponse.model_validate(task, from_attributes=True).model_dump(mode="json") for task in tasks]
-            return JSONResponse(status_code=200, content=response)
+        statement = select_task_columns().where(Task.status == status)
+        return await list_tasks_response(statement, ID_KEYS, page)
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code = 400, detail = "An error occured, try again")    
 
 # Filter tasks based on priority
 @app.get("/tasks/priority/{priority}")
-def get_tasks_with_priority(priority: TaskPriority):
+async def get_tasks_with_priority(priority: TaskPriority, page: PageParams = Depends()):
     try:
-        with Session(engine) as session:
-            statement = select(Task).where(Task.priority == priority)
-            tasks = session.exec(statement).all()
-            response = [TaskResponse.model_validate(task, from_attributes=True).model_dump(mode="json") for task in tasks]
-            return JSONResponse(status_code=200, content=response)
+        statement = select_task_columns().where(Task.priority == priority)
+        return await list_tasks_response(statement, ID_KEYS, page)
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code = 400, detail = "An error occured, try again")
 
 # Filter tasks based on both status and priority
 @app.get("/tasks/status/{status}/priority/{priority}")
-def get_tasks_with_status_and_priority(status: TaskStatus, priority: TaskPriority):
+async def get_tasks_with_status_and_priority(status: TaskStatus, priority: TaskPriority, page: PageParams = Depends()):
     try:
-        with Session(engine) as session:
-            statement = select(Task).where(Task.status == status, Task.priority == priority).limit(10) # Shows only 10 records
-            tasks = session.exec(statement).all()
-            response = [TaskResponse.model_validate(task, from_attributes=True).model_dump(mode="json") for task in tasks]
-            return JSONResponse(status_code=200, content=response)
+        statement = select_task_columns().where(Task.status == status, Task.priority == priority)
+        return await list_tasks_response(statement, ID_KEYS, page)
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code = 400, detail = "An error occured, try again")  
     
 # Sort tasks by ascending task title
 @app.get("/tasks/sortBy/title")
-def get_tasks_sorted_with_title():
+async def get_tasks_sorted_with_title(page: PageParams = Depends()):
     try:
-        with Session(engine) as session:
-            statement = select(Task).order_by(Task.title.asc())
-            tasks = session.exec(statement).all()
-            response = [TaskResponse.model_validate(task, from_attributes=True).model_dump(mode="json") for task in tasks]
-            return JSONResponse(status_code=200, content=response)
+        statement = select_task_columns()
+        return await list_tasks_response(statement, TITLE_KEYS, page)
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code = 400, detail = "An error occured, try again")
 
 # Sort tasks by ascending due date
 @app.get("/tasks/sortBy/dueDate")
-def get_tasks_sorted_with_due_date():
+async def get_tasks_sorted_with_due_date(page: PageParams = Depends()):
     try:
-        with Session(engine) as session:
-            statement = select(Task).order_by(Task.due_date.asc())
-            tasks = session.exec(statement).all()
-            response = [TaskResponse.model_validate(task, from_attributes=True).model_dump(mode="json") for task in tasks]
-            return JSONResponse(status_code=200, content=response)
+        statement = select_task_columns()
+        return await list_tasks_response(statement, DUE_DATE_KEYS, page)
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code = 400, detail = "An error occured, try again")
     
 # Sort tasks by descending due date
 @app.get("/tasks/sortBy/updatedAt")
-def get_tasks_sorted_with_updated_at():
+async def get_tasks_sorted_with_updated_at(page: PageParams = Depends()):
     try:
-        with Session(engine) as session:
-            statement = select(Task).order_by(Task.updated_at.desc())
-            tasks = session.exec(statement).all()
-            response = [TaskResponse.model_validate(task, from_attributes=True).model_dump(mode="json") for task in tasks]
-            return JSONResponse(status_code=200, content=response)
+        statement = select_task_columns()
+        return await list_tasks_response(statement, UPDATED_AT_KEYS, page)
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code = 400, detail = "An error occured, try again")
     
-# Update pending tasks to be in progess
-@app.put("/tasks/updateAll/pending")
-def update_tasks_with_pending_status():
-    try:
-        with Session(engine) as session:
-            statement = select(Task).where(Task.status == TaskStatus.pending)
-            tasks = session.exec(statement).all()
-            for task in tasks:
-                task.status = TaskStatus.in_progress
-                session.add(task)
-            session.commit()
-            for task in tasks:
-                session.refresh(task)
-            response = [TaskResponse.model_validate(task, from_attributes=True).model_dump(mode="json") for task in tasks]
-            return JSONResponse(status_code=200, content=response)
+# Run a set based UPDATE/DELETE statement in one round trip
+# Returns the number of affected tasks, plus their ids or full rows when requested
+# The ids are always returned by the statement, the count is their number
+async def bulk_transition_response(statement, returning: BulkReturning):
+    if returning == BulkReturning.rows:
+        statement = statement.returning(*TASK_COLUMNS)
+    else:
+        statement = statement.returning(Task.__table__.c.id)
+
+    async def write(session):
+        connection = await session.connection()
+        return (await connection.execute(statement)).all()
+
+    result = await write_queue.submit(write)
+    await task_cache.invalidate()
+    if returning == BulkReturning.count:
+        response = {"count": len(result)}
+    elif returning == BulkReturning.ids:
+        response = {"count": len(result), "ids": [row[0] for row in result]}
+    else:
+        response = {"count": len(result), "tasks": [row_to_dict(row) for row in result]}
+    return Response(status_code=200, content=encode(response), media_type="application/json")
+
+# Move every task with a status to another status, to is required except for pending tasks (moved to in progress)
+@app.put("/tasks/updateAll/{status}")
+async def update_tasks_with_status(status: TaskStatus, to: TaskStatus | None = None, returning: BulkReturning = BulkReturning.count):
+    try:
+        if to is None:
+            if status != TaskStatus.pending:
+                raise HTTPException(status_code = 422, detail = "to is required to move tasks that are not pending")
+            to = TaskStatus.in_progress
+        # Moving tasks to their own status would only bump their versions and fill the change feed
+        if to == status:
+            raise HTTPException(status_code = 422, detail = "to must differ from the status of the tasks")
+        table = Task.__table__
+        statement = update(table).where(table.c.status == status).values(status = to, updated_at = datetime.now(timezone.utc))
+        response = await bulk_transition_response(statement, returning)
+        if to in OPEN_STATUSES:
+            scheduler.wake()
+        return response
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code = 400, detail = "An error occured, try again")  
     
-# Delete cancelled tasks
-@app.delete("/tasks/deleteAll/cancelled")
-def delete_tasks_with_cancelled_status():
-    try:
-        with Session(engine) as session:
-            statement = select(Task).where(Task.status == TaskStatus.cancelled)
-            tasks = session.exec(statement).all()
-            for task in tasks:
-                session.delete(task)
-            session.commit()
-            return JSONResponse(status_code=200, content="Cancelled tasks deleted successfully")
+# Delete every task with a status (e.g. cancelled tasks)
+@app.delete("/tasks/deleteAll/{status}")
+async def delete_tasks_with_status(status: TaskStatus, returning: BulkReturning = BulkReturning.count):
+    try:
+        table = Task.__table__
+        statement = delete(table).where(table.c.status == status)
+        return await bulk_transition_response(statement, returning)
     except Exception as e:
         raise HTTPException(status_code = 400, detail = "An error occured, try again")  
     
-# Search in title and description
+# Search in title and description, ranked by relevance with the FTS5 search index
+# (other databases and sqlite builds without FTS5 scan the tasks with LIKE, in id order)
 @app.get("/tasks/search/{text}")
-def get_tasks_with_search_words(text: str):
+async def get_tasks_with_search_words(text: str, page: PageParams = Depends()):
     try:
-        with Session(engine) as session:
-            statement = select(Task).where(Task.title.contains(text) | Task.description.contains(text))
-            tasks = session.exec(statement).all()
-            response = [TaskResponse.model_validate(task, from_attributes=True).model_dump(mode="json") for task in tasks]
-            return JSONResponse(status_code=200, content=response)
+        if FTS5_AVAILABLE:
+            statement, keys = search_statement(text)
+        else:
+            statement, keys = like_search_statement(text), ID_KEYS
+        return await list_tasks_response(statement, keys, page)
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code = 400, detail = "An error occured, try again")
 
 # Delete old database if exists, and create database and sample data
-def main(): 
+# (or the given number of synthetic tasks, loaded in bulk)
+def main(tasks: int = 0, seed: int = 0): 
+    engine.dispose()
+    for file_name in [sqlite_file_name, f"{sqlite_file_name}-wal", f"{sqlite_file_name}-shm"]:
+        if os.path.exists(file_name):
+            os.remove(file_name)
+    migrate()
+    if tasks:
+        create_synthetic_tasks(tasks, seed)
+    else:
+        create_tasks()
+
+# Run WEB_CONCURRENCY worker processes (by default one per CPU) on the existing database
+# The schema is migrated once before the workers start, and each worker waits for its requests in progress
+# for up to GRACEFUL_TIMEOUT seconds when stopped
+def run_production():
+    os.environ.setdefault("SEED_ENABLED", "false")
+    migrate()
     engine.dispose()
-    if os.path.exists(sqlite_file_name):
-        os.remove(sqlite_file_name)
-    create_db()
-    create_tasks()
+    uvicorn.run(
+        "main:app",
+        host = os.getenv("HOST", "0.0.0.0"),
+        port = int(os.getenv("PORT", "8000")),
+        workers = WEB_CONCURRENCY,
+        timeout_graceful_shutdown = GRACEFUL_TIMEOUT,
+        proxy_headers = True,
+    )
 
 # For running the application, call main method and run fastapi
+# With --production, keep the database and run the production workers instead
 if __name__=="__main__":
-    main()
-    uvicorn.run("main:app", host="localhost", port=8000, reload=True)
\ No newline at end of file
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--production", action = "store_true")
+    if parser.parse_args().production:
+        run_production()
+    else:
+        main()
+        uvicorn.run("main:app", host="localhost", port=8000, reload=True)
\ No newline at end of file
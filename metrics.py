@@ -0,0 +1,284 @@
+import contextvars
+import io
+import logging
+import os
+import random
+import time
+from collections import Counter
+from functools import wraps
+from sqlalchemy import event
+
+# Request level performance metrics, exported in the Prometheus text format by GET /metrics
+# An ASGI middleware times every request and collects, through SQLAlchemy events, the queries it runs;
+# serialization functions report their time to the request being served. Metrics are kept per process.
+
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "true").lower() == "true"
+# A request running the same statement this many times is reported as a probable N+1 query
+N_PLUS_ONE_THRESHOLD = int(os.getenv("METRICS_N_PLUS_ONE_THRESHOLD", "10"))
+# Profiling: requests with an X-Profile header get their profile instead of their response when
+# PROFILING_ENABLED is true, and a fraction of requests (PROFILE_SAMPLE_RATE) is profiled into PROFILE_DIR
+PROFILING_ENABLED = os.getenv("PROFILING_ENABLED", "false").lower() == "true"
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0"))
+PROFILE_DIR = os.getenv("PROFILE_DIR", "profiles")
+
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 500)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+
+logger = logging.getLogger("metrics")
+
+class Metric:
+    def __init__(self, name: str, help: str, type: str):
+        self.name = name
+        self.help = help
+        self.type = type
+        self.values = {}
+
+    def header(self) -> list:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+
+def _labels(labels: dict) -> str:
+    if not labels:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for value in labels.values())
+    return "{" + ",".join(f'{name}="{value}"' for name, value in zip(labels, escaped)) + "}"
+
+class CounterMetric(Metric):
+    def __init__(self, name: str, help: str):
+        super().__init__(name, help, "counter")
+
+    def inc(self, amount: float = 1, **labels):
+        key = tuple(labels.items())
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def lines(self) -> list:
+        return [f"{self.name}{_labels(dict(key))} {value}" for key, value in self.values.items()]
+
+class GaugeMetric(Metric):
+    def __init__(self, name: str, help: str, read):
+        super().__init__(name, help, "gauge")
+        self.read = read
+
+    def lines(self) -> list:
+        value = self.read()
+        return [] if value is None else [f"{self.name} {value}"]
+
+class HistogramMetric(Metric):
+    def __init__(self, name: str, help: str, buckets: tuple):
+        super().__init__(name, help, "histogram")
+        self.buckets = buckets
+
+    def observe(self, value: float, **labels):
+        key = tuple(labels.items())
+        counts = self.values.get(key)
+        if counts is None:
+            counts = self.values[key] = [[0] * len(self.buckets), 0, 0.0]
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                counts[0][index] += 1
+                break
+        counts[1] += 1
+        counts[2] += value
+
+    def lines(self) -> list:
+        lines = []
+        for key, (buckets, count, total) in self.values.items():
+            labels, cumulative = dict(key), 0
+            for bound, bucket in zip(self.buckets, buckets):
+                cumulative += bucket
+                lines.append(f"{self.name}_bucket{_labels({**labels, 'le': bound})} {cumulative}")
+            lines.append(f"{self.name}_bucket{_labels({**labels, 'le': '+Inf'})} {count}")
+            lines.append(f"{self.name}_count{_labels(labels)} {count}")
+            lines.append(f"{self.name}_sum{_labels(labels)} {total}")
+        return lines
+
+REQUEST_SECONDS = HistogramMetric("http_request_duration_seconds", "Time to serve a request", LATENCY_BUCKETS)
+RESPONSE_BYTES = HistogramMetric("http_response_size_bytes", "Size of the response body", SIZE_BUCKETS)
+REQUEST_BYTES = HistogramMetric("http_request_size_bytes", "Size of the request body", SIZE_BUCKETS)
+REQUEST_QUERIES = HistogramMetric("db_queries_per_request", "SQL statements run by a request", COUNT_BUCKETS)
+REQUEST_QUERY_SECONDS = HistogramMetric("db_query_duration_seconds_per_request", "Time spent in SQL statements by a request", LATENCY_BUCKETS)
+SERIALIZATION_SECONDS = HistogramMetric("serialization_duration_seconds_per_request", "Time spent encoding responses by a request", LATENCY_BUCKETS)
+QUERIES = CounterMetric("db_queries_total", "SQL statements run by requests, or in the background (e.g. queued writes)")
+QUERY_SECONDS = CounterMetric("db_query_duration_seconds_total", "Time spent in SQL statements")
+N_PLUS_ONE = CounterMetric("db_n_plus_one_total", "Requests running the same statement at least METRICS_N_PLUS_ONE_THRESHOLD times")
+POOL_OVERFLOWS = CounterMetric("db_pool_overflow_checkouts_total", "Connection checkouts beyond the pool size (the pool was exhausted)")
+OVERDUE_FLAGGED = CounterMetric("tasks_overdue_flagged_total", "Tasks flagged overdue by the due date scheduler")
+METRICS = [REQUEST_SECONDS, RESPONSE_BYTES, REQUEST_BYTES, REQUEST_QUERIES, REQUEST_QUERY_SECONDS,
+           SERIALIZATION_SECONDS, QUERIES, QUERY_SECONDS, N_PLUS_ONE, POOL_OVERFLOWS, OVERDUE_FLAGGED]
+
+# Statistics of the request being served, None outside requests (e.g. in the write queue worker)
+class RequestStats:
+    def __init__(self):
+        self.queries = 0
+        self.query_seconds = 0.0
+        self.serialization_seconds = 0.0
+        self.statements = Counter()
+
+current_request = contextvars.ContextVar("current_request", default = None)
+
+# Add the time of an encoding function to the request being served
+def timed_serialization(function):
+    @wraps(function)
+    def wrapper(*args, **kwargs):
+        stats = current_request.get()
+        if stats is None:
+            return function(*args, **kwargs)
+        start = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            stats.serialization_seconds += time.perf_counter() - start
+    return wrapper
+
+# Time every statement run on an engine, and export the state of its connection pool if watch_pool
+def instrument_engine(sync_engine, watch_pool: bool = False):
+    @event.listens_for(sync_engine, "before_cursor_execute")
+    def before_cursor_execute(connection, cursor, statement, parameters, context, executemany):
+        connection.info.setdefault("query_start", []).append(time.perf_counter())
+
+    @event.listens_for(sync_engine, "after_cursor_execute")
+    def after_cursor_execute(connection, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - connection.info["query_start"].pop()
+        stats = current_request.get()
+        source = "background" if stats is None else "request"
+        QUERIES.inc(source = source)
+        QUERY_SECONDS.inc(elapsed, source = source)
+        if stats is not None:
+            stats.queries += 1
+            stats.query_seconds += elapsed
+            stats.statements[statement] += 1
+
+    # A failed statement never reaches after_cursor_execute, drop its start time so later ones are timed right
+    @event.listens_for(sync_engine, "handle_error")
+    def handle_error(context):
+        if context.connection is not None:
+            starts = context.connection.info.get("query_start")
+            if starts:
+                starts.pop()
+
+    # The pool is replaced when the engine is disposed, so it is looked up on every read
+    if watch_pool and hasattr(sync_engine.pool, "checkedout"):
+        @event.listens_for(sync_engine, "checkout")
+        def checkout(dbapi_connection, connection_record, connection_proxy):
+            pool = sync_engine.pool
+            if pool.size() and pool.checkedout() > pool.size():
+                POOL_OVERFLOWS.inc()
+
+        def saturation():
+            pool = sync_engine.pool
+            return pool.checkedout() / pool.size() if pool.size() else None
+
+        METRICS.extend([
+            GaugeMetric("db_pool_size", "Connections kept in the pool", lambda: sync_engine.pool.size()),
+            GaugeMetric("db_pool_checked_out", "Connections in use", lambda: sync_engine.pool.checkedout()),
+            GaugeMetric("db_pool_overflow", "Connections opened beyond the pool size", lambda: sync_engine.pool.overflow()),
+            GaugeMetric("db_pool_saturation", "Connections in use over the pool size", saturation),
+        ])
+
+# Prometheus text exposition of every metric
+def render() -> bytes:
+    lines = []
+    for metric in METRICS:
+        values = metric.lines()
+        if values:
+            lines += metric.header() + values
+    return ("\n".join(lines) + "\n").encode()
+
+# Profile a request with pyinstrument when installed, cProfile otherwise, returns (start, stop -> text)
+def start_profiler():
+    try:
+        from pyinstrument import Profiler
+        profiler = Profiler(async_mode = "enabled")
+        profiler.start()
+        return lambda: (profiler.stop(), profiler.output_text(unicode = True))[1]
+    except ImportError:
+        import cProfile
+        import pstats
+        profiler = cProfile.Profile()
+        profiler.enable()
+        def stop():
+            profiler.disable()
+            output = io.StringIO()
+            pstats.Stats(profiler, stream = output).sort_stats("cumulative").print_stats(50)
+            return output.getvalue()
+        return stop
+
+# ASGI middleware recording the metrics of every HTTP request
+class MetricsMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not METRICS_ENABLED:
+            return await self.app(scope, receive, send)
+
+        headers = dict(scope["headers"])
+        profile = PROFILING_ENABLED and b"x-profile" in headers
+        sampled = not profile and PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE
+        stop_profiler = start_profiler() if profile or sampled else None
+
+        stats = RequestStats()
+        token = current_request.set(stats)
+        status, response_bytes, request_bytes = 500, 0, 0
+        profiled_start = None
+
+        async def receive_wrapper():
+            nonlocal request_bytes
+            message = await receive()
+            request_bytes += len(message.get("body", b""))
+            return message
+
+        async def send_wrapper(message):
+            nonlocal status, response_bytes, profiled_start
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                # The profile replaces the response, sent once the request is done
+                if profile:
+                    profiled_start = message
+                    return
+            elif message["type"] == "http.response.body":
+                response_bytes += len(message.get("body", b""))
+                if profile:
+                    return
+            await send(message)
+
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive_wrapper, send_wrapper)
+        finally:
+            elapsed = time.perf_counter() - start
+            current_request.reset(token)
+            route = getattr(scope.get("route"), "path", "unmatched")
+            self.record(scope["method"], route, status, elapsed, stats, request_bytes, response_bytes)
+            if stop_profiler:
+                text = stop_profiler()
+                if sampled:
+                    self.save_profile(scope["method"], route, text)
+
+        if profile and profiled_start is not None:
+            body = (f"{scope['method']} {scope['path']} -> {status} in {elapsed * 1000:.1f} ms, "
+                    f"{stats.queries} queries ({stats.query_seconds * 1000:.1f} ms), "
+                    f"serialization {stats.serialization_seconds * 1000:.1f} ms\n\n{text}").encode()
+            await send({"type": "http.response.start", "status": 200, "headers": [
+                (b"content-type", b"text/plain; charset=utf-8"), (b"content-length", str(len(body)).encode()), (b"x-profile", b"true")]})
+            await send({"type": "http.response.body", "body": body})
+
+    def record(self, method: str, route: str, status: int, elapsed: float, stats: RequestStats, request_bytes: int, response_bytes: int):
+        labels = {"method": method, "route": route}
+        REQUEST_SECONDS.observe(elapsed, **labels, status = status)
+        REQUEST_BYTES.observe(request_bytes, **labels)
+        RESPONSE_BYTES.observe(response_bytes, **labels)
+        REQUEST_QUERIES.observe(stats.queries, **labels)
+        REQUEST_QUERY_SECONDS.observe(stats.query_seconds, **labels)
+        SERIALIZATION_SECONDS.observe(stats.serialization_seconds, **labels)
+        repeated = [statement for statement, count in stats.statements.items() if count >= N_PLUS_ONE_THRESHOLD]
+        if repeated:
+            N_PLUS_ONE.inc(**labels)
+            logger.warning("%s %s ran the same statement %d times (N+1 query?): %s",
+                           method, route, stats.statements[repeated[0]], repeated[0][:200])
+
+    def save_profile(self, method: str, route: str, text: str):
+        os.makedirs(PROFILE_DIR, exist_ok = True)
+        name = f"{time.strftime('%Y%m%d-%H%M%S')}-{method}-{route.strip('/').replace('/', '_') or 'root'}-{random.randrange(10**6)}.txt"
+        with open(os.path.join(PROFILE_DIR, name), "w") as file:
+            file.write(text)
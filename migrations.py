@@ -0,0 +1,94 @@
+from sqlalchemy import DDL, inspect, text
+from sqlalchemy.schema import CreateIndex
+from sqlmodel import SQLModel
+from models import Task, TASK_SEARCH_DDL, TASK_VERSION_DDL, TASK_STATS_DDL, TASK_SCHEDULER_DDL, TASK_TRIGGER_NAMES
+from database import engine, is_sqlite
+
+# Schema lifecycle
+# The schema version is kept in sqlite's user_version pragma. Pending migrations run in one BEGIN IMMEDIATE
+# transaction, which holds the database write lock: when several workers start together, one migrates and the
+# others wait, then find the schema up to date. Databases are never deleted on startup.
+# Other databases only get their missing tables created (use a migration tool such as Alembic there).
+
+# Create the missing indexes of the task table
+# With IF NOT EXISTS, since expression indexes are not reflected and checkfirst would not see them
+def create_task_indexes(connection):
+    for index in Task.__table__.indexes:
+        connection.execute(CreateIndex(index, if_not_exists = True))
+
+# Migration 1: the schema of models.py
+# Databases created before migrations existed (user_version 0 with a task table) are upgraded in place:
+# missing columns, tables, indexes, search index, versions and change feed are added for the existing tasks
+def create_schema(connection):
+    if not inspect(connection).has_table("task"):
+        SQLModel.metadata.create_all(connection)
+        return
+
+    columns = [column["name"] for column in inspect(connection).get_columns("task")]
+    if "version" not in columns:
+        connection.execute(text("ALTER TABLE task ADD COLUMN version INTEGER NOT NULL DEFAULT 0"))
+    SQLModel.metadata.create_all(connection)
+    create_task_indexes(connection)
+    # Search index (rebuilt from the tasks), then the version and change feed tables,
+    # with the triggers of this version (replacing older ones, and created once the versions are set)
+    for name in TASK_TRIGGER_NAMES:
+        connection.execute(text(f"DROP TRIGGER IF EXISTS {name}"))
+    connection.execute(text("UPDATE task SET version = id WHERE version = 0"))
+    for statement in TASK_SEARCH_DDL + TASK_VERSION_DDL:
+        connection.execute(DDL(statement))
+    connection.execute(text("UPDATE task_version SET value = max(value, (SELECT coalesce(max(version), 0) FROM task)) WHERE id = 1"))
+    connection.execute(text("""INSERT OR IGNORE INTO task_change (task_id, seq, op, changed_at)
+        SELECT id, version, 'insert', strftime('%Y-%m-%d %H:%M:%f', 'now') FROM task"""))
+
+# Migration 2: task counters for the statistics, counted from the existing tasks, and the overdue index
+def create_task_stats(connection):
+    for statement in TASK_STATS_DDL:
+        connection.execute(DDL(statement))
+    create_task_indexes(connection)
+
+# Migration 3: the trigger completing the versions claimed by single task updates
+def create_version_claim_trigger(connection):
+    for statement in TASK_VERSION_DDL:
+        connection.execute(DDL(statement))
+
+# Migration 4: the open tasks due date index (replacing the status and due date one) and the scheduler position,
+# tasks already overdue are not flagged
+def create_due_date_scheduler(connection):
+    connection.execute(text("DROP INDEX IF EXISTS ix_task_status_due_date_id"))
+    create_task_indexes(connection)
+    for statement in TASK_SCHEDULER_DDL:
+        connection.execute(DDL(statement))
+
+# Migration 5: the status and priority rank indexes, sorting them in the order of their enum
+def create_rank_indexes(connection):
+    create_task_indexes(connection)
+
+# Migration 6: the backlog of the due date scheduler, tasks reopened or imported behind its position
+def create_scheduler_backlog(connection):
+    for statement in TASK_SCHEDULER_DDL:
+        connection.execute(DDL(statement))
+
+# Migrations in order, the schema version is the number of applied migrations
+MIGRATIONS = [create_schema, create_task_stats, create_version_claim_trigger, create_due_date_scheduler, create_rank_indexes, create_scheduler_backlog]
+SCHEMA_VERSION = len(MIGRATIONS)
+
+def schema_version(connection) -> int:
+    return connection.execute(text("PRAGMA user_version")).scalar()
+
+# Bring the database schema up to date, returns the number of migrations applied
+def migrate(bind = engine) -> int:
+    if not is_sqlite:
+        SQLModel.metadata.create_all(bind)
+        return 0
+
+    with bind.connect() as connection:
+        # Nothing to do in the common case, checked without taking the write lock
+        if schema_version(connection) >= SCHEMA_VERSION:
+            return 0
+        connection.rollback()
+        with connection.execution_options(begin = "IMMEDIATE").begin():
+            version = schema_version(connection)
+            for migration in MIGRATIONS[version:]:
+                migration(connection)
+            connection.execute(text(f"PRAGMA user_version = {SCHEMA_VERSION}"))
+        return max(SCHEMA_VERSION - version, 0)
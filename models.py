@@ -1,7 +1,10 @@
+import re
 from enum import Enum
 from sqlmodel import Field, SQLModel
+from sqlalchemy import DDL, Index, Integer, case, event, literal_column, text
 from datetime import datetime, timezone
-from pydantic import BaseModel, field_validator, ConfigDict
+from pydantic import BaseModel, field_validator, model_validator, ConfigDict
+from database import FTS5_AVAILABLE
 
 # Create status enum: pending, in_progress, completed, cancelled
 class TaskStatus(Enum):
@@ -17,8 +20,28 @@ class TaskPriority(Enum):
     high = "high"
     urgent = "urgent"
 
+# Create bulk returning enum: count, ids, rows (what set based updates and deletes send back)
+class BulkReturning(Enum):
+    count = "count"
+    ids = "ids"
+    rows = "rows"
+
+# Create list format enum: json, columns, msgpack (representations of task lists)
+class ListFormat(Enum):
+    json = "json"
+    columns = "columns"
+    msgpack = "msgpack"
+
+# Create change operation enum: insert, update, delete, overdue (a task passed its due date, see scheduler.py)
+class ChangeOp(Enum):
+    insert = "insert"
+    update = "update"
+    delete = "delete"
+    overdue = "overdue"
+
 # Create table with SQLModel
 # Optional fields: description, updated_at, due_date, assigned_to
+# version is set by the database on every write (see TASK_VERSION_DDL)
 class Task(SQLModel, table = True):
     id: int | None = Field(default = None, primary_key = True)
     title: str = Field(max_length = 200, index = True)
@@ -29,6 +52,150 @@ class Task(SQLModel, table = True):
     updated_at: datetime | None = None
     due_date: datetime | None = None
     assigned_to: str | None = Field(default = None, max_length = 100)
+    version: int = Field(default = 0)
+
+# Change feed: the last change of every task (deleted tasks are kept as tombstones), ordered by seq
+# seq is the value of the change counter of the write (see TASK_VERSION_DDL), so it only grows and the rows
+# changed since a previous sync are the ones with a greater seq, read from the seq index
+class TaskChange(SQLModel, table = True):
+    __tablename__ = "task_change"
+    task_id: int = Field(primary_key = True)
+    seq: int = Field(unique = True, index = True)
+    op: ChangeOp
+    changed_at: datetime
+
+# Composite indexes matching the filters and sorts of the list endpoints,
+# each one ends with id, the tie breaker of keyset pagination
+Index("ix_task_status_priority_id", Task.status, Task.priority, Task.id)
+Index("ix_task_status_id", Task.status, Task.id)
+Index("ix_task_priority_id", Task.priority, Task.id)
+Index("ix_task_due_date_id", Task.due_date, Task.id)
+Index("ix_task_updated_at_id", Task.updated_at.desc(), Task.id.desc())
+Index("ix_task_assigned_to_id", Task.assigned_to, Task.id)
+Index("ix_task_created_at_id", Task.created_at, Task.id)
+# Open tasks (the ones that can be overdue) by due date, for overdue and due soon counts and listings
+# A partial index is only used by queries repeating its condition, so queries use OPEN_TASKS too. The status
+# is compared as an expression (status || ''), which keeps the status indexes from being chosen instead.
+OPEN_TASKS = text("status || '' IN ('pending', 'in_progress')")
+OPEN_STATUSES = {TaskStatus.pending, TaskStatus.in_progress}
+Index("ix_task_open_due_date_id", Task.due_date, Task.id, sqlite_where = OPEN_TASKS, postgresql_where = OPEN_TASKS)
+
+# Rank of a status or priority in the order of its enum (low < medium < high < urgent), to sort by it instead of
+# alphabetically. Written with literals, so that the queries sorting by a rank match the expression of its index.
+def enum_rank(column, enum: type[Enum]):
+    return case({literal_column(f"'{member.name}'"): literal_column(str(rank), Integer) for rank, member in enumerate(enum)}, value = column)
+
+STATUS_RANK = enum_rank(Task.status, TaskStatus)
+PRIORITY_RANK = enum_rank(Task.priority, TaskPriority)
+Index("ix_task_status_rank_id", STATUS_RANK, Task.id)
+Index("ix_task_priority_rank_id", PRIORITY_RANK, Task.id)
+
+# Full-text search index over title and description (sqlite FTS5)
+# The index reads its content from the task table and is kept in sync by triggers on every write
+TASK_FTS_DDL = [
+    """CREATE VIRTUAL TABLE IF NOT EXISTS task_fts USING fts5(
+        title, description, content='task', content_rowid='id',
+        tokenize='unicode61 remove_diacritics 2', prefix='2 3')""",
+    """CREATE TRIGGER IF NOT EXISTS task_fts_insert AFTER INSERT ON task BEGIN
+        INSERT INTO task_fts(rowid, title, description) VALUES (new.id, new.title, new.description);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS task_fts_delete AFTER DELETE ON task BEGIN
+        INSERT INTO task_fts(task_fts, rowid, title, description) VALUES ('delete', old.id, old.title, old.description);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS task_fts_update AFTER UPDATE OF title, description ON task BEGIN
+        INSERT INTO task_fts(task_fts, rowid, title, description) VALUES ('delete', old.id, old.title, old.description);
+        INSERT INTO task_fts(rowid, title, description) VALUES (new.id, new.title, new.description);
+    END""",
+    "INSERT INTO task_fts(task_fts) VALUES ('rebuild')",
+]
+# The search index statements run on sqlite builds with FTS5 only, searches use LIKE on the others
+TASK_SEARCH_DDL = TASK_FTS_DDL if FTS5_AVAILABLE else []
+
+# Change counter of the task table, bumped by triggers on every insert, update and delete
+# Each written task gets the new counter value as its version, so versions never repeat (even when an id is reused)
+# and the counter tells whether anything changed since a previous read
+# The same triggers record the change in the change feed (% is doubled since DDL statements are % formatted)
+TASK_CHANGE_UPSERT = """INSERT INTO task_change (task_id, seq, op, changed_at)
+        VALUES ({id}, (SELECT value FROM task_version WHERE id = 1), '{op}', strftime('%%Y-%%m-%%d %%H:%%M:%%f', 'now'))
+        ON CONFLICT (task_id) DO UPDATE SET seq = excluded.seq, op = excluded.op, changed_at = excluded.changed_at;"""
+
+TASK_VERSION_DDL = [
+    "CREATE TABLE IF NOT EXISTS task_version (id INTEGER PRIMARY KEY CHECK (id = 1), value INTEGER NOT NULL)",
+    "INSERT OR IGNORE INTO task_version (id, value) VALUES (1, 0)",
+    """CREATE TRIGGER IF NOT EXISTS task_version_insert AFTER INSERT ON task BEGIN
+        UPDATE task_version SET value = value + 1 WHERE id = 1;
+        UPDATE task SET version = (SELECT value FROM task_version WHERE id = 1) WHERE id = new.id;
+        """ + TASK_CHANGE_UPSERT.format(id = "new.id", op = "insert") + """
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS task_version_update AFTER UPDATE ON task WHEN new.version IS old.version BEGIN
+        UPDATE task_version SET value = value + 1 WHERE id = 1;
+        UPDATE task SET version = (SELECT value FROM task_version WHERE id = 1) WHERE id = new.id;
+        """ + TASK_CHANGE_UPSERT.format(id = "new.id", op = "update") + """
+    END""",
+    # Single task updates claim the next version in the statement (NEXT_VERSION in etags.py) to return it,
+    # this trigger then moves the counter to it and records the change
+    """CREATE TRIGGER IF NOT EXISTS task_version_claim AFTER UPDATE OF version ON task
+        WHEN new.version > (SELECT value FROM task_version WHERE id = 1) BEGIN
+        UPDATE task_version SET value = new.version WHERE id = 1;
+        """ + TASK_CHANGE_UPSERT.format(id = "new.id", op = "update") + """
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS task_version_delete AFTER DELETE ON task BEGIN
+        UPDATE task_version SET value = value + 1 WHERE id = 1;
+        """ + TASK_CHANGE_UPSERT.format(id = "old.id", op = "delete") + """
+    END""",
+]
+
+# Task counts by status, priority and assignee (an empty string for unassigned tasks), kept up to date by triggers
+# so that statistics are read without scanning the task table
+# TASK_STATS_COUNT adds the counts of the tasks matching {where}, for the existing tasks and after bulk loads
+TASK_STATS_COUNT = """INSERT INTO task_stats (status, priority, assigned_to, count)
+        SELECT status, priority, coalesce(assigned_to, ''), count(*) FROM task WHERE {where} GROUP BY 1, 2, 3
+        ON CONFLICT (status, priority, assigned_to) DO UPDATE SET count = task_stats.count + excluded.count"""
+
+TASK_STATS_INCREMENT = """INSERT INTO task_stats (status, priority, assigned_to, count)
+        VALUES (new.status, new.priority, coalesce(new.assigned_to, ''), 1)
+        ON CONFLICT (status, priority, assigned_to) DO UPDATE SET count = task_stats.count + 1;"""
+
+TASK_STATS_DECREMENT = """UPDATE task_stats SET count = count - 1
+        WHERE status = old.status AND priority = old.priority AND assigned_to = coalesce(old.assigned_to, '');"""
+
+TASK_STATS_DDL = [
+    """CREATE TABLE IF NOT EXISTS task_stats (
+        status VARCHAR NOT NULL, priority VARCHAR NOT NULL, assigned_to VARCHAR NOT NULL, count INTEGER NOT NULL,
+        PRIMARY KEY (status, priority, assigned_to)) WITHOUT ROWID""",
+    """CREATE TRIGGER IF NOT EXISTS task_stats_insert AFTER INSERT ON task BEGIN
+        """ + TASK_STATS_INCREMENT + """
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS task_stats_delete AFTER DELETE ON task BEGIN
+        """ + TASK_STATS_DECREMENT + """
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS task_stats_update AFTER UPDATE OF status, priority, assigned_to ON task BEGIN
+        """ + TASK_STATS_DECREMENT + """
+        """ + TASK_STATS_INCREMENT + """
+    END""",
+    TASK_STATS_COUNT.format(where = "NOT EXISTS (SELECT 1 FROM task_stats)"),
+]
+
+# Position of the due date scheduler: the (due_date, id) of the last task flagged overdue, starting at creation time
+# Tasks becoming open again with a due date at or before the position are behind it, where flagging does not read
+# anymore: the backlog table queues them (the reopened ones through a trigger, the imported ones in transfer.py)
+TASK_SCHEDULER_DDL = [
+    "CREATE TABLE IF NOT EXISTS task_scheduler (id INTEGER PRIMARY KEY CHECK (id = 1), due_date DATETIME NOT NULL, task_id INTEGER NOT NULL)",
+    "INSERT OR IGNORE INTO task_scheduler (id, due_date, task_id) VALUES (1, strftime('%%Y-%%m-%%d %%H:%%M:%%S.000000', 'now'), 0)",
+    "CREATE TABLE IF NOT EXISTS task_scheduler_backlog (task_id INTEGER PRIMARY KEY)",
+    """CREATE TRIGGER IF NOT EXISTS task_scheduler_reopen AFTER UPDATE OF status ON task
+        WHEN old.status NOT IN ('pending', 'in_progress') AND new.status IN ('pending', 'in_progress')
+        AND new.due_date <= (SELECT due_date FROM task_scheduler WHERE id = 1) BEGIN
+        INSERT OR IGNORE INTO task_scheduler_backlog (task_id) VALUES (new.id);
+    END""",
+]
+
+for statement in TASK_SEARCH_DDL + TASK_VERSION_DDL + TASK_STATS_DDL + TASK_SCHEDULER_DDL:
+    event.listen(Task.__table__, "after_create", DDL(statement).execute_if(dialect = "sqlite"))
+
+# Triggers created by the statements above, dropped and recreated by bulk loads and migrations
+TASK_TRIGGER_DDL = [statement for statement in TASK_SEARCH_DDL + TASK_VERSION_DDL + TASK_STATS_DDL if statement.startswith("CREATE TRIGGER")]
+TASK_TRIGGER_NAMES = [re.search(r"EXISTS (\w+)", statement).group(1) for statement in TASK_TRIGGER_DDL]
 
 # Create Pydantic Models
 
@@ -65,7 +232,7 @@ class TaskUpdate(BaseModel):
 
     @field_validator("title")
     def validate_title(cls, value: str | None) -> str | None:
-        if not value.strip():
+        if value is not None and not value.strip():
             raise ValueError("Title cannot be empty or whitespace only")
         return value
 
@@ -75,6 +242,44 @@ class TaskUpdate(BaseModel):
             raise ValueError("Due date must be in the future")
         return value
 
+# Partial Update Model, only the fields sent are changed and null clears an optional field
+class TaskPatch(TaskUpdate):
+    @model_validator(mode = "after")
+    def validate_required_fields(self):
+        for field in ("title", "status", "priority"):
+            if field in self.model_fields_set and getattr(self, field) is None:
+                raise ValueError(f"{field} cannot be null")
+        return self
+
+# Bulk Update Model, one item of PATCH /tasks/bulk
+class TaskBulkUpdate(TaskPatch):
+    id: int
+
+# Import Model, one row of an imported file
+# Dates are not required to be in the future (to restore old tasks), and dates without a timezone are taken as UTC
+class TaskImport(BaseModel):
+    id: int | None = None
+    title: str
+    description: str | None = None
+    status: TaskStatus = TaskStatus.pending
+    priority: TaskPriority = TaskPriority.medium
+    created_at: datetime = Field(default_factory = lambda: datetime.now(timezone.utc))
+    updated_at: datetime | None = None
+    due_date: datetime | None = None
+    assigned_to: str | None = None
+
+    @field_validator("title")
+    def validate_title(cls, value: str) -> str:
+        if not value.strip():
+            raise ValueError("Title cannot be empty or whitespace only")
+        return value
+
+    @field_validator("created_at", "updated_at", "due_date")
+    def validate_timezone(cls, value: datetime | None) -> datetime | None:
+        if value and value.tzinfo is None:
+            return value.replace(tzinfo = timezone.utc)
+        return value
+
 # Response Model
 class TaskResponse(BaseModel):
     id: int
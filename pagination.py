@@ -0,0 +1,142 @@
+import base64
+import json
+import os
+from datetime import datetime, timezone
+from enum import Enum
+from sqlalchemy import Column, and_, or_, false, tuple_, bindparam
+from sqlalchemy.sql.elements import BindParameter
+from sqlalchemy.types import TypeDecorator
+
+# Page sizes, configurable through the environment
+DEFAULT_PAGE_SIZE = int(os.getenv("TASKS_PAGE_SIZE", "100"))
+MAX_PAGE_SIZE = int(os.getenv("TASKS_MAX_PAGE_SIZE", "1000"))
+
+class InvalidCursor(ValueError):
+    pass
+
+# Encode the sort key values of the last row of a page into an opaque cursor
+def encode_cursor(values: list) -> str:
+    payload = []
+    for value in values:
+        if isinstance(value, datetime):
+            value = value.isoformat()
+        elif isinstance(value, Enum):
+            value = value.value
+        payload.append(value)
+    raw = json.dumps(payload, separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+# Python type of a column, looking through type decorators such as the UTC datetime type of sqlmodel
+def _python_type(column) -> type:
+    column_type = column.type
+    while isinstance(column_type, TypeDecorator):
+        column_type = column_type.impl_instance
+    return column_type.python_type
+
+# Decode a cursor back into sort key values, converted to the python type of each key
+def decode_cursor(cursor: str, keys: list) -> list:
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        payload = json.loads(raw)
+    except ValueError as e:
+        raise InvalidCursor("Invalid cursor") from e
+    if not isinstance(payload, list) or len(payload) != len(keys):
+        raise InvalidCursor("Invalid cursor")
+
+    values = []
+    for (column, _), value in zip(keys, payload):
+        if value is not None:
+            try:
+                python_type = _python_type(column)
+                if issubclass(python_type, datetime):
+                    # Datetimes are stored in UTC, rows read without the UTC type decorator are naive
+                    value = datetime.fromisoformat(value)
+                    if value.tzinfo is None:
+                        value = value.replace(tzinfo = timezone.utc)
+                elif issubclass(python_type, Enum):
+                    value = python_type(value)
+                elif not isinstance(value, python_type):
+                    raise TypeError
+            except (TypeError, ValueError) as e:
+                raise InvalidCursor("Invalid cursor") from e
+        values.append(value)
+    return values
+
+# Columns of subqueries and expressions may not know whether they are nullable, assume they are
+def _nullable(column) -> bool:
+    return getattr(column.expression, "nullable", True)
+
+# Condition matching the rows that sort strictly after value on a single key
+# SQLite sorts NULL before every other value in ascending order and after them in descending order
+def _after(column, descending: bool, value):
+    if value is None:
+        return false() if descending else column.is_not(None)
+    if descending:
+        return or_(column < value, column.is_(None)) if _nullable(column) else column < value
+    return column > value
+
+def _equal(column, value):
+    return column.is_(None) if value is None else column == value
+
+# Cursor values are either plain values or bind parameters (see cursor_placeholders)
+def _bind(column, value):
+    return value if isinstance(value, BindParameter) else bindparam(None, value, type_ = column.type)
+
+# Keyset condition for rows after the cursor on (sort keys..., id)
+# keys is a list of (column, descending) pairs, the last one being a unique column
+def keyset_condition(keys: list, values: list):
+    # When every key sorts in the same direction, a row value comparison such as (title, id) > (?, ?)
+    # lets the database seek into the matching index instead of walking it from the start
+    # (sqlite only seeks with row values into indexes of columns, not of expressions)
+    columns = [column for column, _ in keys]
+    directions = {descending for _, descending in keys}
+    plain = all(isinstance(column.expression, Column) for column in columns)
+    if plain and len(directions) == 1 and all(value is not None for value in values):
+        row = tuple_(*columns)
+        cursor = tuple_(*[_bind(column, value) for column, value in zip(columns, values)])
+        nullable = [column for column in columns if _nullable(column)]
+        if not directions.pop():
+            return row > cursor
+        if not nullable:
+            return row < cursor
+        if nullable == columns[:1]:
+            return or_(row < cursor, columns[0].is_(None))
+
+    branches = []
+    for i, (column, descending) in enumerate(keys):
+        prefix = [_equal(keys[j][0], values[j]) for j in range(i)]
+        branches.append(and_(*prefix, _after(column, descending, values[i])))
+    # The bound on the first key implied by the branches lets the database seek into its index
+    # instead of reading the branches as separate lookups to merge and sort
+    first, descending = keys[0]
+    if values[0] is not None and not _nullable(first):
+        return and_(first <= values[0] if descending else first >= values[0], or_(*branches))
+    return or_(*branches)
+
+# Named bind parameters standing for the non null cursor values, so that a statement built with them
+# can be cached and executed with cursor_parameters(values)
+def cursor_placeholders(keys: list, values: list) -> list:
+    return [None if value is None else bindparam(f"cursor_{i}", type_ = column.type) for i, ((column, _), value) in enumerate(zip(keys, values))]
+
+def cursor_parameters(values: list) -> dict:
+    return {f"cursor_{i}": value for i, value in enumerate(values) if value is not None}
+
+# Order a statement by the pagination keys
+def order_by_keys(statement, keys: list):
+    return statement.order_by(*[column.desc() if descending else column.asc() for column, descending in keys])
+
+# Apply keyset pagination on a statement, fetching one extra row to know whether a next page exists
+# Without a limit every row after the cursor is selected
+def paginate(statement, keys: list, cursor: str | None, limit: int | None):
+    if cursor:
+        statement = statement.where(keyset_condition(keys, decode_cursor(cursor, keys)))
+    statement = order_by_keys(statement, keys)
+    return statement if limit is None else statement.limit(limit + 1)
+
+# Split the extra row off a fetched page and build the cursor of the next page
+def next_page(rows: list, keys: list, limit: int) -> tuple[list, str | None]:
+    if len(rows) <= limit:
+        return rows, None
+    rows = rows[:limit]
+    last = rows[-1]
+    return rows, encode_cursor([getattr(last, column.key) for column, _ in keys])
@@ -0,0 +1,107 @@
+import os
+from functools import lru_cache
+from typing import NamedTuple
+from sqlalchemy import select, bindparam, Integer
+from models import Task, STATUS_RANK, PRIORITY_RANK
+from serializers import TASK_FIELDS, TASK_COLUMNS_BY_FIELD
+from pagination import keyset_condition, cursor_placeholders, cursor_parameters, order_by_keys
+
+# Composable task query used by GET /tasks: filters, multi key sort and field projection
+# Statements only depend on the shape of a query (which filters are set, the sort, the fields, ...),
+# the values are bound at execution, so one statement is built per shape and cached
+
+SORTABLE_FIELDS = ("id", "title", "status", "priority", "created_at", "updated_at", "due_date", "assigned_to")
+STATEMENT_CACHE_SIZE = int(os.getenv("TASKS_STATEMENT_CACHE_SIZE", "256"))
+# Enums sort in the order of their members, by rank (selected under these names for the cursor)
+SORT_EXPRESSIONS = {
+    "status": STATUS_RANK.label("status_rank"),
+    "priority": PRIORITY_RANK.label("priority_rank"),
+}
+# Status and priority are required so their ranks are never null, keyset conditions need no null branches
+for expression in SORT_EXPRESSIONS.values():
+    expression.nullable = False
+
+# Filters and the condition each one adds, values are bound under the filter name
+FILTERS = {
+    "status": lambda: Task.status.in_(bindparam("status", expanding = True)),
+    "priority": lambda: Task.priority.in_(bindparam("priority", expanding = True)),
+    "assigned_to": lambda: Task.assigned_to == bindparam("assigned_to"),
+    "due_after": lambda: Task.due_date > bindparam("due_after"),
+    "due_before": lambda: Task.due_date < bindparam("due_before"),
+    "created_after": lambda: Task.created_at > bindparam("created_after"),
+    "created_before": lambda: Task.created_at < bindparam("created_before"),
+}
+
+class TaskQueryShape(NamedTuple):
+    filters: tuple # names of the filters in use
+    sort: tuple # (field, descending) pairs
+    fields: tuple # projected fields
+    cursor: tuple | None # for each sort key, whether the cursor value is null, None without a cursor
+    limit: bool # False when streaming every row
+
+# Parse a sort parameter such as "-updated_at,title", "-" meaning descending
+def parse_sort(text: str) -> tuple:
+    sort = []
+    for item in text.split(","):
+        item = item.strip()
+        field = item.lstrip("-")
+        if field not in SORTABLE_FIELDS:
+            raise ValueError(f"Cannot sort by '{field}', expected one of {', '.join(SORTABLE_FIELDS)}")
+        if field in [name for name, _ in sort]:
+            raise ValueError(f"Sort field '{field}' is repeated")
+        sort.append((field, item.startswith("-")))
+    return tuple(sort)
+
+# Parse a fields parameter such as "id,title", keeping the order of the response model
+def parse_fields(text: str | None) -> tuple:
+    if not text:
+        return TASK_FIELDS
+    fields = {field.strip() for field in text.split(",")}
+    unknown = fields - set(TASK_FIELDS)
+    if unknown:
+        raise ValueError(f"Unknown fields: {', '.join(sorted(unknown))}")
+    return tuple(field for field in TASK_FIELDS if field in fields)
+
+# Pagination keys of a sort, ending with id (in the direction of the last key) as the tie breaker
+def sort_keys(sort: tuple) -> list:
+    keys = [(SORT_EXPRESSIONS.get(field, getattr(Task, field)), descending) for field, descending in sort]
+    if "id" not in [field for field, _ in sort]:
+        keys.append((Task.id, sort[-1][1] if sort else False))
+    return keys
+
+# Build the statement of a query shape, executed with the parameters returned by task_query()
+@lru_cache(maxsize = STATEMENT_CACHE_SIZE)
+def compile_task_query(shape: TaskQueryShape):
+    keys = sort_keys(shape.sort)
+    # Projected fields first, then the sort keys missing from the projection (needed for the cursor)
+    key_columns = [TASK_COLUMNS_BY_FIELD.get(column.key, column) for column, _ in keys if column.key not in shape.fields]
+    columns = [*(TASK_COLUMNS_BY_FIELD[field] for field in shape.fields), *key_columns]
+
+    statement = select(*columns)
+    for name in shape.filters:
+        statement = statement.where(FILTERS[name]())
+    if shape.cursor is not None:
+        values = [None if is_null else True for is_null in shape.cursor]
+        statement = statement.where(keyset_condition(keys, cursor_placeholders(keys, values)))
+    statement = order_by_keys(statement, keys)
+    if shape.limit:
+        statement = statement.limit(bindparam("limit", type_ = Integer))
+    return statement
+
+# Shape and parameters of a query
+# filters maps filter names to values (lists for status and priority), unset filters are None or empty
+def task_query(filters: dict, sort: tuple, fields: tuple, cursor_values: list | None, limit: int | None):
+    used = tuple(name for name in FILTERS if filters.get(name) not in (None, []))
+    shape = TaskQueryShape(
+        filters = used,
+        sort = sort,
+        fields = fields,
+        cursor = None if cursor_values is None else tuple(value is None for value in cursor_values),
+        limit = limit is not None,
+    )
+    parameters = {name: filters[name] for name in used}
+    if cursor_values is not None:
+        parameters.update(cursor_parameters(cursor_values))
+    if limit is not None:
+        parameters["limit"] = limit + 1
+    return compile_task_query(shape), parameters, sort_keys(sort)
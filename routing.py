@@ -0,0 +1,222 @@
+import sys
+import os
+
+sys.path.append(os.path.dirname(__file__))
+
+import argparse
+import asyncio
+import contextvars
+import itertools
+import logging
+import sqlite3
+import time
+from sqlalchemy import event, text
+from sqlalchemy.exc import OperationalError
+from database import async_engine, engine, replica_engines, replica_urls, sqlite_file_name
+from metrics import METRICS, CounterMetric, GaugeMetric
+
+# Read/write routing across the primary database and its read replicas (DATABASE_REPLICA_URLS)
+# Writes always go to the primary (through the write queue). Reads of a request go to one healthy replica,
+# taken in turn, so adding replicas adds read capacity. Replicas lag behind the primary, so a client that must
+# see its own writes sends back the X-Consistency-Token header of its last write response: the position of the
+# primary after the write (the change counter on sqlite, the WAL position on PostgreSQL). Its reads then go to a
+# replica that replayed at least that position, or to the primary when none did. Requests without a token read
+# from any healthy replica.
+# Replicas are checked every REPLICA_CHECK_INTERVAL seconds, which also reads their position. A replica
+# failing REPLICA_MAX_FAILURES checks or queries in a row is left out for REPLICA_EJECT_SECONDS.
+# With several sqlite files as stand-ins for replicas, `python routing.py sync` copies the primary to them.
+
+REPLICA_CHECK_INTERVAL = float(os.getenv("REPLICA_CHECK_INTERVAL", "5"))
+REPLICA_MAX_FAILURES = int(os.getenv("REPLICA_MAX_FAILURES", "3"))
+REPLICA_EJECT_SECONDS = float(os.getenv("REPLICA_EJECT_SECONDS", "30"))
+CONSISTENCY_HEADER = "X-Consistency-Token"
+
+logger = logging.getLogger("routing")
+
+# Position statements of the primary and of a replica, by dialect
+POSITION_STATEMENTS = {
+    "sqlite": (text("SELECT value FROM task_version WHERE id = 1"),) * 2,
+    "postgresql": (text("SELECT pg_current_wal_lsn() - '0/0'"), text("SELECT coalesce(pg_last_wal_replay_lsn(), pg_current_wal_lsn()) - '0/0'")),
+}
+
+READ_ROUTES = CounterMetric("db_read_routes_total", "Requests reading from the primary or from a replica")
+
+# Position of a database, 0 when its dialect has none (tokens are then ignored)
+async def read_position(connection, replica: bool) -> int:
+    statements = POSITION_STATEMENTS.get(connection.dialect.name)
+    if statements is None:
+        return 0
+    return int((await connection.execute(statements[1 if replica else 0])).scalar() or 0)
+
+class Replica:
+    def __init__(self, engine, name: str):
+        self.engine = engine
+        self.name = name
+        # Unknown until the first check, so a replica only serves reads once it answered
+        self.position = -1
+        self.failures = 0
+        self.ejected_until = 0.0
+        # Failed queries of requests count like failed checks
+        event.listen(engine.sync_engine, "handle_error", self._on_error)
+
+    def _on_error(self, context):
+        if context.is_disconnect or isinstance(context.sqlalchemy_exception, OperationalError):
+            self.failed()
+
+    def available(self) -> bool:
+        return self.position >= 0 and self.ejected_until <= time.monotonic()
+
+    def failed(self):
+        self.failures += 1
+        if self.failures >= REPLICA_MAX_FAILURES and self.ejected_until <= time.monotonic():
+            self.ejected_until = time.monotonic() + REPLICA_EJECT_SECONDS
+            logger.warning("replica %s ejected for %.0fs after %d failures", self.name, REPLICA_EJECT_SECONDS, self.failures)
+
+    async def check(self):
+        try:
+            async with self.engine.connect() as connection:
+                self.position = await read_position(connection, replica = True)
+            self.failures = 0
+        except Exception:
+            self.failed()
+
+    def status(self) -> dict:
+        return {"name": self.name, "available": self.available(), "position": self.position, "failures": self.failures}
+
+# Engine chosen for the reads of a request, once, so that they all see the same database
+class ReadRoute:
+    def __init__(self, min_position: int):
+        self.min_position = min_position
+        self.engine = None
+
+current_route = contextvars.ContextVar("current_route", default = None)
+
+class ReplicaRouter:
+    def __init__(self, primary, replicas: list):
+        self.primary = primary
+        self.replicas = replicas
+        self.turn = itertools.count()
+        self.task = None
+
+    # A replica at min_position or later, in turn, or the primary
+    def choose(self, min_position: int = 0):
+        candidates = [replica for replica in self.replicas if replica.available() and replica.position >= min_position]
+        if not candidates:
+            READ_ROUTES.inc(target = "primary")
+            return self.primary
+        READ_ROUTES.inc(target = "replica")
+        return candidates[next(self.turn) % len(candidates)].engine
+
+    # Engine for the reads of the current request, the primary outside of requests
+    def read_engine(self):
+        route = current_route.get()
+        if route is None or not self.replicas:
+            return self.primary
+        if route.engine is None:
+            route.engine = self.choose(route.min_position)
+        return route.engine
+
+    async def primary_position(self) -> int:
+        async with self.primary.connect() as connection:
+            return await read_position(connection, replica = False)
+
+    async def check(self):
+        await asyncio.gather(*(replica.check() for replica in self.replicas))
+
+    async def start(self):
+        if not self.replicas or self.task is not None:
+            return
+        await self.check()
+        # The checks outlive the startup, so they do not run in its context
+        self.task = asyncio.get_running_loop().create_task(self._run(), context = contextvars.Context())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+        for replica in self.replicas:
+            await replica.engine.dispose()
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(REPLICA_CHECK_INTERVAL)
+            await self.check()
+
+    def status(self) -> list:
+        return [replica.status() for replica in self.replicas]
+
+router = ReplicaRouter(async_engine, [Replica(replica_engine, replica_url.render_as_string(hide_password = True))
+                                      for replica_engine, replica_url in zip(replica_engines, replica_urls)])
+METRICS.extend([READ_ROUTES, GaugeMetric("db_replicas_available", "Replicas serving reads", lambda: sum(replica.available() for replica in router.replicas))])
+
+def read_engine():
+    return router.read_engine()
+
+# ASGI middleware routing the reads of GET requests, and adding the consistency token to write responses
+class RoutingMiddleware:
+    def __init__(self, app, router: ReplicaRouter = router):
+        self.app = app
+        self.router = router
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not self.router.replicas:
+            return await self.app(scope, receive, send)
+
+        if scope["method"] in ("GET", "HEAD"):
+            header = next((value for name, value in scope["headers"] if name == CONSISTENCY_HEADER.lower().encode()), b"0")
+            try:
+                min_position = int(header)
+            except ValueError:
+                min_position = 0
+            token = current_route.set(ReadRoute(min_position))
+            try:
+                return await self.app(scope, receive, send)
+            finally:
+                current_route.reset(token)
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start" and message["status"] < 400:
+                # Read after the write committed, so the position covers it
+                try:
+                    position = await self.router.primary_position()
+                    message = {**message, "headers": [*message.get("headers", []), (CONSISTENCY_HEADER.lower().encode(), str(position).encode())]}
+                except Exception:
+                    logger.exception("reading the position of the primary failed")
+            await send(message)
+
+        await self.app(scope, receive, send_wrapper)
+
+# Copy the primary sqlite database to a replica file, with the backup API (readers of the replica keep working)
+def copy_sqlite_database(source: str, target: str):
+    source_connection, target_connection = sqlite3.connect(source), sqlite3.connect(target)
+    try:
+        source_connection.backup(target_connection)
+    finally:
+        source_connection.close()
+        target_connection.close()
+
+# Copy the primary to the sqlite replicas of DATABASE_REPLICA_URLS, once or every interval seconds
+def main():
+    parser = argparse.ArgumentParser()
+    commands = parser.add_subparsers(dest = "command", required = True)
+    sync = commands.add_parser("sync", help = "copy the primary sqlite database to the sqlite replicas")
+    sync.add_argument("--interval", type = float, default = 0, help = "keep copying every interval seconds")
+    args = parser.parse_args()
+
+    targets = [replica_url.database for replica_url in replica_urls if replica_url.get_backend_name() == "sqlite"]
+    if engine.dialect.name != "sqlite" or not targets:
+        parser.error("sync needs a sqlite primary and sqlite replicas in DATABASE_REPLICA_URLS")
+    while True:
+        for target in targets:
+            copy_sqlite_database(sqlite_file_name, target)
+        print(f"copied {sqlite_file_name} to {', '.join(targets)}")
+        if not args.interval:
+            return
+        time.sleep(args.interval)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,211 @@
+import asyncio
+import contextvars
+import heapq
+import logging
+import os
+from datetime import datetime, timedelta, timezone
+from sqlalchemy import Integer, bindparam, text
+from sqlmodel import select
+from sqlmodel.ext.asyncio.session import AsyncSession
+from models import Task, OPEN_TASKS
+from database import async_engine, is_sqlite
+from pagination import keyset_condition
+from writer import write_queue
+from cache import task_cache
+from metrics import OVERDUE_FLAGGED
+
+# Due date scheduler
+# Open tasks whose due date passed are flagged overdue: their change feed entry becomes an "overdue" change
+# with the current task, so clients following the feed get a reminder. The position of the scheduler, the
+# (due_date, id) of the last flagged task, is stored in task_scheduler, and flagging reads the open tasks due
+# date index from the position up to now, in batches of one write each. Each task is flagged once, even with
+# several workers, and after a restart only the tasks that became due while the app was stopped are read.
+# Due dates are in the future when written, so they are always after the position, but tasks reopened (closed
+# to open status) or imported with a due date at or before the position are behind it: they are queued in the
+# task_scheduler_backlog table (by a trigger and by the import), and each run flags them too.
+# Between runs the scheduler sleeps until the next due date, taken from a min heap of the due dates of the
+# next SCHEDULER_HORIZON: loaded from the index one window at a time, and updated by the write endpoints.
+
+SCHEDULER_ENABLED = is_sqlite and os.getenv("SCHEDULER_ENABLED", "true").lower() == "true"
+SCHEDULER_BATCH_SIZE = int(os.getenv("SCHEDULER_BATCH_SIZE", "500"))
+SCHEDULER_HORIZON = timedelta(seconds = float(os.getenv("SCHEDULER_HORIZON", "3600")))
+# Longest sleep between runs, the delay before flagging tasks written by other workers
+SCHEDULER_MAX_SLEEP = float(os.getenv("SCHEDULER_MAX_SLEEP", "60"))
+
+logger = logging.getLogger("scheduler")
+
+DUE_DATE_KEYS = [(Task.due_date, False), (Task.id, False)]
+DUE_DATE_TYPE = Task.__table__.c.due_date.type
+
+# The position is read with a write, so that the transaction holds the write lock from its first statement
+# and workers flagging at the same time wait for each other instead of failing to upgrade their lock
+POSITION_STATEMENT = text(
+    "UPDATE task_scheduler SET task_id = task_id WHERE id = 1 RETURNING due_date, task_id"
+).columns(due_date = DUE_DATE_TYPE, task_id = Integer)
+MOVE_POSITION_STATEMENT = text(
+    "UPDATE task_scheduler SET due_date = :due_date, task_id = :task_id WHERE id = 1"
+).bindparams(bindparam("due_date", type_ = DUE_DATE_TYPE))
+# Claim count values of the change counter, the flagged tasks get the seqs up to the returned value
+CLAIM_SEQS_STATEMENT = text("UPDATE task_version SET value = value + :count WHERE id = 1 RETURNING value")
+# Take up to limit tasks out of the backlog
+TAKE_BACKLOG_STATEMENT = text("""DELETE FROM task_scheduler_backlog
+    WHERE task_id IN (SELECT task_id FROM task_scheduler_backlog LIMIT :limit) RETURNING task_id""")
+OVERDUE_CHANGE_STATEMENT = text("""INSERT INTO task_change (task_id, seq, op, changed_at)
+    VALUES (:task_id, :seq, 'overdue', strftime('%Y-%m-%d %H:%M:%f', 'now'))
+    ON CONFLICT (task_id) DO UPDATE SET seq = excluded.seq, op = excluded.op, changed_at = excluded.changed_at""")
+
+def as_utc(value: datetime) -> datetime:
+    return value.replace(tzinfo = timezone.utc) if value.tzinfo is None else value.astimezone(timezone.utc)
+
+# Open tasks with a due date in (start, end], in due date order, read from the open tasks due date index
+# start is a datetime, or a (due_date, id) position
+def due_statement(start, end: datetime, limit: int | None = None):
+    after = keyset_condition(DUE_DATE_KEYS, list(start)) if isinstance(start, (tuple, list)) else Task.due_date > start
+    return select(Task.id, Task.due_date).where(OPEN_TASKS, after, Task.due_date <= end).order_by(Task.due_date, Task.id).limit(limit)
+
+# Make the change feed entries of the tasks "overdue" changes, with new seqs
+async def flag_tasks(connection, task_ids: list[int]):
+    last = (await connection.execute(CLAIM_SEQS_STATEMENT, {"count": len(task_ids)})).scalar_one()
+    first = last - len(task_ids) + 1
+    await connection.execute(OVERDUE_CHANGE_STATEMENT, [{"task_id": task_id, "seq": first + i} for i, task_id in enumerate(task_ids)])
+
+# Flag the next open tasks due by now (up to batch_size of them) in the session's transaction,
+# returns the number of flagged tasks
+async def flag_overdue_batch(session, now: datetime, batch_size: int) -> int:
+    connection = await session.connection()
+    position = (await connection.execute(POSITION_STATEMENT)).one()
+    rows = (await connection.execute(due_statement(tuple(position), now, batch_size))).all()
+    if not rows:
+        return 0
+    await flag_tasks(connection, [row.id for row in rows])
+    await connection.execute(MOVE_POSITION_STATEMENT, {"due_date": rows[-1].due_date, "task_id": rows[-1].id})
+    return len(rows)
+
+# Flag the next tasks of the backlog (up to batch_size of them) still open and behind the position,
+# returns the number of tasks taken out of the backlog and the number of flagged tasks
+async def flag_backlog_batch(session, batch_size: int) -> tuple[int, int]:
+    connection = await session.connection()
+    position = (await connection.execute(POSITION_STATEMENT)).one()
+    task_ids = (await connection.execute(TAKE_BACKLOG_STATEMENT, {"limit": batch_size})).scalars().all()
+    if not task_ids:
+        return 0, 0
+    behind = ~keyset_condition(DUE_DATE_KEYS, list(position))
+    flagged = (await connection.execute(select(Task.id).where(Task.id.in_(task_ids), OPEN_TASKS, behind).order_by(Task.id))).scalars().all()
+    if flagged:
+        await flag_tasks(connection, flagged)
+    return len(task_ids), len(flagged)
+
+# Flag every open task due by now, one write per batch, returns the number of flagged tasks
+async def flag_overdue(now: datetime | None = None, batch_size: int = SCHEDULER_BATCH_SIZE) -> int:
+    now = now or datetime.now(timezone.utc)
+    total = 0
+    while True:
+        count = await write_queue.submit(lambda session: flag_overdue_batch(session, now, batch_size))
+        total += count
+        if count < batch_size:
+            break
+    while True:
+        taken, count = await write_queue.submit(lambda session: flag_backlog_batch(session, batch_size))
+        total += count
+        if taken < batch_size:
+            break
+    if total:
+        OVERDUE_FLAGGED.inc(total)
+        await task_cache.invalidate()
+    return total
+
+class DueDateScheduler:
+    def __init__(self, engine = async_engine, horizon: timedelta = SCHEDULER_HORIZON, max_sleep: float = SCHEDULER_MAX_SLEEP):
+        self.engine = engine
+        self.horizon = horizon
+        self.max_sleep = max_sleep
+        # Heap of (due_date, task_id), entries whose due date is no longer the one in due are stale and skipped
+        self.heap = []
+        self.due = {}
+        # Due dates up to loaded_until are in the heap, None while the scheduler is stopped
+        self.loaded_until = None
+        self.task = None
+        self.wakeup = None
+
+    # Start the scheduler on the running event loop
+    def start(self):
+        if not SCHEDULER_ENABLED or self.task is not None:
+            return
+        self.wakeup = asyncio.Event()
+        # The scheduler outlives the request or startup starting it, so it does not run in its context
+        self.task = asyncio.get_running_loop().create_task(self._run(), context = contextvars.Context())
+
+    async def stop(self):
+        if self.task is None:
+            return
+        self.task.cancel()
+        try:
+            await self.task
+        except asyncio.CancelledError:
+            pass
+        self.task = None
+        self.heap, self.due, self.loaded_until = [], {}, None
+
+    # Called by the write endpoints with the new due date of a task, None for deleted tasks
+    def notify(self, task_id: int, due_date: datetime | None):
+        if self.loaded_until is None:
+            return
+        due_date = as_utc(due_date) if due_date is not None else None
+        if due_date is None or due_date > self.loaded_until:
+            self.due.pop(task_id, None)
+            return
+        self._push(task_id, due_date)
+        if self.heap[0] == (due_date, task_id):
+            self.wakeup.set()
+
+    # Called by the write endpoints after reopening or importing tasks, which may have queued tasks in the backlog
+    def wake(self):
+        if self.wakeup is not None:
+            self.wakeup.set()
+
+    def _push(self, task_id: int, due_date: datetime):
+        self.due[task_id] = due_date
+        heapq.heappush(self.heap, (due_date, task_id))
+
+    # Next due date in the heap, dropping the stale entries on top
+    def next_due(self) -> datetime | None:
+        while self.heap and self.due.get(self.heap[0][1]) != self.heap[0][0]:
+            heapq.heappop(self.heap)
+        return self.heap[0][0] if self.heap else None
+
+    # Remove the entries due by now, they were just flagged
+    def pop_due(self, now: datetime):
+        while self.heap and self.heap[0][0] <= now:
+            due_date, task_id = heapq.heappop(self.heap)
+            if self.due.get(task_id) == due_date:
+                del self.due[task_id]
+
+    # Add the due dates after the loaded window up to until
+    async def load(self, now: datetime, until: datetime):
+        async with AsyncSession(self.engine) as session:
+            connection = await session.connection()
+            rows = (await connection.execute(due_statement(max(self.loaded_until or now, now), until))).all()
+        for task_id, due_date in rows:
+            self._push(task_id, as_utc(due_date))
+        self.loaded_until = until
+
+    async def _run(self):
+        while True:
+            timeout = self.max_sleep
+            try:
+                now = datetime.now(timezone.utc)
+                await flag_overdue(now)
+                self.pop_due(now)
+                await self.load(now, now + self.horizon)
+                next_due = self.next_due()
+                if next_due is not None:
+                    timeout = min(timeout, max((next_due - datetime.now(timezone.utc)).total_seconds(), 0))
+            except Exception:
+                logger.exception("flagging overdue tasks failed, retrying in %.0fs", timeout)
+            self.wakeup.clear()
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+scheduler = DueDateScheduler()
@@ -0,0 +1,39 @@
+import re
+from sqlalchemy import Float, func, literal_column, table, column, or_
+from models import Task
+from serializers import TASK_FIELDS, select_task_columns
+
+# Search in title and description using the task_fts full-text index (see models.py)
+# Every word of the text must match, as a word prefix, and results are ranked with bm25
+# where a match in the title weighs more than one in the description
+
+task_fts = table("task_fts", column("rowid"))
+TITLE_WEIGHT = 10.0
+DESCRIPTION_WEIGHT = 1.0
+
+# Build an FTS5 query from free text: each word is quoted (so FTS5 operators are not interpreted)
+# and made a prefix query, e.g. 'buy milk' -> '"buy"* "milk"*'
+def match_query(text: str) -> str | None:
+    words = re.findall(r"\w+", text)
+    if not words:
+        return None
+    return " ".join(f'"{word}"*' for word in words)
+
+# Statement selecting the matching tasks with their rank, and the keyset pagination keys ordering them by relevance
+def search_statement(text: str):
+    query = match_query(text)
+    rank = func.bm25(literal_column("task_fts"), TITLE_WEIGHT, DESCRIPTION_WEIGHT, type_ = Float)
+    ranked = (
+        select_task_columns()
+        .add_columns(rank.label("rank"))
+        .join_from(Task, task_fts, Task.id == task_fts.c.rowid)
+        .where(literal_column("task_fts").op("MATCH")(query or '""'))
+        .subquery()
+    )
+    statement = ranked.select().with_only_columns(*[ranked.c[field] for field in TASK_FIELDS], ranked.c.rank)
+    keys = [(ranked.c.rank, False), (ranked.c.id, False)]
+    return statement, keys
+
+# Fallback for databases without FTS5, a LIKE scan over title and description
+def like_search_statement(text: str):
+    return select_task_columns().where(or_(Task.title.contains(text), Task.description.contains(text)))
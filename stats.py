@@ -0,0 +1,49 @@
+from datetime import datetime, timezone
+from sqlalchemy import Integer, String, func, text
+from sqlmodel import select
+from models import Task, TaskStatus, TaskPriority, OPEN_TASKS
+from database import is_sqlite
+
+# Task statistics: counts by status, priority and assignee, and overdue tasks
+# On sqlite the counts are read from task_stats, the counters kept up to date by triggers on every write
+# (see models.py), so reading them takes the same time whatever the number of tasks. Other databases group
+# the task table instead. Overdue tasks depend on the current time, so they are counted with a range of the
+# open tasks due date index, which only reads the entries of overdue tasks.
+
+if is_sqlite:
+    COUNTS_STATEMENT = text(
+        "SELECT status, priority, nullif(assigned_to, '') AS assigned_to, count FROM task_stats WHERE count > 0"
+    ).columns(status = Task.__table__.c.status.type, priority = Task.__table__.c.priority.type, assigned_to = String, count = Integer)
+else:
+    COUNTS_STATEMENT = select(Task.status, Task.priority, Task.assigned_to, func.count()).group_by(Task.status, Task.priority, Task.assigned_to)
+
+def overdue_statement(now: datetime):
+    return select(func.count()).select_from(Task).where(OPEN_TASKS, Task.due_date < now)
+
+# Build the statistics from rows of (status, priority, assigned_to, count)
+# Assignees are sorted by task count, only the first ones are kept
+def stats_to_dict(rows, overdue: int, assignees: int) -> dict:
+    by_status = {status.value: 0 for status in TaskStatus}
+    by_priority = {priority.value: 0 for priority in TaskPriority}
+    by_status_priority = {status.value: {priority.value: 0 for priority in TaskPriority} for status in TaskStatus}
+    by_assignee = {}
+    for status, priority, assigned_to, count in rows:
+        by_status[status.value] += count
+        by_priority[priority.value] += count
+        by_status_priority[status.value][priority.value] += count
+        by_assignee[assigned_to] = by_assignee.get(assigned_to, 0) + count
+    top = sorted(by_assignee.items(), key = lambda item: (-item[1], item[0] is None, item[0] or ""))[:assignees]
+    return {
+        "total": sum(by_status.values()),
+        "overdue": overdue,
+        "by_status": by_status,
+        "by_priority": by_priority,
+        "by_status_priority": by_status_priority,
+        "by_assignee": [{"assigned_to": assigned_to, "count": count} for assigned_to, count in top],
+    }
+
+# Read the statistics in one transaction
+async def read_stats(connection, assignees: int) -> dict:
+    rows = (await connection.execute(COUNTS_STATEMENT)).all()
+    overdue = (await connection.execute(overdue_statement(datetime.now(timezone.utc)))).scalar()
+    return stats_to_dict(rows, overdue, assignees)
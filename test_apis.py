@@ -1,12 +1,17 @@
 import sys
 import os
+import json
 
 sys.path.append(os.path.dirname(__file__))
 
 from fastapi.testclient import TestClient
 import pytest
 from main import app
-from database import sqlite_file_name, engine
+from database import sqlite_file_name, engine, async_engine
+from sqlalchemy import event
+from models import Task, TaskResponse, TaskStatus, TaskPriority
+from database_seeder import generate_tasks
+from sqlmodel import Session, select
 
 client = TestClient(app)
 
@@ -180,10 +185,896 @@ def test_get_tasks_with_text_returns_success():
     response = client.get("tasks/search/string")
     assert response.status_code == 200
 
+# 32. Test paginate tasks using the next page cursor
+def test_get_tasks_with_cursor_returns_next_page():
+    first_page = client.get("/tasks", params={"limit": 2})
+    assert first_page.status_code == 200
+    assert len(first_page.json()) == 2
+    cursor = first_page.headers["X-Next-Cursor"]
+    second_page = client.get("/tasks", params={"limit": 2, "cursor": cursor})
+    assert second_page.status_code == 200
+    assert second_page.json()[0]["id"] > first_page.json()[-1]["id"]
+
+# 33. Test paginate sorted tasks does not repeat or skip tasks
+def test_get_tasks_sort_by_title_with_cursor_returns_all_tasks():
+    all_tasks = client.get("/tasks/sortBy/title").json()
+    paged_tasks, cursor = [], None
+    while True:
+        params = {"limit": 1, "cursor": cursor} if cursor else {"limit": 1}
+        response = client.get("/tasks/sortBy/title", params=params)
+        paged_tasks += response.json()
+        cursor = response.headers.get("X-Next-Cursor")
+        if not cursor:
+            break
+    assert paged_tasks == all_tasks
+
+# 34. Test paginate tasks with incorrect cursor
+def test_get_tasks_with_invalid_cursor_returns_bad_request_error():
+    response = client.get("/tasks", params={"cursor": "string"})
+    assert response.status_code == 400
+
+# 35. Test paginate tasks with a page size above the maximum
+def test_get_tasks_with_too_large_limit_returns_validation_error():
+    response = client.get("/tasks", params={"limit": 100000})
+    assert response.status_code == 422
+
+# 36. Test stream tasks as newline delimited JSON
+def test_get_tasks_with_stream_returns_ndjson():
+    tasks = client.get("/tasks").json()
+    response = client.get("/tasks", params={"stream": "true"})
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/x-ndjson"
+    assert [json.loads(line) for line in response.text.splitlines()] == tasks
+
+# 37. Test stream tasks using the accept header
+def test_get_tasks_sort_by_title_with_ndjson_accept_header_returns_ndjson():
+    response = client.get("/tasks/sortBy/title", headers={"Accept": "application/x-ndjson"})
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/x-ndjson"
+
+# 38. Test fast serialization matches the TaskResponse model
+def test_get_tasks_matches_task_response_model():
+    response = client.get("/tasks")
+    with Session(engine) as session:
+        tasks = session.exec(select(Task).order_by(Task.id)).all()
+        expected = [TaskResponse.model_validate(task).model_dump(mode="json") for task in tasks]
+    assert response.json() == expected[:len(response.json())]
+
+# 39. Test create tasks in bulk reports each item
+def test_post_tasks_bulk_returns_item_results():
+    response = client.post("/tasks/bulk", json=[{"title": "Bulk 1"}, {"title": " "}, {"title": "Bulk 2", "priority": "high"}])
+    assert response.status_code == 200
+    assert [item["status"] for item in response.json()] == [201, 422, 201]
+    assert response.json()[2]["task"]["priority"] == "high"
+
+# 40. Test update tasks in bulk reports each item
+def test_patch_tasks_bulk_returns_item_results():
+    task_id = client.post("/tasks/bulk", json=[{"title": "Bulk 3"}]).json()[0]["task"]["id"]
+    response = client.patch("/tasks/bulk", json=[{"id": task_id, "status": "completed"}, {"id": 900, "title": "New"}, {"title": "New"}])
+    assert response.status_code == 200
+    assert [item["status"] for item in response.json()] == [200, 404, 422]
+    assert client.get(f"/tasks/{task_id}").json()["status"] == "completed"
+
+# 41. Test delete tasks in bulk reports each item
+def test_delete_tasks_bulk_returns_item_results():
+    task_id = client.post("/tasks/bulk", json=[{"title": "Bulk 4"}]).json()[0]["task"]["id"]
+    response = client.request("DELETE", "/tasks/bulk", json=[task_id, 900])
+    assert response.status_code == 200
+    assert [item["status"] for item in response.json()] == [200, 404]
+    assert client.get(f"/tasks/{task_id}").status_code == 404
+
+# 42. Test move tasks between statuses returns the affected ids
+def test_put_tasks_with_status_returns_ids():
+    task_id = client.post("/tasks/bulk", json=[{"title": "Bulk 5", "status": "completed"}]).json()[0]["task"]["id"]
+    response = client.put("/tasks/updateAll/completed", params={"to": "cancelled", "returning": "ids"})
+    assert response.status_code == 200
+    assert task_id in response.json()["ids"]
+    assert response.json()["count"] == len(response.json()["ids"])
+
+# 43. Test delete tasks with a status returns the deleted rows
+def test_delete_tasks_with_status_returns_rows():
+    response = client.delete("/tasks/deleteAll/cancelled", params={"returning": "rows"})
+    assert response.status_code == 200
+    assert all(task["status"] == "cancelled" for task in response.json()["tasks"])
+    assert client.get("/tasks/status/cancelled").json() == []
+
+# 44. Test search matches word prefixes and ranks title matches first
+def test_get_tasks_with_search_prefix_returns_ranked_tasks():
+    created = client.post("/tasks/bulk", json=[{"title": "Other", "description": "Searchable words"}, {"title": "Searchable title"}]).json()
+    response = client.get("/tasks/search/search")
+    assert response.status_code == 200
+    assert [task["id"] for task in response.json()] == [created[1]["task"]["id"], created[0]["task"]["id"]]
+
+# 45. Test search index follows updates and deletes
+def test_get_tasks_with_search_after_update_and_delete_returns_success():
+    task_ids = [item["task"]["id"] for item in client.post("/tasks/bulk", json=[{"title": "Findme one"}, {"title": "Findme two"}]).json()]
+    client.put(f"/tasks/{task_ids[0]}", json={"title": "Renamed"})
+    client.delete(f"/tasks/{task_ids[1]}")
+    response = client.get("/tasks/search/findme")
+    assert response.status_code == 200
+    assert response.json() == []
+
+# Capture the SELECT statements run by an endpoint and explain their query plans
+def explain_endpoint(path: str, params: dict) -> list:
+    statements = []
+    def capture(connection, cursor, statement, parameters, context, executemany):
+        # The change counter lookup of conditional requests is a primary key lookup, left out
+        if statement.lstrip().upper().startswith("SELECT") and "task_version" not in statement:
+            statements.append((statement, parameters))
+
+    event.listen(async_engine.sync_engine, "before_cursor_execute", capture)
+    try:
+        assert client.get(path, params=params).status_code == 200
+    finally:
+        event.remove(async_engine.sync_engine, "before_cursor_execute", capture)
+    with engine.connect() as connection:
+        return [[row[3] for row in connection.exec_driver_sql("EXPLAIN QUERY PLAN " + statement, parameters)] for statement, parameters in statements]
+
+# 46. Test the query of each list endpoint uses its index instead of a table scan and sort
+# Plans are checked on the second page, after the cursor of the first one
+@pytest.mark.parametrize("path, index", [
+    ("/tasks", "INTEGER PRIMARY KEY"),
+    ("/tasks/status/pending", "ix_task_status_id"),
+    ("/tasks/priority/medium", "ix_task_priority_id"),
+    ("/tasks/status/pending/priority/medium", "ix_task_status_priority_id"),
+    ("/tasks/sortBy/title", "ix_task_title"),
+    ("/tasks/sortBy/dueDate", "ix_task_due_date_id"),
+    ("/tasks/sortBy/updatedAt", "ix_task_updated_at_id"),
+    ("/tasks/search/task", "task_fts"),
+])
+def test_get_tasks_query_plans_use_indexes(path, index):
+    client.post("/tasks/bulk", json=[{"title": "Task plan", "status": "pending", "priority": "medium"}] * 2)
+    cursor = client.get(path, params={"limit": 1}).headers["X-Next-Cursor"]
+    plans = explain_endpoint(path, {"limit": 1, "cursor": cursor})
+    assert len(plans) == 1
+    plan = plans[0]
+    assert any(index in detail for detail in plan), plan
+    assert not any(detail.startswith("SCAN task") and "INDEX" not in detail for detail in plan), plan
+    # Search results are ordered by relevance, which can only be sorted once the matches are found
+    if not path.startswith("/tasks/search"):
+        assert not any("TEMP B-TREE" in detail for detail in plan), plan
+
+# 47. Test get tasks with combined filters, sort and fields
+def test_get_tasks_with_filters_sort_and_fields_returns_success():
+    client.post("/tasks/bulk", json=[
+        {"title": "Query B", "status": "completed", "priority": "urgent", "assigned_to": "Query"},
+        {"title": "Query A", "status": "in_progress", "priority": "urgent", "assigned_to": "Query"},
+        {"title": "Query C", "status": "pending", "priority": "urgent", "assigned_to": "Query"},
+    ])
+    response = client.get("/tasks", params={
+        "status": ["completed", "in_progress"],
+        "priority": "urgent",
+        "assigned_to": "Query",
+        "sort": "title",
+        "fields": "title,status",
+    })
+    assert response.status_code == 200
+    assert response.json() == [{"title": "Query A", "status": "in_progress"}, {"title": "Query B", "status": "completed"}]
+
+# 48. Test get tasks with multi key sort pages through every task once
+def test_get_tasks_with_multi_key_sort_and_cursor_returns_all_tasks():
+    params = {"sort": "-priority,title", "fields": "id"}
+    all_tasks = client.get("/tasks", params={**params, "limit": 1000}).json()
+    paged_tasks, cursor = [], None
+    while True:
+        response = client.get("/tasks", params={**params, "limit": 3, **({"cursor": cursor} if cursor else {})})
+        paged_tasks += response.json()
+        cursor = response.headers.get("X-Next-Cursor")
+        if not cursor:
+            break
+    assert paged_tasks == all_tasks
+
+# 49. Test get tasks with incorrect sort and fields
+def test_get_tasks_with_unknown_sort_or_fields_returns_validation_error():
+    assert client.get("/tasks", params={"sort": "description"}).status_code == 422
+    assert client.get("/tasks", params={"fields": "id,secret"}).status_code == 422
+
+# 50. Test get task is served from the cache and refreshed after an update
+def test_get_task_with_id_cached_until_update():
+    task_id = client.post("/tasks", json={"title": "Cached"}).json()["id"]
+    client.get(f"/tasks/{task_id}")
+    hits = client.get("/cache/stats").json()["hits"]
+    assert client.get(f"/tasks/{task_id}").json()["title"] == "Cached"
+    assert client.get("/cache/stats").json()["hits"] == hits + 1
+    client.put(f"/tasks/{task_id}", json={"title": "Cached renamed"})
+    assert client.get(f"/tasks/{task_id}").json()["title"] == "Cached renamed"
+    client.delete(f"/tasks/{task_id}")
+    assert client.get(f"/tasks/{task_id}").status_code == 404
+
+# 51. Test cached pages keep their cursor and are dropped after a write
+def test_get_tasks_cached_page_invalidated_after_write():
+    params = {"status": "pending", "sort": "-id", "limit": 2}
+    first = client.get("/tasks", params=params)
+    second = client.get("/tasks", params=params)
+    assert second.json() == first.json()
+    assert second.headers["X-Next-Cursor"] == first.headers["X-Next-Cursor"]
+    task_id = client.post("/tasks", json={"title": "Newest pending"}).json()["id"]
+    assert client.get("/tasks", params=params).json()[0]["id"] == task_id
+    client.put("/tasks/updateAll/pending", params={"to": "in_progress"})
+    assert client.get("/tasks", params=params).json() == []
+
+# 52. Test get task with an unchanged tag returns not modified
+def test_get_task_with_id_and_if_none_match_returns_not_modified():
+    task_id = client.post("/tasks", json={"title": "Tagged"}).json()["id"]
+    etag = client.get(f"/tasks/{task_id}").headers["ETag"]
+    response = client.get(f"/tasks/{task_id}", headers={"If-None-Match": etag})
+    assert response.status_code == 304
+    assert response.content == b""
+    client.put(f"/tasks/{task_id}", json={"title": "Tagged again"})
+    response = client.get(f"/tasks/{task_id}", headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.headers["ETag"] != etag
+
+# 53. Test get tasks with an unchanged tag returns not modified until a write
+def test_get_tasks_with_if_none_match_returns_not_modified():
+    params = {"sort": "-id", "limit": 5}
+    etag = client.get("/tasks", params=params).headers["ETag"]
+    assert client.get("/tasks", params=params, headers={"If-None-Match": etag}).status_code == 304
+    assert client.get("/tasks", params={**params, "limit": 6}, headers={"If-None-Match": etag}).status_code == 200
+    client.delete(f"/tasks/{client.post('/tasks', json={'title': 'Poll'}).json()['id']}")
+    assert client.get("/tasks", params=params, headers={"If-None-Match": etag}).status_code == 200
+
+# 54. Test update task with an outdated tag returns precondition failed
+def test_put_task_with_outdated_if_match_returns_precondition_failed():
+    task_id = client.post("/tasks", json={"title": "Versioned"}).json()["id"]
+    etag = client.get(f"/tasks/{task_id}").headers["ETag"]
+    response = client.put(f"/tasks/{task_id}", json={"title": "First"}, headers={"If-Match": etag})
+    assert response.status_code == 200
+    assert response.headers["ETag"] == client.get(f"/tasks/{task_id}").headers["ETag"]
+    response = client.put(f"/tasks/{task_id}", json={"title": "Second"}, headers={"If-Match": etag})
+    assert response.status_code == 412
+    assert client.get(f"/tasks/{task_id}").json()["title"] == "First"
+
+# 55. Test changes after a seq include updates and deletes once, with the current task
+def test_get_task_changes_returns_changed_tasks_and_tombstones():
+    since = client.get("/tasks/changes", params={"since": 10**9}).json()["next_since"]
+    task_ids = [client.post("/tasks", json={"title": f"Change {i}"}).json()["id"] for i in range(3)]
+    client.put(f"/tasks/{task_ids[0]}", json={"title": "Change updated"})
+    client.delete(f"/tasks/{task_ids[1]}")
+    response = client.get("/tasks/changes", params={"since": since})
+    assert response.status_code == 200
+    changes = response.json()["changes"]
+    assert [(change["task_id"], change["op"]) for change in changes] == [(task_ids[2], "insert"), (task_ids[0], "update"), (task_ids[1], "delete")]
+    assert changes[1]["task"]["title"] == "Change updated"
+    assert changes[2]["task"] is None
+    assert response.json()["next_since"] == changes[-1]["seq"]
+    assert client.get("/tasks/changes", params={"since": changes[-1]["seq"]}).json()["changes"] == []
+
+# 56. Test changes are paginated with next_since
+def test_get_task_changes_with_limit_pages_through_changes():
+    since = client.get("/tasks/changes", params={"since": 10**9}).json()["next_since"]
+    client.post("/tasks/bulk", json=[{"title": f"Paged change {i}"} for i in range(5)])
+    seen = []
+    while True:
+        page = client.get("/tasks/changes", params={"since": since, "limit": 2}).json()
+        seen += [change["task"]["title"] for change in page["changes"]]
+        since = page["next_since"]
+        if not page["has_more"]:
+            break
+    assert seen == [f"Paged change {i}" for i in range(5)]
+
+# 57. Test the change stream sends the changes after the last event id as server-sent events
+def test_stream_task_changes_returns_events():
+    since = client.get("/tasks/changes", params={"since": 10**9}).json()["next_since"]
+    task_id = client.post("/tasks", json={"title": "Streamed change"}).json()["id"]
+    response = client.get("/tasks/changes/stream", params={"timeout": 0}, headers={"Last-Event-ID": str(since)})
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/event-stream")
+    events = [event for event in response.text.split("\n\n") if event.startswith("id:")]
+    assert len(events) == 1
+    assert f'"task_id":{task_id}' in events[0]
+
+# 58. Test synthetic tasks are reproducible and valid
+def test_generate_tasks_returns_valid_reproducible_tasks():
+    tasks = list(generate_tasks(500, seed=1))
+    assert [task["title"] for task in tasks] == [task["title"] for task in generate_tasks(500, seed=1)]
+    assert len({task["status"] for task in tasks}) == len(TaskStatus)
+    for task in tasks:
+        Task.model_validate(task)
+        assert task["updated_at"] is None or task["updated_at"] >= task["created_at"]
+
+# 59. Test export then import of tasks, imported tasks are searchable and versioned like the others
+def test_export_and_import_tasks_returns_success():
+    response = client.get("/tasks/export", params={"format": "csv"})
+    assert response.status_code == 200
+    assert response.text.splitlines()[0] == "id,title,description,status,priority,created_at,updated_at,due_date,assigned_to"
+    exported = [json.loads(line) for line in client.get("/tasks/export").text.splitlines()]
+    assert len(exported) == len(response.text.splitlines()) - 1
+
+    rows = [{**task, "id": None, "title": f"Imported zyxwv {task['id']}"} for task in exported[:3]]
+    body = "".join(json.dumps(row) + "\n" for row in rows)
+    response = client.post("/tasks/import", content=body, headers={"Content-Type": "application/x-ndjson"})
+    assert response.status_code == 201
+    assert response.json()["imported"] == 3
+    found = client.get("/tasks/search/zyxwv").json()
+    assert sorted(task["title"] for task in found) == sorted(row["title"] for row in rows)
+    etag = client.get(f"/tasks/{found[0]['id']}").headers["ETag"]
+    client.put(f"/tasks/{found[0]['id']}", json={"status": "completed"})
+    assert client.get(f"/tasks/{found[0]['id']}").headers["ETag"] != etag
+
+# 60. Test import with an invalid row imports nothing
+def test_import_tasks_with_invalid_row_returns_validation_error():
+    count = len(client.get("/tasks/export").text.splitlines())
+    body = "title,status\nValid,pending\n,pending\n"
+    response = client.post("/tasks/import", params={"format": "csv"}, content=body)
+    assert response.status_code == 422
+    assert len(client.get("/tasks/export").text.splitlines()) == count
+    assert client.post("/tasks/import", content=body).status_code == 415
+
+# 61. Test seeding with synthetic tasks
+def test_seeding_with_synthetic_tasks_returns_success():
+    response = client.post("/seed", params={"tasks": 2000})
+    assert response.status_code == 201
+    assert len(client.get("/tasks/export").text.splitlines()) == 2000
+    assert client.get("/tasks/changes", params={"limit": 1}).json()["next_since"] > 0
+    assert client.get("/tasks/search/deploy").json() != []
+
+# 62. Test metrics count requests per route with their queries and payload sizes
+def test_get_metrics_returns_route_metrics():
+    client.get("/tasks/1")
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain")
+    lines = response.text.splitlines()
+    assert any(line.startswith('http_request_duration_seconds_count{method="GET",route="/tasks/{task_id}",status="200"}') for line in lines)
+    assert any(line.startswith('db_queries_per_request_sum{method="GET",route="/tasks/{task_id}"}') for line in lines)
+    assert any(line.startswith('http_response_size_bytes_bucket{method="GET",route="/tasks/{task_id}",le="256"}') for line in lines)
+    assert any(line.startswith("db_pool_size ") for line in lines)
+
+# 63. Test a request with the profiling header returns its profile
+def test_get_tasks_with_profile_header_returns_profile(monkeypatch):
+    import metrics
+    assert client.get("/tasks", headers={"X-Profile": "1"}).headers["content-type"] == "application/json"
+    monkeypatch.setattr(metrics, "PROFILING_ENABLED", True)
+    response = client.get("/tasks", headers={"X-Profile": "1"})
+    assert response.status_code == 200
+    assert response.headers["x-profile"] == "true"
+    assert response.text.startswith("GET /tasks -> 200 in ")
+
+# 64. Test readiness returns ready, then not ready after SIGTERM while the server keeps serving until it stops
+def test_get_ready_returns_ready_until_draining(tmp_path):
+    import signal
+    import socket
+    import subprocess
+    import time
+    import httpx
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        port = probe.getsockname()[1]
+    environment = {**os.environ, "SQLITE_FILE_NAME": str(tmp_path / "draining.db"), "DRAIN_DELAY": "2"}
+    server = subprocess.Popen([sys.executable, "-m", "uvicorn", "main:app", "--port", str(port)],
+                              env = environment, cwd = os.path.dirname(os.path.abspath(__file__)), stderr = subprocess.DEVNULL)
+    url = f"http://127.0.0.1:{port}"
+    try:
+        for _ in range(100):
+            try:
+                response = httpx.get(f"{url}/ready")
+                break
+            except httpx.TransportError:
+                time.sleep(0.1)
+        assert response.status_code == 200
+        assert response.json()["status"] == "ready"
+        server.send_signal(signal.SIGTERM)
+        time.sleep(0.5)
+        response = httpx.get(f"{url}/ready")
+        assert response.status_code == 503
+        assert response.json() == {"status": "draining"}
+        assert httpx.get(f"{url}/health").status_code == 200
+        # uvicorn raises the signal again once it has shut down
+        assert server.wait(timeout = 30) in (0, -signal.SIGTERM)
+        with pytest.raises(httpx.TransportError):
+            httpx.get(f"{url}/ready")
+    finally:
+        server.kill()
+
+# 65. Test migrations upgrade a database created before them, and run once
+def test_migrate_upgrades_legacy_database_once(tmp_path):
+    from sqlmodel import create_engine
+    from database import configure_sqlite
+    from migrations import SCHEMA_VERSION, migrate, schema_version
+    from sqlalchemy import text
+    legacy = create_engine(f"sqlite:///{tmp_path / 'legacy.db'}")
+    configure_sqlite(legacy)
+    with legacy.begin() as connection:
+        connection.execute(text("""CREATE TABLE task (id INTEGER PRIMARY KEY, title VARCHAR(200) NOT NULL, description VARCHAR(1000),
+            status VARCHAR(11) NOT NULL, priority VARCHAR(6) NOT NULL, created_at DATETIME NOT NULL, updated_at DATETIME,
+            due_date DATETIME, assigned_to VARCHAR(100))"""))
+        connection.execute(text("""INSERT INTO task (title, status, priority, created_at) VALUES
+            ('Legacy report', 'pending', 'high', '2025-01-01 00:00:00'), ('Legacy review', 'completed', 'low', '2025-01-02 00:00:00')"""))
+    assert migrate(legacy) == SCHEMA_VERSION
+    assert migrate(legacy) == 0
+    with legacy.connect() as connection:
+        assert schema_version(connection) == SCHEMA_VERSION
+        assert connection.execute(text("SELECT count(*) FROM task WHERE version > 0")).scalar() == 2
+        assert connection.execute(text("SELECT count(*) FROM task_change")).scalar() == 2
+        assert connection.execute(text("SELECT sum(count) FROM task_stats")).scalar() == 2
+        assert connection.execute(text("SELECT rowid FROM task_fts WHERE task_fts MATCH 'review'")).scalar() == 2
+        assert connection.execute(text("SELECT task_id FROM task_scheduler")).scalar() == 0
+    with legacy.begin() as connection:
+        connection.execute(text("UPDATE task SET title = 'Legacy renamed' WHERE id = 1"))
+        assert connection.execute(text("SELECT version FROM task WHERE id = 1")).scalar() == 3
+    legacy.dispose()
+
+# Counts of the task table by status and priority, and by assignee, to compare with the statistics
+def count_tasks_by_group() -> tuple[dict, dict]:
+    from sqlalchemy import func
+    with Session(engine) as session:
+        rows = session.exec(select(Task.status, Task.priority, Task.assigned_to, func.count()).group_by(Task.status, Task.priority, Task.assigned_to)).all()
+    by_status_priority, by_assignee = {}, {}
+    for status, priority, assigned_to, count in rows:
+        key = (status.value, priority.value)
+        by_status_priority[key] = by_status_priority.get(key, 0) + count
+        by_assignee[assigned_to] = by_assignee.get(assigned_to, 0) + count
+    return by_status_priority, by_assignee
+
+# 66. Test task statistics follow every kind of write
+def test_get_task_stats_returns_counts_after_writes():
+    from datetime import datetime, timedelta, timezone
+    before = client.get("/tasks/stats").json()["overdue"]
+    ids = [task["task"]["id"] for task in client.post("/tasks/bulk", json=[{"title": "Stats", "priority": "urgent", "assigned_to": "stats-owner"}] * 3).json()]
+    client.put(f"/tasks/{ids[0]}", json={"status": "completed"})
+    client.patch("/tasks/bulk", json=[{"id": ids[1], "assigned_to": "stats-other", "priority": "low"}])
+    client.delete(f"/tasks/{ids[2]}")
+    client.put("/tasks/updateAll/in_progress", params={"to": "pending"})
+    with Session(engine) as session:
+        session.add(Task(title = "Overdue", status = TaskStatus.in_progress, due_date = datetime.now(timezone.utc) - timedelta(days = 1)))
+        session.add(Task(title = "Done late", status = TaskStatus.completed, due_date = datetime.now(timezone.utc) - timedelta(days = 1)))
+        session.commit()
+
+    response = client.get("/tasks/stats", params={"assignees": 1000})
+    assert response.status_code == 200
+    stats = response.json()
+    by_status_priority, by_assignee = count_tasks_by_group()
+    assert stats["total"] == sum(by_status_priority.values())
+    assert stats["overdue"] == before + 1
+    for status, priorities in stats["by_status_priority"].items():
+        for priority, count in priorities.items():
+            assert count == by_status_priority.get((status, priority), 0)
+    assert {item["assigned_to"]: item["count"] for item in stats["by_assignee"]} == by_assignee
+    assert stats["by_status"]["pending"] == sum(stats["by_status_priority"]["pending"].values())
+    assert len(client.get("/tasks/stats", params={"assignees": 1}).json()["by_assignee"]) == 1
+
+# 67. Test task statistics do not scan the task table
+def test_get_task_stats_query_plans_do_not_scan_tasks():
+    plans = explain_endpoint("/tasks/stats", {})
+    assert len(plans) == 2
+    assert any("ix_task_open_due_date_id" in detail for detail in plans[1]), plans
+    assert not any(detail.startswith("SCAN task ") or detail == "SCAN task" for plan in plans for detail in plan), plans
+
+# Statements other than transaction control run by a request
+def statements_of_request(method: str, path: str, **kwargs) -> tuple:
+    statements = []
+    def capture(connection, cursor, statement, parameters, context, executemany):
+        if statement.lstrip().split()[0].upper() in ("SELECT", "INSERT", "UPDATE", "DELETE"):
+            statements.append(statement)
+
+    event.listen(async_engine.sync_engine, "before_cursor_execute", capture)
+    try:
+        response = client.request(method, path, **kwargs)
+    finally:
+        event.remove(async_engine.sync_engine, "before_cursor_execute", capture)
+    return response, statements
+
+# 68. Test update and delete task with id run a single statement
+def test_put_and_delete_task_with_id_run_one_statement():
+    task_id = client.post("/tasks", json={"title": "One trip", "description": "Kept"}).json()["id"]
+    response, statements = statements_of_request("PUT", f"/tasks/{task_id}", json={"description": "", "priority": "low"})
+    assert response.status_code == 200
+    assert len(statements) == 1 and statements[0].startswith("UPDATE"), statements
+    assert response.json()["description"] == ""
+    assert response.json()["priority"] == "low"
+    assert response.headers["ETag"] == client.get(f"/tasks/{task_id}").headers["ETag"]
+    version = int(response.headers["ETag"].strip('"').split(".")[1])
+    change = client.get("/tasks/changes", params={"since": version - 1, "limit": 1}).json()["changes"][0]
+    assert (change["seq"], change["task_id"], change["op"]) == (version, task_id, "update")
+    response, statements = statements_of_request("DELETE", f"/tasks/{task_id}")
+    assert response.status_code == 200
+    assert len(statements) == 1 and statements[0].startswith("DELETE"), statements
+    assert client.delete(f"/tasks/{task_id}").status_code == 404
+    assert client.put(f"/tasks/{task_id}", json={"title": "Gone"}).status_code == 404
+
+# 69. Test partial update only changes the fields sent, and null clears optional fields
+def test_patch_task_with_id_returns_partially_updated_task():
+    task = client.post("/tasks", json={"title": "Partial", "description": "Keep", "assigned_to": "someone", "priority": "high"}).json()
+    etag = client.get(f"/tasks/{task['id']}").headers["ETag"]
+    response = client.patch(f"/tasks/{task['id']}", json={"assigned_to": None, "status": "in_progress"}, headers={"If-Match": etag})
+    assert response.status_code == 200
+    patched = response.json()
+    assert patched["assigned_to"] is None
+    assert patched["status"] == "in_progress"
+    assert (patched["title"], patched["description"], patched["priority"]) == ("Partial", "Keep", "high")
+    assert client.patch(f"/tasks/{task['id']}", json={"title": "Stale"}, headers={"If-Match": etag}).status_code == 412
+    assert client.patch(f"/tasks/{task['id']}", json={"title": None}).status_code == 422
+    assert client.patch("/tasks/999999999", json={"title": "Missing"}).status_code == 404
+
+# 70. Test responses are compressed with the negotiated encoding above the minimum size, streams included
+def test_get_tasks_with_accept_encoding_returns_compressed_response():
+    from compression import COMPRESSORS, negotiate_encoding
+    plain = client.get("/tasks", params={"limit": 100}, headers={"Accept-Encoding": "identity"})
+    assert "content-encoding" not in plain.headers
+    response = client.get("/tasks", params={"limit": 100}, headers={"Accept-Encoding": "gzip"})
+    assert response.headers["content-encoding"] == "gzip"
+    assert "Accept-Encoding" in response.headers["vary"]
+    assert response.json() == plain.json()
+    assert int(response.headers["content-length"]) < len(plain.content)
+    assert "content-encoding" not in client.get("/health", headers={"Accept-Encoding": "gzip"}).headers
+    streamed = client.get("/tasks", params={"stream": "true"}, headers={"Accept-Encoding": "gzip"})
+    assert streamed.headers["content-encoding"] == "gzip"
+    assert len(streamed.text.splitlines()) > 100
+    assert negotiate_encoding("gzip;q=0.5, br, zstd;q=0") == ("br" if "br" in COMPRESSORS else "gzip")
+    assert negotiate_encoding("identity, gzip;q=0") is None
+
+# 71. Test compact columnar and MessagePack pages hold the same tasks as the JSON page
+def test_get_tasks_with_compact_formats_returns_same_tasks():
+    from datetime import datetime, timedelta, timezone
+    from serializers import MSGPACK_AVAILABLE
+    params = {"limit": 50, "sort": "-id"}
+    tasks = client.get("/tasks", params=params).json()
+    response = client.get("/tasks", params={**params, "format": "columns"})
+    assert response.status_code == 200
+    assert response.headers["ETag"] != client.get("/tasks", params=params).headers["ETag"]
+
+    # Datetimes of both representations are compared to the millisecond
+    epoch = datetime(1970, 1, 1, tzinfo = timezone.utc)
+    def decode(page: dict) -> list:
+        columns, enums, decoded = page["columns"], page["enums"], []
+        for index in range(page["count"]):
+            task = {}
+            for field, values in columns.items():
+                value = values[index]
+                if field in enums:
+                    value = enums[field][value]
+                elif field.endswith(("_at", "_date")) and value is not None:
+                    value = epoch + timedelta(milliseconds = value)
+                task[field] = value
+            decoded.append(task)
+        return decoded
+
+    def truncate(task: dict) -> dict:
+        return {field: datetime.fromisoformat(value).replace(microsecond = datetime.fromisoformat(value).microsecond // 1000 * 1000)
+                if field.endswith(("_at", "_date")) and value else value for field, value in task.items()}
+
+    assert [truncate(task) for task in tasks] == decode(response.json())
+    response = client.get("/tasks", params=params, headers={"Accept": "application/msgpack"})
+    if MSGPACK_AVAILABLE:
+        import msgpack
+        assert response.headers["content-type"] == "application/msgpack"
+        assert decode(msgpack.unpackb(response.content)) == decode(client.get("/tasks", params={**params, "format": "columns"}).json())
+    else:
+        assert response.status_code == 406
+
+# 72. Test overdue and due soon lists return the open tasks of their due date range, from the open tasks index
+def test_get_overdue_and_due_soon_tasks_returns_open_tasks_by_due_date():
+    from datetime import datetime, timedelta, timezone
+    now = datetime.now(timezone.utc)
+    with Session(engine) as session:
+        late = [Task(title = "Late", status = TaskStatus.pending, due_date = now - timedelta(hours = hours)) for hours in (1, 2)]
+        finished = Task(title = "Finished late", status = TaskStatus.completed, due_date = now - timedelta(hours = 1))
+        session.add_all(late + [finished])
+        session.commit()
+        late_ids, finished_id = [task.id for task in late], finished.id
+    soon = client.post("/tasks", json={"title": "Soon", "due_date": (now + timedelta(hours = 2)).isoformat()}).json()["id"]
+    later = client.post("/tasks", json={"title": "Later", "due_date": (now + timedelta(days = 3)).isoformat()}).json()["id"]
+
+    response = client.get("/tasks/overdue", params={"limit": 1000})
+    assert response.status_code == 200
+    assert "ETag" not in response.headers
+    overdue = response.json()
+    ids = [task["id"] for task in overdue]
+    assert set(late_ids) <= set(ids) and finished_id not in ids and soon not in ids
+    assert ids.index(late_ids[1]) < ids.index(late_ids[0])
+    assert all(task["status"] in ("pending", "in_progress") for task in overdue)
+    assert [task["due_date"] for task in overdue] == sorted(task["due_date"] for task in overdue)
+
+    ids = [task["id"] for task in client.get("/tasks/due-soon", params={"within": "PT6H", "limit": 1000}).json()]
+    assert soon in ids and later not in ids and late_ids[0] not in ids
+    assert later in [task["id"] for task in client.get("/tasks/due-soon", params={"within": "P7D", "limit": 1000}).json()]
+    assert client.get("/tasks/due-soon", params={"within": "PT0S"}).status_code == 400
+
+    cursor = client.get("/tasks/overdue", params={"limit": 1}).headers["X-Next-Cursor"]
+    for path in ("/tasks/overdue", "/tasks/due-soon"):
+        plans = explain_endpoint(path, {"limit": 1, "cursor": cursor} if path == "/tasks/overdue" else {"limit": 1})
+        assert len(plans) == 1
+        assert any("ix_task_open_due_date_id" in detail for detail in plans[0]), plans
+        assert not any("TEMP B-TREE" in detail for detail in plans[0]), plans
+
+# 73. Test the due date heap keeps the next due date of the loaded window, moved and deleted tasks included
+def test_due_date_scheduler_heap_returns_next_due_date():
+    import asyncio
+    from datetime import datetime, timedelta, timezone
+    from scheduler import DueDateScheduler
+    now = datetime.now(timezone.utc)
+    heap = DueDateScheduler()
+    heap.loaded_until, heap.wakeup = now + timedelta(hours = 1), asyncio.Event()
+    heap.notify(1, now + timedelta(minutes = 30))
+    heap.notify(2, now + timedelta(minutes = 10))
+    assert heap.wakeup.is_set() and heap.next_due() == now + timedelta(minutes = 10)
+    heap.notify(2, now + timedelta(minutes = 40))
+    assert heap.next_due() == now + timedelta(minutes = 30)
+    heap.notify(1, None)
+    heap.notify(3, now + timedelta(hours = 2))
+    assert heap.next_due() == now + timedelta(minutes = 40)
+    heap.pop_due(now + timedelta(minutes = 45))
+    assert heap.next_due() is None and heap.due == {}
+
+# 74. Test flagging overdue tasks adds an overdue change once per task, from the stored position
+def test_flag_overdue_adds_overdue_changes_once():
+    import asyncio
+    from datetime import datetime, timedelta, timezone
+    from scheduler import flag_overdue
+    due_date = datetime.now(timezone.utc) + timedelta(days = 30)
+    task_id = client.post("/tasks", json={"title": "Reminder", "due_date": due_date.isoformat()}).json()["id"]
+    done_id = client.post("/tasks", json={"title": "Done in time", "status": "completed", "due_date": due_date.isoformat()}).json()["id"]
+    since = int(client.get(f"/tasks/{done_id}").headers["ETag"].strip('"').split(".")[1])
+
+    assert asyncio.run(flag_overdue(due_date + timedelta(seconds = 1), batch_size = 2)) >= 1
+    changes = client.get("/tasks/changes", params={"since": since, "limit": 1000}).json()["changes"]
+    flagged = {change["task_id"]: change for change in changes}
+    assert flagged[task_id]["op"] == "overdue" and flagged[task_id]["task"]["title"] == "Reminder"
+    assert done_id not in flagged
+    assert all(change["op"] == "overdue" for change in changes)
+    assert asyncio.run(flag_overdue(due_date + timedelta(seconds = 1))) == 0
+
+# 75. Test reads are spread over the replicas, reads with the token of a write see it, and failing replicas are left out
+def test_reads_are_routed_to_replicas_with_read_your_writes(tmp_path, monkeypatch):
+    import asyncio
+    from sqlalchemy.engine import make_url
+    from database import create_api_engine, configure_sqlite
+    from routing import CONSISTENCY_HEADER, REPLICA_MAX_FAILURES, Replica, router, copy_sqlite_database
+    engines, used = [], []
+    for index in range(2):
+        copy_sqlite_database(sqlite_file_name, str(tmp_path / f"replica{index}.db"))
+        replica_engine = create_api_engine(make_url(f"sqlite+aiosqlite:///{tmp_path / f'replica{index}.db'}"))
+        configure_sqlite(replica_engine.sync_engine, read_only = True)
+        event.listen(replica_engine.sync_engine, "before_cursor_execute", lambda *args, index = index: used.append(index))
+        engines.append(replica_engine)
+    replicas = [Replica(replica_engine, f"replica{index}") for index, replica_engine in enumerate(engines)]
+    monkeypatch.setattr(router, "replicas", replicas)
+    asyncio.run(router.check())
+    assert all(replica.available() for replica in replicas)
+
+    for _ in range(4):
+        assert client.get("/tasks", params={"limit": 5}).status_code == 200
+    assert set(used) == {0, 1}
+
+    # The replicas do not have the new task yet: reads with the token of the write go to the primary
+    response = client.post("/tasks", json={"title": "Routed"})
+    task_id, token = response.json()["id"], response.headers[CONSISTENCY_HEADER]
+    assert int(token) > max(replica.position for replica in replicas)
+    assert client.get(f"/tasks/{task_id}").status_code == 404
+    used.clear()
+    assert client.get(f"/tasks/{task_id}", headers={CONSISTENCY_HEADER: token}).status_code == 200
+    assert used == []
+
+    # Once a replica caught up, it serves the reads with the token
+    copy_sqlite_database(sqlite_file_name, str(tmp_path / "replica0.db"))
+    asyncio.run(router.check())
+    used.clear()
+    assert client.get(f"/tasks/{task_id}", headers={CONSISTENCY_HEADER: token}).status_code == 200
+    assert set(used) == {0}
+
+    # A replica failing its checks is ejected, the others keep serving reads
+    monkeypatch.setattr(replicas[1], "engine", create_api_engine(make_url(f"sqlite+aiosqlite:///{tmp_path / 'missing' / 'replica.db'}")))
+    for _ in range(REPLICA_MAX_FAILURES):
+        asyncio.run(router.check())
+    assert [replica["available"] for replica in router.status()] == [True, False]
+    used.clear()
+    for _ in range(4):
+        assert client.get("/tasks", params={"limit": 5}).status_code == 200
+    assert set(used) == {0}
+    for replica_engine in engines + [replicas[1].engine]:
+        asyncio.run(replica_engine.dispose())
+
+# Write requests of one worker process, run by the test below: bulk updates (reading before writing) and an import
+WORKER_WRITES = """
+import asyncio, io, httpx
+from main import app
+from transfer import import_tasks
+
+async def main():
+    async with httpx.AsyncClient(transport = httpx.ASGITransport(app = app), base_url = "http://test") as client:
+        async def patch(task_id):
+            return (await client.patch("/tasks/bulk", json = [{"id": task_id, "priority": "high"}, {"id": task_id + 1, "title": "Shared"}])).status_code
+        statuses = await asyncio.gather(*(patch(task_id) for task_id in range(1, 61)))
+    imported = import_tasks(io.BytesIO(b'{"title": "Imported"}\\n' * 50), "ndjson")
+    print(sum(status != 200 for status in statuses), imported)
+
+asyncio.run(main())
+"""
+
+# 76. Test two worker processes writing to one database wait for each other instead of failing on the lock
+def test_concurrent_writes_from_two_processes_return_success(tmp_path):
+    import subprocess
+    environment = {**os.environ, "SQLITE_FILE_NAME": str(tmp_path / "shared.db")}
+    directory = os.path.dirname(os.path.abspath(__file__))
+    subprocess.run([sys.executable, "-c", "from main import main; main(100)"], env = environment, cwd = directory, check = True)
+    workers = [subprocess.Popen([sys.executable, "-c", WORKER_WRITES], env = environment, cwd = directory, stdout = subprocess.PIPE, text = True)
+               for _ in range(2)]
+    outputs = [worker.communicate(timeout = 120)[0].split() for worker in workers]
+    assert all(worker.returncode == 0 for worker in workers)
+    assert outputs == [["0", "50"], ["0", "50"]]
+
+# 77. Test bulk create with null status and priority creates the tasks with the default ones
+def test_post_tasks_in_bulk_with_null_status_returns_default_status():
+    response = client.post("/tasks/bulk", json=[{"title": "Null status", "status": None, "priority": None}, {"title": "Set status", "status": "completed"}])
+    assert response.status_code == 200
+    results = response.json()
+    assert [result["status"] for result in results] == [201, 201]
+    assert (results[0]["task"]["status"], results[0]["task"]["priority"]) == ("pending", "medium")
+    assert results[1]["task"]["status"] == "completed"
+    single = client.post("/tasks", json={"title": "Null status", "status": None, "priority": None})
+    assert single.status_code == 201
+    assert (single.json()["status"], single.json()["priority"]) == ("pending", "medium")
+
+# 78. Test Parquet export and import without pyarrow answer that the format is not available
+def test_parquet_transfer_without_pyarrow_returns_not_available(monkeypatch):
+    import io
+    import main
+    import transfer
+    monkeypatch.setattr(main, "PARQUET_AVAILABLE", False)
+    monkeypatch.setattr(transfer, "PARQUET_AVAILABLE", False)
+    response = client.get("/tasks/export", params={"format": "parquet"})
+    assert response.status_code == 406
+    assert response.json()["detail"] == "Parquet needs the pyarrow package"
+    response = client.post("/tasks/import", params={"format": "parquet"}, content=b"PAR1")
+    assert response.status_code == 415
+    assert response.json()["detail"] == "Parquet needs the pyarrow package"
+    with pytest.raises(transfer.TransferError):
+        transfer.export_tasks(io.BytesIO(), "parquet")
+
+# 79. Test sorting by priority and status follows the order of their values, and pages seek into the rank indexes
+def test_get_tasks_sorted_by_priority_and_status_use_enum_order():
+    priorities = [priority.value for priority in TaskPriority]
+    statuses = [status.value for status in TaskStatus]
+    client.post("/tasks/bulk", json=[{"title": "Ranked", "status": status, "priority": priority, "assigned_to": "Ranked"} for status in statuses for priority in priorities])
+    tasks = client.get("/tasks", params={"assigned_to": "Ranked", "sort": "-priority,status", "fields": "status,priority"}).json()
+    ranks = [(-priorities.index(task["priority"]), statuses.index(task["status"])) for task in tasks]
+    assert len(ranks) == 16 and ranks == sorted(ranks)
+    assert (tasks[0], tasks[-1]) == ({"status": "pending", "priority": "urgent"}, {"status": "cancelled", "priority": "low"})
+    for sort, index in [("-priority", "ix_task_priority_rank_id"), ("status", "ix_task_status_rank_id")]:
+        cursor = client.get("/tasks", params={"sort": sort, "limit": 1}).headers["X-Next-Cursor"]
+        plans = explain_endpoint("/tasks", {"sort": sort, "limit": 1, "cursor": cursor})
+        assert any(detail.startswith(f"SEARCH task USING INDEX {index}") for detail in plans[0]), plans
+        assert not any("TEMP B-TREE" in detail for detail in plans[0]), plans
+
+# 80. Test a write to a task keeps the other cached tasks, and cache backends implement every method
+def test_get_task_with_id_stays_cached_after_write_to_another_task():
+    from cache import CacheBackend
+    task_ids = [item["task"]["id"] for item in client.post("/tasks/bulk", json=[{"title": "Kept"}, {"title": "Written"}]).json()]
+    client.get(f"/tasks/{task_ids[0]}")
+    client.patch(f"/tasks/{task_ids[1]}", json={"title": "Written again"})
+    hits = client.get("/cache/stats").json()["hits"]
+    assert client.get(f"/tasks/{task_ids[0]}").json()["title"] == "Kept"
+    assert client.get("/cache/stats").json()["hits"] == hits + 1
+    assert client.get(f"/tasks/{task_ids[1]}").json()["title"] == "Written again"
+    with pytest.raises(TypeError):
+        type("PartialBackend", (CacheBackend,), {"get": lambda self, key: None})()
+
+NO_FTS5_SEARCH = """
+import database
+database.FTS5_AVAILABLE = False
+import io, json
+from fastapi.testclient import TestClient
+from sqlalchemy import text
+from main import app, main
+from transfer import import_tasks
+
+main(20)
+client = TestClient(app)
+client.post("/tasks", json = {"title": "Quarterly review"})
+import_tasks(io.BytesIO(b'{"title": "Imported quarterly plan"}\\n'), "ndjson")
+with database.engine.connect() as connection:
+    tables = connection.execute(text("SELECT count(*) FROM sqlite_master WHERE name LIKE 'task_fts%'")).scalar()
+print(json.dumps([tables, [task["title"] for task in client.get("/tasks/search/quarterly").json()]]))
+"""
+
+# 81. Test a sqlite build without FTS5 creates the database without the search index and searches with LIKE
+def test_search_without_fts5_uses_like_search(tmp_path):
+    import subprocess
+    environment = {**os.environ, "SQLITE_FILE_NAME": str(tmp_path / "no_fts5.db")}
+    directory = os.path.dirname(os.path.abspath(__file__))
+    output = subprocess.run([sys.executable, "-c", NO_FTS5_SEARCH], env = environment, cwd = directory, check = True, capture_output = True, text = True).stdout
+    assert json.loads(output) == [0, ["Quarterly review", "Imported quarterly plan"]]
+
+# 82. Test moving tasks without a target status, or to their own status, is rejected without changing them
+def test_put_tasks_with_status_without_or_to_same_status_returns_validation_error():
+    task_id = client.post("/tasks", json={"title": "Stays completed", "status": "completed"}).json()["id"]
+    etag = client.get(f"/tasks/{task_id}").headers["ETag"]
+    response = client.put("/tasks/updateAll/completed")
+    assert response.status_code == 422
+    assert response.json()["detail"] == "to is required to move tasks that are not pending"
+    response = client.put("/tasks/updateAll/completed", params={"to": "completed"})
+    assert response.status_code == 422
+    assert response.json()["detail"] == "to must differ from the status of the tasks"
+    assert client.put("/tasks/updateAll/pending", params={"to": "pending"}).status_code == 422
+    task = client.get(f"/tasks/{task_id}")
+    assert task.json()["status"] == "completed"
+    assert task.headers["ETag"] == etag
+
+# Value of a metric line of /metrics
+def metric_value(name: str) -> float:
+    lines = client.get("/metrics").text.splitlines()
+    return next((float(line.rsplit(" ", 1)[1]) for line in lines if line.startswith(name + " ")), 0.0)
+
+# 83. Test the statements of writes run by the write queue are counted against the request submitting them
+def test_get_metrics_counts_queued_writes_per_request():
+    name = 'db_queries_per_request_sum{method="POST",route="/tasks"}'
+    queries = metric_value(name)
+    client.post("/tasks", json={"title": "Counted write"})
+    assert metric_value(name) >= queries + 1
+    assert metric_value('db_query_duration_seconds_per_request_sum{method="POST",route="/tasks"}') > 0
+
+# 84. Test a failed statement leaves no start time behind, and cache lookups are exported on /metrics
+def test_get_metrics_after_failed_statement_and_cache_lookups():
+    from sqlalchemy import create_engine, text
+    from sqlalchemy.exc import OperationalError
+    from metrics import instrument_engine
+    instrumented = create_engine("sqlite://")
+    instrument_engine(instrumented)
+    with instrumented.connect() as connection:
+        with pytest.raises(OperationalError):
+            connection.execute(text("SELECT * FROM missing_table"))
+        assert connection.info["query_start"] == []
+    task_id = client.post("/tasks", json={"title": "Cache metrics"}).json()["id"]
+    hits = metric_value('cache_lookups_total{result="hit"}')
+    client.get(f"/tasks/{task_id}")
+    client.get(f"/tasks/{task_id}")
+    assert metric_value('cache_lookups_total{result="hit"}') == hits + 1
+    assert metric_value('cache_lookups_total{result="miss"}') > 0
+    assert metric_value("cache_invalidations_total") > 0
+
+# 85. Test tasks reopened or imported with a due date behind the scheduler position are still flagged overdue
+def test_flag_overdue_flags_reopened_and_imported_tasks():
+    import asyncio
+    from datetime import datetime, timedelta, timezone
+    from scheduler import flag_overdue
+    due_date = datetime.now(timezone.utc) + timedelta(days = 60)
+    done_id = client.post("/tasks", json={"title": "Reopened later", "status": "completed", "due_date": (due_date - timedelta(minutes = 1)).isoformat()}).json()["id"]
+    task_id = client.post("/tasks", json={"title": "Open reminder", "due_date": due_date.isoformat()}).json()["id"]
+    since = int(client.get(f"/tasks/{task_id}").headers["ETag"].strip('"').split(".")[1])
+
+    assert asyncio.run(flag_overdue(due_date + timedelta(seconds = 1))) >= 1
+    flagged = {change["task_id"]: change for change in client.get("/tasks/changes", params={"since": since, "limit": 1000}).json()["changes"]}
+    assert flagged[task_id]["op"] == "overdue" and done_id not in flagged
+
+    # Both tasks are due before the position, which the flagging scan has moved past
+    assert client.patch(f"/tasks/{done_id}", json={"status": "pending"}).status_code == 200
+    response = client.post("/tasks/import", params={"format": "ndjson"},
+        content=json.dumps({"title": "Imported late", "due_date": (due_date - timedelta(minutes = 2)).isoformat()}).encode())
+    assert response.status_code == 201
+    changes = client.get("/tasks/changes", params={"since": since, "limit": 1000}).json()["changes"]
+    imported_id = next(change["task_id"] for change in changes if change["task"]["title"] == "Imported late")
+
+    assert asyncio.run(flag_overdue(due_date + timedelta(seconds = 2))) == 2
+    changes = client.get("/tasks/changes", params={"since": since, "limit": 1000}).json()["changes"]
+    flagged = {change["task_id"]: change for change in changes}
+    assert flagged[done_id]["op"] == "overdue" and flagged[done_id]["task"]["status"] == "pending"
+    assert flagged[imported_id]["op"] == "overdue"
+    assert asyncio.run(flag_overdue(due_date + timedelta(seconds = 2))) == 0
+
+# 86. Test imports with a taken id answer 409 and malformed rows 422, with the row and the reason, importing nothing
+def test_import_tasks_reports_conflicting_and_malformed_rows():
+    count = client.get("/tasks/stats").json()["total"]
+    cases = [
+        ("ndjson", b'{"title": "Fine"}\n{"title": \n', 422, 2, "Invalid JSON"),
+        ("ndjson", b'{"title": "Fine"}\n\n{"title": "Bad", "status": "done"}\n', 422, 2, "status: "),
+        ("csv", b'title,status\nFine,pending\nBad,pending,extra\n', 422, 2, "3 values, the header has 2 columns"),
+        ("csv", b'title\nFine\n\xff\n', 422, 2, "Invalid CSV"),
+        ("ndjson", b'{"id": 1, "title": "Taken"}\n', 409, 1, "Task id 1 already exists"),
+        ("ndjson", b'{"id": 990001, "title": "First"}\n{"id": 990002, "title": "Second"}\n{"id": 990001, "title": "Again"}\n', 409, 3, "Task id 990001 already exists"),
+    ]
+    for format, content, status_code, row, reason in cases:
+        response = client.post("/tasks/import", params={"format": format}, content=content)
+        assert response.status_code == status_code
+        assert response.json()["detail"]["row"] == row and reason in response.json()["detail"]["reason"]
+    assert client.get("/tasks/stats").json()["total"] == count
+    assert client.get("/tasks/990001").status_code == 404
+
 # Delete database after tests are done
 @pytest.fixture(scope="session", autouse=True)
 def cleanup_database_after_tests():
     yield
     engine.dispose()
-    if os.path.exists(sqlite_file_name):
-        os.remove(sqlite_file_name)
\ No newline at end of file
+    for file_name in [sqlite_file_name, f"{sqlite_file_name}-wal", f"{sqlite_file_name}-shm"]:
+        if os.path.exists(file_name):
+            os.remove(file_name)
\ No newline at end of file
@@ -0,0 +1,252 @@
+import sys
+import os
+
+sys.path.append(os.path.dirname(__file__))
+
+import argparse
+import csv
+import importlib.util
+import io
+import time
+from datetime import datetime, timezone
+from enum import Enum as PyEnum
+from itertools import islice
+from pydantic import TypeAdapter, ValidationError
+from sqlalchemy import DDL, Enum, insert, text
+from sqlalchemy.exc import IntegrityError
+from sqlmodel.sql.sqltypes import UTCDateTime
+from models import Task, TaskImport, TASK_TRIGGER_DDL, TASK_TRIGGER_NAMES, TASK_STATS_COUNT
+from database import FTS5_AVAILABLE, engine, is_sqlite
+from serializers import TASK_FIELDS, select_task_columns, encode_tasks_ndjson
+
+# Bulk import and export of tasks (CSV, NDJSON, and Parquet when pyarrow is installed)
+# Files are read and written in fixed-size chunks, so any number of tasks fits in memory.
+# Rows are loaded with one executemany insert per chunk, all in one transaction. On sqlite, the triggers
+# maintaining the search index, the versions, the change feed and the counters are dropped during the load and their work
+# is done once at the end with set based statements, and secondary indexes are built after the load when
+# the table was empty.
+# Usage: python transfer.py import tasks.csv | python transfer.py export tasks.ndjson | python transfer.py seed 1000000
+
+CHUNK_SIZE = int(os.getenv("TASKS_TRANSFER_CHUNK_SIZE", "10000"))
+FORMATS = ("csv", "ndjson", "parquet")
+# Parquet needs the optional pyarrow package, only imported when a Parquet file is read or written
+PARQUET_AVAILABLE = importlib.util.find_spec("pyarrow") is not None
+
+TASK_IMPORT_LIST = TypeAdapter(list[TaskImport])
+
+# Raised for unknown formats or invalid rows, with the number of the row in the file (from 1, header excluded)
+class TransferError(ValueError):
+    def __init__(self, reason: str, row: int | None = None):
+        super().__init__(reason if row is None else f"Row {row}: {reason}")
+        self.reason = reason
+        self.row = row
+
+# Raised for rows whose id is taken, by an existing task or by an earlier row of the file
+class TransferConflict(TransferError):
+    pass
+
+def format_of(path: str) -> str:
+    extension = os.path.splitext(path)[1].lstrip(".").lower()
+    extension = {"jsonl": "ndjson", "json": "ndjson", "pq": "parquet"}.get(extension, extension)
+    if extension not in FORMATS:
+        raise TransferError(f"Unknown format '{extension}', expected one of {', '.join(FORMATS)}")
+    return extension
+
+def check_format_available(format: str):
+    if format == "parquet" and not PARQUET_AVAILABLE:
+        raise TransferError("Parquet needs the pyarrow package")
+
+# Read raw rows (dicts) from a binary file
+def read_rows(file, format: str):
+    if format == "csv":
+        # Lines are decoded one at a time, so an invalid one is reported at its row
+        reader = csv.DictReader(line.decode("utf-8") for line in file)
+        row = 0
+        try:
+            for row, values in enumerate(reader, 1):
+                # Values after the last column of the header are kept under None
+                if None in values:
+                    raise TransferError(f"{len(reader.fieldnames) + len(values[None])} values, the header has {len(reader.fieldnames)} columns", row)
+                yield {name: value for name, value in values.items() if value != ""}
+        except (csv.Error, UnicodeDecodeError) as e:
+            raise TransferError(f"Invalid CSV: {e}", row + 1)
+    elif format == "ndjson":
+        import orjson
+        row = 0
+        for line in file:
+            if line.strip():
+                row += 1
+                try:
+                    yield orjson.loads(line)
+                except orjson.JSONDecodeError as e:
+                    raise TransferError(f"Invalid JSON: {e}", row)
+    else:
+        import pyarrow.parquet
+        for batch in pyarrow.parquet.ParquetFile(file).iter_batches(batch_size = CHUNK_SIZE):
+            yield from batch.to_pylist()
+
+# Validate raw rows chunk by chunk, yielding lists of rows ready to insert
+def validate_chunks(rows, chunk_size: int = CHUNK_SIZE):
+    line = 0
+    while chunk := list(islice(rows, chunk_size)):
+        try:
+            tasks = TASK_IMPORT_LIST.validate_python(chunk)
+        except ValidationError as e:
+            # The location of an error starts with the index of the row in the chunk
+            error = e.errors(include_url = False)[0]
+            index, *field = error["loc"]
+            raise TransferError(f"{'.'.join(map(str, field)) or 'task'}: {error['msg']}", line + index + 1)
+        line += len(chunk)
+        yield TASK_IMPORT_LIST.dump_python(tasks)
+
+# On sqlite, rows are converted to the stored values here and inserted with the driver's executemany,
+# skipping the per value bind processing of SQLAlchemy (the slowest part of a load)
+def _sqlite_converter(column):
+    if isinstance(column.type, UTCDateTime):
+        # Same text as the DateTime type stores, naive UTC with microseconds
+        return lambda value: value if value is None else value.astimezone(timezone.utc).replace(tzinfo = None).isoformat(" ", "microseconds")
+    if isinstance(column.type, Enum):
+        return lambda value: value.name if isinstance(value, PyEnum) else value
+    return None
+
+SQLITE_COLUMNS = [(column.key, _sqlite_converter(column)) for column in Task.__table__.columns]
+SQLITE_INSERT = f"INSERT INTO task ({', '.join(key for key, _ in SQLITE_COLUMNS)}) VALUES ({', '.join('?' * len(SQLITE_COLUMNS))})"
+
+def sqlite_values(row: dict) -> tuple:
+    return tuple(convert(row.get(key)) if convert else row.get(key) for key, convert in SQLITE_COLUMNS)
+
+# Insert chunks of rows (dicts with the Task columns) in one transaction, returns the number of rows
+# The transaction takes the write lock at once (BEGIN IMMEDIATE), since it reads before writing
+# With queue_overdue, open tasks due at or before the due date scheduler position go to its backlog to be flagged
+def load_chunks(chunks, bind = engine, queue_overdue: bool = False) -> int:
+    count = 0
+    table = Task.__table__
+    with bind.execution_options(begin = "IMMEDIATE").begin() as connection:
+        defer_indexes = is_sqlite and connection.execute(text("SELECT NOT EXISTS (SELECT 1 FROM task)")).scalar()
+        if is_sqlite:
+            start_version = connection.execute(text("SELECT value FROM task_version WHERE id = 1")).scalar()
+            for name in TASK_TRIGGER_NAMES:
+                connection.execute(text(f"DROP TRIGGER IF EXISTS {name}"))
+        if defer_indexes:
+            for index in table.indexes:
+                index.drop(connection)
+
+        for chunk in chunks:
+            for row in chunk:
+                row.setdefault("version", 0)
+            if is_sqlite:
+                try:
+                    connection.exec_driver_sql(SQLITE_INSERT, [sqlite_values(row) for row in chunk])
+                except IntegrityError as e:
+                    raise duplicate_row(connection, chunk, count) from e
+            else:
+                connection.execute(insert(table), chunk)
+            count += len(chunk)
+
+        if defer_indexes:
+            for index in table.indexes:
+                index.create(connection)
+        if is_sqlite:
+            finish_sqlite_load(connection, start_version, queue_overdue)
+    return count
+
+# The row of a chunk whose id was taken: the driver's executemany stops at it, after inserting the rows before it,
+# and the rows of the load are the only ones with version 0 until it finishes
+def duplicate_row(connection, chunk: list[dict], count: int) -> TransferConflict:
+    inserted = connection.execute(text("SELECT count(*) FROM task WHERE version = 0")).scalar() - count
+    return TransferConflict(f"Task id {chunk[inserted]['id']} already exists", count + inserted + 1)
+
+# Do the work of the dropped triggers for the loaded rows (the only ones with version 0), then restore the triggers
+def finish_sqlite_load(connection, start_version: int, queue_overdue: bool = False):
+    connection.execute(text("UPDATE task SET version = :start + id WHERE version = 0"), {"start": start_version})
+    connection.execute(text("UPDATE task_version SET value = max(value, (SELECT coalesce(max(version), 0) FROM task)) WHERE id = 1"))
+    if FTS5_AVAILABLE:
+        connection.execute(text("""INSERT INTO task_fts (rowid, title, description)
+            SELECT id, title, description FROM task WHERE version > :start"""), {"start": start_version})
+    connection.execute(text("""INSERT INTO task_change (task_id, seq, op, changed_at)
+        SELECT id, version, 'insert', strftime('%Y-%m-%d %H:%M:%f', 'now') FROM task WHERE version > :start
+        ON CONFLICT (task_id) DO UPDATE SET seq = excluded.seq, op = excluded.op, changed_at = excluded.changed_at"""),
+        {"start": start_version})
+    connection.execute(text(TASK_STATS_COUNT.format(where = "version > :start")), {"start": start_version})
+    if queue_overdue:
+        connection.execute(text("""INSERT OR IGNORE INTO task_scheduler_backlog (task_id)
+            SELECT id FROM task WHERE version > :start AND status IN ('pending', 'in_progress')
+            AND due_date <= (SELECT due_date FROM task_scheduler WHERE id = 1)"""), {"start": start_version})
+    for statement in TASK_TRIGGER_DDL:
+        connection.execute(DDL(statement))
+
+# Import a file of tasks, returns the number of imported tasks
+def import_tasks(file, format: str, bind = engine, chunk_size: int = CHUNK_SIZE) -> int:
+    check_format_available(format)
+    return load_chunks(validate_chunks(read_rows(file, format), chunk_size), bind, queue_overdue = True)
+
+# Write every task to a binary file, reading them in chunks
+def export_tasks(file, format: str, bind = engine, chunk_size: int = CHUNK_SIZE) -> int:
+    check_format_available(format)
+    count = 0
+    with bind.connect() as connection:
+        result = connection.execution_options(yield_per = chunk_size).execute(select_task_columns().order_by(Task.id))
+        if format == "parquet":
+            import pyarrow
+            import pyarrow.parquet
+            writer = None
+            for rows in result.partitions():
+                batch = pyarrow.Table.from_pylist([dict(zip(TASK_FIELDS, row)) for row in rows])
+                writer = writer or pyarrow.parquet.ParquetWriter(file, batch.schema)
+                writer.write_table(batch)
+                count += len(rows)
+            if writer:
+                writer.close()
+            return count
+
+        file.write(export_header(format))
+        for rows in result.partitions():
+            file.write(encode_chunk(rows, format))
+            count += len(rows)
+        return count
+
+# First bytes of an exported file: the column names of a CSV file
+def export_header(format: str) -> bytes:
+    return (",".join(TASK_FIELDS) + "\r\n").encode() if format == "csv" else b""
+
+# Encode rows of select_task_columns() as CSV lines (dates in UTC with a "Z" suffix) or NDJSON
+def encode_chunk(rows, format: str) -> bytes:
+    if format == "ndjson":
+        return encode_tasks_ndjson(rows)
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows([value.isoformat() + "Z" if isinstance(value, datetime) else value for value in row] for row in rows)
+    return buffer.getvalue().encode()
+
+def report(action: str, count: int, elapsed: float):
+    print(f"{action} {count:,} tasks in {elapsed:.2f}s ({count / elapsed if elapsed else 0:,.0f} rows/s)")
+
+def main():
+    parser = argparse.ArgumentParser()
+    commands = parser.add_subparsers(dest = "command", required = True)
+    for command in ("import", "export"):
+        subparser = commands.add_parser(command)
+        subparser.add_argument("path")
+        subparser.add_argument("--format", choices = FORMATS, help = "by default from the file extension")
+    seed = commands.add_parser("seed", help = "replace the database with synthetic tasks")
+    seed.add_argument("count", type = int)
+    seed.add_argument("--seed", type = int, default = 0)
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    if args.command == "seed":
+        from main import main as reset_database
+        reset_database(args.count, args.seed)
+        report("seeded", args.count, time.perf_counter() - start)
+        return
+
+    from migrations import migrate
+    migrate()
+    if args.command == "import":
+        with open(args.path, "rb") as file:
+            report("imported", import_tasks(file, args.format or format_of(args.path)), time.perf_counter() - start)
+    else:
+        with open(args.path, "wb") as file:
+            report("exported", export_tasks(file, args.format or format_of(args.path)), time.perf_counter() - start)
+
+if __name__ == "__main__":
+    main()
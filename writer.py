@@ -0,0 +1,95 @@
+import asyncio
+import contextvars
+import os
+from sqlmodel.ext.asyncio.session import AsyncSession
+from database import async_engine
+from metrics import current_request
+
+# Single writer queue
+# sqlite allows one writer at a time, so instead of letting every request open its own write
+# transaction and wait on the database lock, writes are queued and run by one worker task.
+# Writes submitted while a transaction is running are grouped into the next transaction (one
+# commit, one fsync), each inside a savepoint so a failing write does not undo the others.
+# Reads do not go through the queue and keep running in parallel on the connection pool.
+# Write transactions start with BEGIN IMMEDIATE (see database.py), taking the write lock before their first
+# read: with several worker processes, a deferred transaction reading before writing would fail at once with
+# "database is locked" when another process committed in between, instead of waiting for the lock.
+# Each write runs with the statistics of the request that submitted it (see metrics.py), so its statements
+# are counted against that request even though the worker runs outside of it.
+
+WRITE_QUEUE_ENABLED = os.getenv("WRITE_QUEUE_ENABLED", "true").lower() == "true"
+WRITE_BATCH_SIZE = int(os.getenv("WRITE_BATCH_SIZE", "100"))
+
+class WriteQueue:
+    def __init__(self, engine, batch_size: int = WRITE_BATCH_SIZE):
+        self.engine = engine.execution_options(begin = "IMMEDIATE")
+        self.batch_size = batch_size
+        self.queue = None
+        self.worker = None
+        self.loop = None
+
+    # Start the worker on the running event loop, again if the loop changed (e.g. in tests)
+    def _ensure_worker(self):
+        loop = asyncio.get_running_loop()
+        if self.loop is not loop or self.worker.done():
+            self.loop = loop
+            self.queue = asyncio.Queue()
+            # The worker outlives the request starting it, so it does not run in the request's context
+            self.worker = loop.create_task(self._run(), context = contextvars.Context())
+
+    # Run write(session) in a grouped transaction and return its result once committed
+    # write is an async function receiving an AsyncSession, it must not commit
+    async def submit(self, write):
+        if not WRITE_QUEUE_ENABLED:
+            async with AsyncSession(self.engine, expire_on_commit = False) as session:
+                result = await write(session)
+                await session.commit()
+                return result
+
+        self._ensure_worker()
+        future = self.loop.create_future()
+        await self.queue.put((write, future, current_request.get()))
+        return await future
+
+    async def _run(self):
+        while True:
+            batch = [await self.queue.get()]
+            while len(batch) < self.batch_size and not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+            await self._run_batch(batch)
+            for _ in batch:
+                self.queue.task_done()
+
+    # Wait for the queued writes to be committed, then stop the worker (on shutdown)
+    async def drain(self):
+        if self.worker is None or self.loop is not asyncio.get_running_loop() or self.worker.done():
+            return
+        await self.queue.join()
+        self.worker.cancel()
+
+    async def _run_batch(self, batch: list):
+        results = []
+        try:
+            async with AsyncSession(self.engine, expire_on_commit = False) as session:
+                for write, future, stats in batch:
+                    token = current_request.set(stats)
+                    try:
+                        async with session.begin_nested():
+                            results.append((future, await write(session), None))
+                    except Exception as e:
+                        results.append((future, None, e))
+                    finally:
+                        current_request.reset(token)
+                await session.commit()
+        except Exception as e:
+            results = [(future, None, e) for _, future, _ in batch]
+
+        for future, result, error in results:
+            if future.done():
+                continue
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+write_queue = WriteQueue(async_engine)